@@ -5,6 +5,13 @@ import sys
 import os
 import click
 import shutil
+import concurrent.futures
+import hashlib
+import json
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
 try:
   from encryptId import *
   encryptIdDefine = True
@@ -12,109 +19,197 @@ except:
   encryptIdDefine = False
   print("No defined encryption key")
 
-def removeDate(ds):
-  if (0x8, 0x20) in ds:  # If Study Date is present
-    ds[(0x8, 0x20)].value = b"000000"
-  if (0x8, 0x21) in ds:  # If Series Date is present
-    ds[(0x8, 0x21)].value = b"000000"
-  if (0x8, 0x22) in ds:  # If Acquisition Date is present
-    ds[(0x8, 0x22)].value = b"000000"
-  if (0x8, 0x23) in ds:  # If Content Date is present
-    ds[(0x8, 0x23)].value = b"000000"
-  if (0x8, 0x2a) in ds:  # If Acquisition DateTime is present
-    ds[(0x8, 0x2a)].value = b"000000"
-  if (0x8, 0x30) in ds:  # If Study Time is present
-    ds[(0x8, 0x30)].value = b"000000"
-  if (0x8, 0x31) in ds:  # If Series Time is present
-    ds[(0x8, 0x31)].value = b"000000"
-  if (0x8, 0x32) in ds:  # If Acquisition Time is present
-    ds[(0x8, 0x32)].value = b"000000"
-  if (0x8, 0x33) in ds:  # If Content Time is present
-    ds[(0x8, 0x33)].value = b"000000"
-  return ds
+#Anonymization rules: ((group, element), action, value)
+#The actions are:
+#  replace: set the value (converted to int or float for binary numeric VR)
+#  blank: set an empty value (depending on the VR)
+#  hash: set the sha256 of the current value (a 2.25 uid for UI VR), truncated to the maximal length of the VR
+#  encrypt: set encryptId of the current value
+#  delete: remove the element
+#  keep: do not change the element (used in a profile to disable a previous rule)
+anonymizationRules = [
+  ((0x8, 0x12), "replace", b"000000"),  # Instance Creation Date
+  ((0x8, 0x13), "replace", b"000000"),  # Instance Creation Time
+  ((0x8, 0x20), "replace", b"000000"),  # Study Date
+  ((0x8, 0x30), "replace", b"000000"),  # Study Time
+  ((0x8, 0x50), "replace", b"000000"),  # Accession Number
+  ((0x8, 0x80), "replace", b"anonymous"),  # Institution Name
+  ((0x8, 0x81), "replace", b"anonymous"),  # Institution Address
+  ((0x8, 0x90), "replace", b"anonymous"),  # Referring Physician's Name
+  ((0x8, 0x1030), "replace", b"000000"),  # Study Description
+  ((0x8, 0x1040), "replace", b"anonymous"),  # Department Name
+  ((0x8, 0x1048), "replace", b"anonymous"),  # Physician(s) of Record
+  ((0x8, 0x1060), "replace", b"anonymous"),  # Name of Physician(s) Reading Study
+  ((0x8, 0x1070), "replace", b"anonymous"),  # Referring Operators' Name
+  ((0x9, 0x1040), "replace", b"anonymous"),  # Patient Object Name
+  ((0x9, 0x1042), "replace", b"000000"),  # Patient Creation Date
+  ((0x9, 0x1043), "replace", b"000000"),  # Patient Creation Time
+  ((0x10, 0x21), "replace", b"anonymous"),  # Issuer of Patient ID
+  ((0x10, 0x30), "replace", b"000000"),  # Patient's Birth Date
+  ((0x10, 0x40), "replace", b"U"),  # Patient's Sex
+  ((0x10, 0x1000), "replace", b"000000"),  # Other Patient IDs
+  ((0x10, 0x1001), "replace", b"000000"),  # Other Patient Names
+  ((0x10, 0x1040), "replace", b"anonymous"),  # Patient's Address
+  ((0x10, 0x2160), "replace", b"000000"),  # Ethnic Group
+  ((0x10, 0x2180), "replace", b"000000"),  # Occupation
+  ((0x18, 0x1030), "replace", b"000000"),  # Protocol Name
+  ((0x20, 0x10), "replace", b"000000"),  # Study Id
+  ((0x32, 0x1032), "replace", b"000000"),  # Requesting Physician
+  ((0xe1, 0x1061), "replace", b"anonymous"),  # Protocol File Name
+  ((0xe1, 0x1063), "replace", b"anonymous"),  # Patient Language
+  ((0x300a, 0x0002), "replace", b""),  # RT Plan Label
+  ((0x300a, 0x0003), "replace", b""),  # RT Plan Name
+  ((0x300a, 0x0006), "replace", b""),  # RT Plan Date
+  ((0x300a, 0x0007), "replace", b""),  # RT Plan Time
+]
 
-def anonymizeDicomFile(inputFile, outputFile, patientname, patientid, removedate, tag):
-  ds = pydicom.read_file(inputFile, force=True)
-  ds = pydicom.read_file(inputFile)
-  if (0x8, 0x12) in ds:  # If Accession Number is present
-    ds[(0x8, 0x12)].value = b"000000"
-  if (0x8, 0x13) in ds:  # If Accession Number is present
-    ds[(0x8, 0x13)].value = b"000000"
-  if (0x8, 0x20) in ds:  # If Accession Number is present
-    ds[(0x8, 0x20)].value = b"000000"
-  if (0x8, 0x30) in ds:  # If Accession Number is present
-    ds[(0x8, 0x30)].value = b"000000"
-  if (0x8, 0x50) in ds:  # If Accession Number is present
-    ds[(0x8, 0x50)].value = b"000000"
-  if (0x8, 0x80) in ds:  # If Institution Name is present
-    ds[(0x8, 0x80)].value = b"anonymous"
-  if (0x8, 0x81) in ds:  # If Institution Address is present
-    ds[(0x8, 0x81)].value = b"anonymous"
-  if (0x8, 0x90) in ds:  # If Referring Physician's Name is present
-    ds[(0x8, 0x90)].value = b"anonymous"
-  if (0x8, 0x1030) in ds:  # If Study Description is present
-    ds[(0x8, 0x1030)].value = b"000000"
-  if (0x8, 0x1040) in ds:  # If Department Name is present
-    ds[(0x8, 0x1040)].value = b"anonymous"
-  if (0x8, 0x1048) in ds:  # If Physician(s) of Record is present
-    ds[(0x8, 0x1048)].value = b"anonymous"
-  if (0x8, 0x1060) in ds:  # If Name of Physician(s) Reading Study is present
-    ds[(0x8, 0x1060)].value = b"anonymous"
-  if (0x8, 0x1070) in ds:  # If Referring Operators' Name is present
-    ds[(0x8, 0x1070)].value = b"anonymous"
-  if (0x9, 0x1040) in ds:  # If Patient Object Name is present
-    ds[(0x9, 0x1040)].value = b"anonymous"
-  if (0x9, 0x1042) in ds:  # If Patient Creation Date is present
-    ds[(0x9, 0x1042)].value = b"000000"
-  if (0x9, 0x1043) in ds:  # If Patient Creation Time is present
-    ds[(0x9, 0x1043)].value = b"000000"
-  if (0x10, 0x10) in ds:  # If PatientName is present
-    ds[(0x10, 0x10)].value = str.encode(patientname)
-  if (0x10, 0x20) in ds:  # If Patient ID is present
-    ds[(0x10, 0x20)].value = str.encode(patientid)
-  if (0x10, 0x21) in ds:  # If Issuer of Patient ID is present
-    ds[(0x10, 0x21)].value = b"anonymous"
-  if (0x10, 0x30) in ds:  # If Patient's Birth Date is present
-    ds[(0x10, 0x30)].value = b"000000"
-  if (0x10, 0x40) in ds:  # If Patient's Sex is present
-    ds[(0x10, 0x40)].value = b"U"
-  if (0x10, 0x1000) in ds:  # If Other Patient IDs is present
-    ds[(0x10, 0x1000)].value = b"000000"
-  if (0x10, 0x1001) in ds:  # If Other Patient Names is present
-    ds[(0x10, 0x1001)].value = b"000000"
-  if (0x10, 0x1040) in ds:  # If Patient's Address is present
-    ds[(0x10, 0x1040)].value = b"anonymous"
-  if (0x10, 0x2160) in ds:  # If Ethnic Group is present
-    ds[(0x10, 0x2160)].value = b"000000"
-  if (0x10, 0x2180) in ds:  # If Occupation is present
-    ds[(0x10, 0x2180)].value = b"000000"
-  if (0x18, 0x1030) in ds:  # If Protocol Name is present
-    ds[(0x18, 0x1030)].value = b"000000"
-  if (0x20, 0x10) in ds:  # If Study Id is present
-    ds[(0x20, 0x10)].value = b"000000"
-  if (0x32, 0x1032) in ds: # If Requesting Physician is present
-    ds[(0x32, 0x1032)].value = b"000000"
-  if (0xe1, 0x1061) in ds:  # If Protocol File Name is present
-    ds[(0xe1, 0x1061)].value = b"anonymous"
-  if (0xe1, 0x1063) in ds:  # If Patient Language is present
-    ds[(0xe1, 0x1063)].value = b"anonymous"
-  if (0x300a, 0x0002) in ds:  # If RT Plan Label is present
-    ds[(0x300a, 0x0002)].value = b""
-  if (0x300a, 0x0003) in ds:  # If RT Plan Name is present
-    ds[(0x300a, 0x0003)].value = b""
-  if (0x300a, 0x0006) in ds:  # If RT Plan Date is present
-    ds[(0x300a, 0x0006)].value = b""
-  if (0x300a, 0x0007) in ds:  # If RT Plan Time is present
-    ds[(0x300a, 0x0007)].value = b""
+dateRules = [
+  ((0x8, 0x20), "replace", b"000000"),  # Study Date
+  ((0x8, 0x21), "replace", b"000000"),  # Series Date
+  ((0x8, 0x22), "replace", b"000000"),  # Acquisition Date
+  ((0x8, 0x23), "replace", b"000000"),  # Content Date
+  ((0x8, 0x2a), "replace", b"000000"),  # Acquisition DateTime
+  ((0x8, 0x30), "replace", b"000000"),  # Study Time
+  ((0x8, 0x31), "replace", b"000000"),  # Series Time
+  ((0x8, 0x32), "replace", b"000000"),  # Acquisition Time
+  ((0x8, 0x33), "replace", b"000000"),  # Content Time
+]
 
+ruleActions = ["replace", "blank", "hash", "encrypt", "delete", "keep"]
+binaryVR = ["OB", "OD", "OF", "OL", "OV", "OW", "UN"]
+numericVR = {"US": int, "SS": int, "UL": int, "SL": int, "UV": int, "SV": int, "FL": float, "FD": float}
+maxLengthVR = {"AE": 16, "AS": 4, "CS": 16, "DA": 8, "DS": 16, "DT": 26, "IS": 12, "LO": 64, "PN": 64, "SH": 16, "TM": 16, "UI": 64}
+
+def loadProfile(profile):
+  #Read the rules of a json profile file:
+  #[{"tag": ["0x8", "0x50"], "action": "replace", "value": "000000"}, {"tag": ["0x10", "0x1010"], "action": "delete"}]
+  with open(profile) as f:
+    rules = json.load(f)
+  return [((r["tag"][0], r["tag"][1]), r["action"], r.get("value")) for r in rules]
+
+def compileRules(patientname="anonymous", patientid="000000", removedate=False, tag=[], encrypt=False, profile=None):
+  #Merge all the rule tables in a single dict {tag: (action, value)}, the last rule for a tag wins
+  rules = list(anonymizationRules)
+  rules.append(((0x10, 0x10), "replace", str.encode(patientname)))  # PatientName
+  if encrypt and encryptIdDefine:
+    rules.append(((0x10, 0x20), "encrypt", None))  # Patient ID
+  else:
+    rules.append(((0x10, 0x20), "replace", str.encode(patientid)))  # Patient ID
   if removedate:
-    ds = removeDate(ds)
+    rules += dateRules
+  if profile is not None:
+    rules += loadProfile(profile)
+  rules += [((t[0], t[1]), "replace", t[2]) for t in tag]
+  return compileRuleTable(rules)
+
+def compileRuleTable(rules):
+  compiledRules = {}
+  for (group, element), action, value in rules:
+    if action not in ruleActions:
+      print("Unknown action " + str(action) + " for tag (" + str(group) + ", " + str(element) + ")")
+      sys.exit(1)
+    if action == "encrypt" and not encryptIdDefine:
+      print("Encrypt action for tag (" + str(group) + ", " + str(element) + ") without encryptId function")
+      sys.exit(1)
+    if isinstance(group, str):
+      group = int(group, 16)
+    if isinstance(element, str):
+      element = int(element, 16)
+    compiledRules[pydicom.tag.Tag(group, element)] = (action, value)
+  return {t: rule for t, rule in compiledRules.items() if rule[0] != "keep"}
+
+def ruleValue(elem, action, value):
+  if action == "replace":
+    if elem.VR in numericVR and isinstance(value, str):
+      return numericVR[elem.VR](value)
+    return value
+  if action == "blank":
+    if elem.VR == "SQ":
+      return []
+    if elem.VR in numericVR:
+      return None
+    if elem.VR in binaryVR:
+      return b""
+    return ""
+  if action == "hash":
+    currentValue = elem.value if isinstance(elem.value, bytes) else str(elem.value).encode()
+    digest = hashlib.sha256(currentValue).hexdigest()
+    if elem.VR == "UI":
+      return "2.25." + str(int(digest, 16))[:59]
+    return digest[:maxLengthVR.get(elem.VR, 64)]
+  if action == "encrypt":
+    return str.encode(str(encryptId(int(elem.value))))
+
+def applyRules(ds, rules):
+  #Apply the compiled rules in one pass over the elements of ds, going down into the sequences
+  #Elements without rule are not converted, so they are written back unchanged
+  deletedTags = []
+  for t in list(ds.keys()):
+    rule = rules.get(t)
+    if rule is None:
+      if isSequence(ds.get_item(t)):
+        #ds[t] converts the raw element read from a file into a sequence
+        for item in ds[t].value:
+          applyRules(item, rules)
+    elif rule[0] == "delete":
+      deletedTags.append(t)
+    else:
+      elem = ds[t]
+      elem.value = ruleValue(elem, rule[0], rule[1])
+  for t in deletedTags:
+    del ds[t]
+  return ds
+
+def isSequence(elem):
+  #A raw element read from a file has no VR with implicit VR transfer syntax: the dictionary gives it
+  if elem.VR == "SQ":
+    return True
+  if elem.VR is None or elem.VR == "UN":
+    try:
+      return pydicom.datadict.dictionary_VR(elem.tag) == "SQ"
+    except KeyError:
+      return False
+  return False
+
+def removeDate(ds):
+  return applyRules(ds, compileRuleTable(dateRules))
 
-  for t in tag:
-      if (t[0], t[1]) in ds:
-          ds[(t[0], t[1])].value = t[2]
+def pixelDataOffset(ds, fp):
+  #ds was read from fp with stop_before_pixels, so fp is at the beginning of the pixel data element
+  #Return this offset if the end of the file can be copied as raw bytes after the header, None otherwise
+  if ds.file_meta.get("TransferSyntaxUID") == pydicom.uid.DeflatedExplicitVRLittleEndian:
+    return None
+  offset = fp.tell()
+  tag = fp.read(4)
+  if len(tag) == 0:  # No pixel data
+    return offset
+  group = int.from_bytes(tag[:2], "little" if ds.is_little_endian else "big")
+  if group != 0x7fe0:
+    return None
+  return offset
 
-  ds.save_as(outputFile)
+def anonymizeDicomFile(inputFile, outputFile, patientname="anonymous", patientid="000000", removedate=False, tag=[], encrypt=False, rules=None):
+  #The file is parsed only once, up to the pixel data.
+  #The pixel data are not decoded: they are copied as raw bytes after the anonymized header
+  if rules is None:
+    rules = compileRules(patientname, patientid, removedate, tag, encrypt)
+  with open(inputFile, "rb") as fp:
+    ds = pydicom.dcmread(fp, stop_before_pixels=True)
+    offset = pixelDataOffset(ds, fp)
+    if offset is not None and any(t >= 0x7fe00000 for t in rules):  # A rule changes the end of the file
+      offset = None
+    if offset is None:
+      fp.seek(0)
+      ds = pydicom.dcmread(fp)
+    ds = applyRules(ds, rules)
+    ds.save_as(outputFile)
+    if offset is not None:
+      fp.seek(offset)
+      with open(outputFile, "ab") as fout:
+        shutil.copyfileobj(fp, fout, 1024*1024)
+
+def anonymizeDataset(ds, patientname, patientid, removedate, tag, encrypt=False):
+  return applyRules(ds, compileRules(patientname, patientid, removedate, tag, encrypt))
 
 
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
@@ -126,7 +221,12 @@ CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 @click.option('-id', '--patientid', default="000000", help='New patient id')
 @click.option('-e', '--encrypt', is_flag=True, help='Encrypt patient id')
 @click.option('-t', '--tag', type=(str, str, str), multiple=True, help='Change other tags (-t "0x8" "0x1060" Lu-177 -t "0x8" "0x81" 72.3)')
-def anonymizeDicom_click(inputfolder, force, patientname, patientid, encrypt, removedate, tag):
+@click.option('-j', '--jobs', default=1, help='Number of parallel processes (0 to use all the cores)')
+@click.option('--profile', type=click.Path(exists=True, dir_okay=False), help='Json file with additional anonymization rules')
+@click.option('-u', '--incremental', is_flag=True, help='Keep the output folder and anonymize only the new or modified files')
+@click.option('-x', '--passthrough', multiple=True, help='Other extension of non dicom files to copy without warning (-x .log -x .txt)')
+@click.option('-l', '--link', is_flag=True, help='Hardlink the non dicom files in the output folder instead of copying them')
+def anonymizeDicom_click(inputfolder, force, patientname, patientid, encrypt, removedate, tag, jobs, profile, incremental, passthrough, link):
     """
     \b
     :param inputfolder: Folder containing all dicom files to be anonymized
@@ -173,43 +273,213 @@ def anonymizeDicom_click(inputfolder, force, patientname, patientid, encrypt, re
       (0x8, 0x31) Series Time\n
       (0x8, 0x32) Acquisition Time\n
       (0x8, 0x33) Content Time\n
-    Encrypt option allows you to encrypt the patient id. Be sure to have encryptId function in your python path. If encrypt is set, patientid is not taken into account.
+    Encrypt option allows you to encrypt the patient id. Be sure to have encryptId function in your python path. If encrypt is set, patientid is not taken into account.\n
+    With jobs > 1, the files are anonymized in parallel by a pool of processes. The output is the same as with a single process.\n
+    The tags are also changed inside the sequences.
+    A profile json file can add rules, applied after the previous ones and before the tag option, with the actions replace, blank, hash, encrypt, delete or keep (to disable a rule):\n
+      [{"tag": ["0x10", "0x1010"], "action": "delete"}, {"tag": ["0x20", "0xd"], "action": "hash"}]\n
+    With incremental, the output folder is kept (force is ignored) and a manifest (anonymizationOutput/.anonymizationManifest.jsonl) records the size, modification time and sha256 of the anonymized input files. Only the new or modified files, or all the files if the anonymization options changed, are processed. An interrupted run resumes where it stopped.\n
+    The files without the "DICM" magic after the 128 bytes preamble are not parsed: they are copied (or hardlinked with link) to the output without going through python.
     """
 
-    anonymizeDicom(inputfolder, force, patientname, patientid, tag, encrypt, removedate)
+    anonymizeDicom(inputfolder, force, patientname, patientid, tag, encrypt, removedate, jobs, profile, incremental, passthrough, link)
+
+def anonymizeDicom(inputfolder, force, patientname, patientid, tag=[], encrypt=False, removedate=False, jobs=1, profile=None, incremental=False, passthrough=[], link=False):
 
-def anonymizeDicom(inputfolder, force, patientname, patientid, tag=[], encrypt=False, removedate=False):
+    rules = compileRules(patientname, patientid, removedate, tag, encrypt, profile)
 
-    beginningFolder = os.getcwd()
-    os.chdir(inputfolder)
-    outputPath = os.path.join(os.getcwd(), "anonymizationOutput")
-    if force and os.path.isdir(outputPath):
+    inputfolder = os.path.abspath(inputfolder)
+    outputPath = os.path.join(inputfolder, "anonymizationOutput")
+    if force and not incremental and os.path.isdir(outputPath):
         shutil.rmtree(outputPath)
-    os.makedirs(outputPath)
+    os.makedirs(outputPath, exist_ok=incremental)
     exclude = ["anonymizationOutput"]
 
-    for root, dirs, files in os.walk('.', topdown=True):
-        dirs[:] = [d for d in dirs if d not in exclude]
-        for file in files:
+    #In incremental mode, the manifest records the input files already anonymized.
+    #An entry is appended as soon as a file is done, so an interrupted run resumes where it stopped
+    manifestFile = os.path.join(outputPath, manifestName)
+    manifest = readManifest(manifestFile) if incremental else {}
+    rulesDigest = rulesHash(rules)
+    manifestStream = open(manifestFile, "a") if incremental else None
+    nbUpToDate = 0
+
+    def addManifestEntry(entry):
+        manifest[entry["input"]] = entry
+        manifestStream.write(json.dumps(entry) + "\n")
+        manifestStream.flush()
+
+    def isUpToDate(inputFile, outputFile, stat):
+        entry = manifest.get(os.path.relpath(inputFile, inputfolder))
+        if entry is None or entry["rules"] != rulesDigest or entry["size"] != stat.st_size or not os.path.isfile(outputFile):
+            return False
+        if entry["mtime"] == stat.st_mtime_ns:
+            return True
+        if entry["sha256"] == hashFile(inputFile):  # Touched but not modified
+            entry["mtime"] = stat.st_mtime_ns
+            addManifestEntry(entry)
+            return True
+        return False
+
+    def listFiles():
+        nonlocal nbUpToDate
+        for root, dirs, files in os.walk(inputfolder, topdown=True):
+            dirs[:] = [d for d in dirs if d not in exclude]
+            root = os.path.relpath(root, inputfolder)
             if not os.path.isdir(os.path.join(outputPath, root)):
-                   os.makedirs(os.path.join(outputPath, root))
+                os.makedirs(os.path.join(outputPath, root))
+            for file in files:
+                inputFile = os.path.join(inputfolder, root, file)
+                outputFile = os.path.join(outputPath, root, file)
+                stat = os.stat(inputFile) if incremental else None
+                if incremental and isUpToDate(inputFile, outputFile, stat):
+                    nbUpToDate += 1
+                    continue
+                yield (inputFile, outputFile, stat)
+
+    def fileDone(inputFile, outputFile, stat, result):
+        messages, digest = result
+        printMessages(messages)
+        if incremental:
+            addManifestEntry({"input": os.path.relpath(inputFile, inputfolder), "size": stat.st_size, "mtime": stat.st_mtime_ns,
+                              "sha256": digest, "output": os.path.relpath(outputFile, outputPath), "rules": rulesDigest})
+
+    if jobs == 0:
+        jobs = os.cpu_count()
+    try:
+        if jobs <= 1:
+            for inputFile, outputFile, stat in listFiles():
+                fileDone(inputFile, outputFile, stat, anonymizeTreeFile(inputFile, outputFile, rules, incremental, passthrough, link))
+        else:
+            #Keep a bounded number of files in flight so the walk does not get ahead of the workers
+            maxPending = 4*jobs
+            with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+                pending = {}
+                for inputFile, outputFile, stat in listFiles():
+                    if len(pending) >= maxPending:
+                        done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                        for future in done:
+                            fileDone(*pending.pop(future), future.result())
+                    future = executor.submit(anonymizeTreeFile, inputFile, outputFile, rules, incremental, passthrough, link)
+                    pending[future] = (inputFile, outputFile, stat)
+                for future in concurrent.futures.as_completed(list(pending)):
+                    fileDone(*pending.pop(future), future.result())
+    finally:
+        if incremental:
+            manifestStream.close()
+
+    if incremental:
+        writeManifest(manifestFile, manifest)
+        print(str(nbUpToDate) + " files already anonymized")
+
+def anonymizeTreeFile(inputFile, outputFile, rules, hashInput=False, passthrough=[], link=False):
+    #Anonymize one file of the input tree (or copy it if it is not a dicom)
+    #Return the messages to print, so the parallel mode can print them from the main process,
+    #and the sha256 of the input file if hashInput is set
+    messages = []
+    digest = hashFile(inputFile) if hashInput else None
+    if os.path.lexists(outputFile):  # Never write through a previous hardlink to the input
+        os.remove(outputFile)
+    if not isDicomFile(inputFile):
+        if not isPassthroughFile(inputFile, passthrough):
+            messages.append(inputFile + " is not a correct dicom file")
+        passthroughCopy(inputFile, outputFile, link)
+        return (messages, digest)
+    try:
+        anonymizeDicomFile(inputFile, outputFile, rules=rules)
+    except Exception as e:
+        messages.append(str(e))
+        if not isPassthroughFile(inputFile, passthrough):
+            messages.append(inputFile + " is not a correct dicom file")
+        passthroughCopy(inputFile, outputFile, link)
+    return (messages, digest)
+
+#Files known not to be dicom: they are copied without warning
+passthroughExtensions = [".dat", ".mhd", ".raw", ".INI", ".XVI", ".SCAN", ".REFSCAN", ".REFPATIENTORIENTATION", ".REFORIENTATION",
+                         ".DELINEATION", ".tar.bz2", ".jpg", ".his"]
+passthroughPrefixes = ["Angle."]
+
+def isPassthroughFile(filename, passthrough=[]):
+    file = os.path.basename(filename)
+    return file.endswith(tuple(passthroughExtensions + list(passthrough))) or file.startswith(tuple(passthroughPrefixes))
+
+def isDicomFile(filename):
+    #Check the "DICM" magic after the 128 bytes preamble, without parsing the file
+    with open(filename, "rb") as f:
+        header = f.read(132)
+    return len(header) == 132 and header[128:] == b"DICM"
+
+FICLONE = 0x40049409  # Linux ioctl to reflink a file
+
+def passthroughCopy(inputFile, outputFile, link=False):
+    #Copy a non dicom file without reading it in python:
+    #hardlink (if link is set), reflink (copy on write file systems), or copy in the kernel
+    if link:
+        try:
+            os.link(inputFile, outputFile)
+            return
+        except OSError:
+            pass
+    with open(inputFile, "rb") as fin, open(outputFile, "wb") as fout:
+        if fcntl is not None:
             try:
-                ds = pydicom.read_file(os.path.join(root, file), force=True)
-                realPatientId = patientid
-                if encrypt and encryptIdDefine and (0x10, 0x20) in ds:  # If Patient ID is present
-                  realPatientId = str(encryptId(int(ds[(0x10, 0x20)].value)))
-                anonymizeDicomFile(os.path.join(root, file), os.path.join(outputPath, root, file), patientname, realPatientId, removedate, tag)
-            except Exception as e:
-                print(e)
-                if not file.endswith(".dat") and not file.endswith(".mhd") and not file.endswith(".raw") \
-                   and not file.endswith(".INI") and not file.endswith(".XVI") and not file.endswith(".SCAN") \
-                   and not file.endswith(".REFSCAN") and not file.endswith(".REFPATIENTORIENTATION") and not file.endswith(".REFORIENTATION") \
-                   and not file.endswith(".DELINEATION") and not file.endswith(".tar.bz2") and not file.startswith("Angle.") \
-                   and not file.endswith(".jpg") and not file.endswith(".his"):
-                    print(os.path.join(inputfolder, root, file) + " is not a correct dicom file")
-                shutil.copyfile(os.path.join(root, file), os.path.join(outputPath, root, file))
-
-    os.chdir(beginningFolder)
+                fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+                return
+            except OSError:
+                pass
+        size = os.fstat(fin.fileno()).st_size
+        copied = 0
+        try:
+            while copied < size:
+                if hasattr(os, "copy_file_range"):
+                    n = os.copy_file_range(fin.fileno(), fout.fileno(), size - copied, copied, copied)
+                else:
+                    n = os.sendfile(fout.fileno(), fin.fileno(), copied, size - copied)
+                if n == 0:
+                    break
+                copied += n
+        except (OSError, AttributeError):
+            pass
+        if copied < size:
+            fin.seek(copied)
+            fout.seek(copied)
+            shutil.copyfileobj(fin, fout, 1024*1024)
+
+def hashFile(filename):
+    sha = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1024*1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def rulesHash(rules):
+    #Files anonymized with other rules are not up to date
+    return hashlib.sha256(repr(sorted(rules.items())).encode()).hexdigest()
+
+manifestName = ".anonymizationManifest.jsonl"
+
+def readManifest(manifestFile):
+    #Return the last entry of the manifest (one json object per line) for each input file
+    manifest = {}
+    if os.path.isfile(manifestFile):
+        with open(manifestFile) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:  # Line truncated by an interrupted run
+                    continue
+                manifest[entry["input"]] = entry
+    return manifest
+
+def writeManifest(manifestFile, manifest):
+    #Rewrite the manifest without the outdated entries
+    with open(manifestFile + ".tmp", "w") as f:
+        for entry in manifest.values():
+            f.write(json.dumps(entry) + "\n")
+    os.replace(manifestFile + ".tmp", manifestFile)
+
+def printMessages(messages):
+    for message in messages:
+        print(message)
 
 if __name__ == '__main__':
     anonymizeDicom_click()
@@ -234,3 +504,134 @@ class Test_Anonymize(unittest.TestCase):
             self.assertTrue("b519eba34907eca4ad184a47b5a3e0ff02efdfbfa5ce1074d2ab07f91f8f6840" == new_hash)
         os.chdir(prevdir)
         shutil.rmtree(tmpdirpath)
+
+    def test_anonymize_parallel(self):
+        from pydicom.data import get_testdata_file
+        tmpdirpath = tempfile.mkdtemp()
+        os.makedirs(os.path.join(tmpdirpath, "serie"))
+        for file in ["CT_small.dcm", "MR_small.dcm", "rtplan.dcm"]:
+            shutil.copyfile(get_testdata_file(file), os.path.join(tmpdirpath, "serie", file))
+        with open(os.path.join(tmpdirpath, "serie", "projection.raw"), "wb") as f:
+            f.write(b"\x00\x01\x02\x03")
+        outputPath = os.path.join(tmpdirpath, "serie", "anonymizationOutput")
+        anonymizeDicom(os.path.join(tmpdirpath, "serie"), False, "testAnonymisation", "1234567", removedate=True)
+        serialHashes = {}
+        for file in os.listdir(outputPath):
+            with open(os.path.join(outputPath, file), "rb") as f:
+                serialHashes[file] = hashlib.sha256(f.read()).hexdigest()
+        anonymizeDicom(os.path.join(tmpdirpath, "serie"), True, "testAnonymisation", "1234567", removedate=True, jobs=2)
+        self.assertTrue(sorted(os.listdir(outputPath)) == sorted(serialHashes.keys()))
+        for file in serialHashes:
+            with open(os.path.join(outputPath, file), "rb") as f:
+                self.assertTrue(hashlib.sha256(f.read()).hexdigest() == serialHashes[file])
+        shutil.rmtree(tmpdirpath)
+
+    def test_anonymize_single_parse(self):
+        from pydicom.data import get_testdata_file
+        tmpdirpath = tempfile.mkdtemp()
+        for file in ["CT_small.dcm", "MR_small_bigendian.dcm", "image_dfl.dcm"]:
+            inputFile = get_testdata_file(file)
+            anonymizeDicomFile(inputFile, os.path.join(tmpdirpath, "stream.dcm"), "testAnonymisation", "1234567", True, [])
+            ds = pydicom.dcmread(inputFile)
+            anonymizeDataset(ds, "testAnonymisation", "1234567", True, [])
+            ds.save_as(os.path.join(tmpdirpath, "full.dcm"))
+            with open(os.path.join(tmpdirpath, "stream.dcm"), "rb") as fstream, open(os.path.join(tmpdirpath, "full.dcm"), "rb") as ffull:
+                self.assertTrue(fstream.read() == ffull.read())
+        shutil.rmtree(tmpdirpath)
+
+    def test_anonymize_file_sequences(self):
+        from pydicom.data import get_testdata_file
+        tmpdirpath = tempfile.mkdtemp()
+        inputFile = get_testdata_file("CT_small.dcm")
+        self.assertTrue([item.PatientID for item in pydicom.dcmread(inputFile).OtherPatientIDsSequence] == ["ABCD1234", "1234ABCD"])
+        for transferSyntax in [pydicom.uid.ExplicitVRLittleEndian, pydicom.uid.ImplicitVRLittleEndian]:
+            ds = pydicom.dcmread(inputFile)
+            ds.file_meta.TransferSyntaxUID = transferSyntax
+            ds.is_implicit_VR = transferSyntax == pydicom.uid.ImplicitVRLittleEndian
+            ds.save_as(os.path.join(tmpdirpath, "input.dcm"))
+            anonymizeDicomFile(os.path.join(tmpdirpath, "input.dcm"), os.path.join(tmpdirpath, "output.dcm"), "testAnonymisation", "1234567")
+            ds = pydicom.dcmread(os.path.join(tmpdirpath, "output.dcm"))
+            self.assertTrue(ds.PatientID == "1234567")
+            self.assertTrue([item.PatientID for item in ds.OtherPatientIDsSequence] == ["1234567", "1234567"])
+        shutil.rmtree(tmpdirpath)
+
+    def test_anonymize_rules(self):
+        tmpdirpath = tempfile.mkdtemp()
+        profile = os.path.join(tmpdirpath, "profile.json")
+        with open(profile, "w") as f:
+            json.dump([{"tag": ["0x10", "0x1010"], "action": "delete"},
+                       {"tag": ["0x20", "0xd"], "action": "hash"},
+                       {"tag": ["0x28", "0x10"], "action": "replace", "value": "12"},
+                       {"tag": ["0x8", "0x1030"], "action": "blank"},
+                       {"tag": ["0x8", "0x80"], "action": "keep"}], f)
+        rules = compileRules("testAnonymisation", "1234567", profile=profile)
+        ds = pydicom.Dataset()
+        ds.PatientName = "Doe^John"
+        ds.PatientAge = "042Y"
+        ds.StudyInstanceUID = "1.2.3.4"
+        ds.StudyDescription = "Study"
+        ds.InstitutionName = "Hospital"
+        ds.Rows = 10
+        item = pydicom.Dataset()
+        item.ReferringPhysicianName = "Doe^Jane"
+        item.PatientAge = "042Y"
+        ds.ReferencedStudySequence = pydicom.Sequence([item])
+        applyRules(ds, rules)
+        self.assertTrue(ds.PatientName == "testAnonymisation")
+        self.assertTrue("PatientAge" not in ds)
+        self.assertTrue(ds.StudyInstanceUID.startswith("2.25."))
+        self.assertTrue(ds.StudyDescription == "")
+        self.assertTrue(ds.InstitutionName == "Hospital")
+        self.assertTrue(ds.Rows == 12)
+        self.assertTrue(ds.ReferencedStudySequence[0].ReferringPhysicianName == "anonymous")
+        self.assertTrue("PatientAge" not in ds.ReferencedStudySequence[0])
+        shutil.rmtree(tmpdirpath)
+
+    def test_anonymize_incremental(self):
+        from pydicom.data import get_testdata_file
+        tmpdirpath = tempfile.mkdtemp()
+        for file in ["CT_small.dcm", "MR_small.dcm"]:
+            shutil.copyfile(get_testdata_file(file), os.path.join(tmpdirpath, file))
+        outputPath = os.path.join(tmpdirpath, "anonymizationOutput")
+        anonymizeDicom(tmpdirpath, False, "testAnonymisation", "1234567", incremental=True)
+        self.assertTrue(sorted(readManifest(os.path.join(outputPath, manifestName)).keys()) == ["CT_small.dcm", "MR_small.dcm"])
+        with open(os.path.join(outputPath, "CT_small.dcm"), "rb") as f:
+            ctBytes = f.read()
+        #Unchanged files are skipped, new ones are anonymized
+        os.remove(os.path.join(outputPath, "CT_small.dcm"))
+        os.utime(os.path.join(tmpdirpath, "MR_small.dcm"))
+        with open(os.path.join(outputPath, "MR_small.dcm"), "ab") as f:
+            f.write(b"marker")
+        shutil.copyfile(get_testdata_file("rtplan.dcm"), os.path.join(tmpdirpath, "rtplan.dcm"))
+        anonymizeDicom(tmpdirpath, False, "testAnonymisation", "1234567", incremental=True)
+        with open(os.path.join(outputPath, "CT_small.dcm"), "rb") as f:
+            self.assertTrue(f.read() == ctBytes)
+        with open(os.path.join(outputPath, "MR_small.dcm"), "rb") as f:
+            self.assertTrue(f.read().endswith(b"marker"))
+        self.assertTrue(os.path.isfile(os.path.join(outputPath, "rtplan.dcm")))
+        #Other options: all the files are anonymized again
+        anonymizeDicom(tmpdirpath, False, "testAnonymisation2", "1234567", incremental=True)
+        with open(os.path.join(outputPath, "MR_small.dcm"), "rb") as f:
+            self.assertFalse(f.read().endswith(b"marker"))
+        shutil.rmtree(tmpdirpath)
+
+    def test_anonymize_passthrough(self):
+        from pydicom.data import get_testdata_file
+        tmpdirpath = tempfile.mkdtemp()
+        shutil.copyfile(get_testdata_file("CT_small.dcm"), os.path.join(tmpdirpath, "CT_small.dcm"))
+        projection = os.urandom(3*1024*1024 + 7)
+        with open(os.path.join(tmpdirpath, "projection.raw"), "wb") as f:
+            f.write(projection)
+        self.assertTrue(isDicomFile(os.path.join(tmpdirpath, "CT_small.dcm")))
+        self.assertFalse(isDicomFile(os.path.join(tmpdirpath, "projection.raw")))
+        outputPath = os.path.join(tmpdirpath, "anonymizationOutput")
+        anonymizeDicom(tmpdirpath, False, "testAnonymisation", "1234567")
+        with open(os.path.join(outputPath, "projection.raw"), "rb") as f:
+            self.assertTrue(f.read() == projection)
+        anonymizeDicom(tmpdirpath, True, "testAnonymisation", "1234567", link=True, incremental=True)
+        self.assertTrue(os.path.samefile(os.path.join(outputPath, "projection.raw"), os.path.join(tmpdirpath, "projection.raw")))
+        anonymizeDicom(tmpdirpath, False, "testAnonymisation2", "1234567", incremental=True)
+        self.assertFalse(os.path.samefile(os.path.join(outputPath, "projection.raw"), os.path.join(tmpdirpath, "projection.raw")))
+        with open(os.path.join(tmpdirpath, "projection.raw"), "rb") as f:
+            self.assertTrue(f.read() == projection)
+        shutil.rmtree(tmpdirpath)
@@ -11,7 +11,13 @@ import itk
 import click
 import numpy as np
 import sys
+import os
+import glob
+import json
+import hashlib
+import tempfile
 import image_projection
+import faf_pipeline
 
 def convertNewParameterToFloat(newParameterString, size=1):
     if newParameterString is not None:
@@ -32,12 +38,14 @@ CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 @click.option('--c', '-c', help='Attenuation Coefficient for Water and Bone for CT energy')
 @click.option('--s', '-s', help='Attenuation Coefficient for Air, Water and Bone for SPECT energies')
 @click.option('--weight', '-w', help='Weights for all emitted peak for the SPECT')
+@click.option('--cache', help='Cache folder of the ACF images already computed', type=click.Path(file_okay=False))
+@click.option('--cache_size', help='Maximal size of the cache folder in MB', default=1000.0)
 @click.option('--output', '-o', help='Output filename', required=True,
                 type=click.Path(dir_okay=False,
                               writable=True, readable=False,
                               resolve_path=True, allow_dash=False, path_type=None))
 
-def faf_ACF_image_click(ct, c, s, weight, output):
+def faf_ACF_image_click(ct, c, s, weight, cache, cache_size, output):
     '''
     Compute the Attenuation Correction Factor (ACF) image from the CT taking into account the energies of the CT acquisition (-c option) and of the emitted gamma (-s option) along the axis a.
 
@@ -77,21 +85,57 @@ def faf_ACF_image_click(ct, c, s, weight, output):
     
     Then, the AC are weighted and sum, Finally, the image is projected along axis y and the return result is (division by 10 because mm to cm and division by 2 because mean attenuation): \n
         exp(spacingAlongAxis/(2.0*10.0)*projectedAC)
+
+    The CT is processed by slabs of slices and the 3D attenuation image is never created. An uncompressed .mhd/.raw CT is memory mapped, so it is never fully loaded in memory.
+
+    With --cache, the ACF image is stored in the cache folder, keyed by a hash of the CT voxels, its geometry and the coefficients. A next call with the same CT and coefficients reads it back instead of computing it. The least recently used images are removed when the cache folder is larger than --cache_size (MB).
     
     '''
 
-    ctImage = itk.imread(ct)
     ctCoeff = convertNewParameterToFloat(c)
     spectCoeff = convertNewParameterToFloat(s)
     weightPeak = convertNewParameterToFloat(weight)
-    outputImage = faf_ACF_image(ctImage, ctCoeff, spectCoeff, weightPeak)
+    #The node reads the CT file itself, so it can be memory mapped
+    node = faf_pipeline.Node("acf", lambda ctFile: faf_ACF_image_file(ctFile, ctCoeff, spectCoeff, weightPeak, cache, cache_size*1000000), ["ctFile"], ["acf"])
+    outputImage = faf_pipeline.run_step(node, {"ctFile": ct})
     itk.imwrite(outputImage, output)
 
 # -----------------------------------------------------------------------------
-def faf_ACF_image(image, ctCoeff, spectCoeff, weight=None):
+def attenuation_coefficients(ctCoeff, spectCoeff, weight):
+    #The weighted sum over the peaks of the piecewise-linear conversions is piecewise-linear too:
+    #attenuation = intercept + slopeNegative*HU if HU < 0, intercept + slopePositive*HU if HU > 0
+    intercept = 0.0
+    slopeNegative = 0.0
+    slopePositive = 0.0
+    for i in range(len(weight)):
+        intercept += weight[i]*spectCoeff[3*i+1]
+        slopeNegative += weight[i]*(spectCoeff[3*i+1] - spectCoeff[3*i])/1000.0
+        slopePositive += weight[i]*ctCoeff[0]/(ctCoeff[1]-ctCoeff[0])*(spectCoeff[3*i+2] - spectCoeff[3*i+1])/1000.0
+    return (intercept, slopeNegative, slopePositive)
 
-    if image.GetImageDimension() != 3:
-        print("Image dimension (" + str(image.GetImageDimension()) + ") is not 3")
+# -----------------------------------------------------------------------------
+def hu_to_attenuation(ctArray, ctCoeff, spectCoeff, weight, out=None, slabSize=16):
+    #Convert the HU to the weighted attenuation of all the peaks in one pass, in float32.
+    #The conversion is done by slabs of slices, so the temporaries are one slab large
+    intercept, slopeNegative, slopePositive = attenuation_coefficients(ctCoeff, spectCoeff, weight)
+    if out is None:
+        out = np.empty(ctArray.shape, dtype=np.float32)
+    for z in range(0, ctArray.shape[0], slabSize):
+        ct = ctArray[z:z+slabSize]
+        attenuation = out[z:z+slabSize]
+        np.maximum(ct, 0, out=attenuation)
+        attenuation *= slopePositive
+        attenuation += slopeNegative*np.minimum(ct, 0)
+        attenuation += intercept
+        attenuation[ct == 0] = 0  # HU = 0 is not converted
+        np.maximum(attenuation, 0, out=attenuation)
+    return out
+
+# -----------------------------------------------------------------------------
+def check_parameters(nbDimension, ctCoeff, spectCoeff, weight):
+
+    if nbDimension != 3:
+        print("Image dimension (" + str(nbDimension) + ") is not 3")
         sys.exit(1)
     if ctCoeff is None:
         print("ctCoeff is mandatory")
@@ -108,32 +152,152 @@ def faf_ACF_image(image, ctCoeff, spectCoeff, weight=None):
     elif len(spectCoeff) != 3*nbPeak:
         print("ctCoeff size (" + str(len(spectCoeff)) + ") is not 3*nbPeak (" + str(3*nbPeak) + ")")
         sys.exit(1)
+    return weight
 
-    ctArray = itk.array_from_image(image)
-    ctPositiveValueIndex = np.where(ctArray > 0)
-    ctNegativeValueIndex = np.where(ctArray < 0)
-    attenuation = np.zeros(ctArray.shape)
-    for i in range(nbPeak):
-        attenuationTemp = np.zeros(ctArray.shape)
-        attenuationTemp[ctNegativeValueIndex] = spectCoeff[3*i+1] + (spectCoeff[3*i+1] - spectCoeff[3*i])/1000.0 *ctArray[ctNegativeValueIndex]
-        attenuationTemp[ctPositiveValueIndex] = spectCoeff[3*i+1] + ctCoeff[0]/(ctCoeff[1]-ctCoeff[0])*(spectCoeff[3*i+2] - spectCoeff[3*i+1])/1000.0 *ctArray[ctPositiveValueIndex]
-        attenuation = attenuation + weight[i]*attenuationTemp
-    attenuation[attenuation < 0] = 0
-    attenuationImage = itk.image_from_array(attenuation)
-    attenuationImage.CopyInformation(image)
-    
-    projectionAxis = 1
-    projection = image_projection.image_projection(attenuationImage, projectionAxis)
-    acfArray = np.exp(image.GetSpacing()[projectionAxis]/(2.0*10.0)*itk.array_from_image(projection))
+# -----------------------------------------------------------------------------
+def projected_attenuation(ctArray, ctCoeff, spectCoeff, weight, slabSize=16):
+    #Sum the attenuation along y (numpy axis 1) slab of slices by slab of slices:
+    #the 3D attenuation is never materialized, only one slab of the CT is in memory at a time (ctArray can be a memmap)
+    projectedArray = np.empty((ctArray.shape[0], ctArray.shape[2]), dtype=np.float64)
+    attenuation = np.empty((slabSize,) + ctArray.shape[1:], dtype=np.float32)
+    for z in range(0, ctArray.shape[0], slabSize):
+        ct = np.array(ctArray[z:z+slabSize])
+        slabAttenuation = hu_to_attenuation(ct, ctCoeff, spectCoeff, weight, out=attenuation[:ct.shape[0]], slabSize=slabSize)
+        np.sum(slabAttenuation, axis=1, dtype=np.float64, out=projectedArray[z:z+ct.shape[0]])
+    return projectedArray
+
+# -----------------------------------------------------------------------------
+def acf_image_from_projection(projectedArray, spacing, origin, projectionAxis=1):
+    acfArray = np.exp(spacing[projectionAxis]/(2.0*10.0)*projectedArray)
     acfImage = itk.image_from_array(acfArray)
-    acfImage.CopyInformation(projection)
+    acfImage.SetSpacing(np.delete(np.array(spacing), projectionAxis))
+    acfImage.SetOrigin(np.delete(np.array(origin), projectionAxis))
     flipFilter = itk.FlipImageFilter.New(Input=acfImage)
     flipFilter.SetFlipAxes((False, True))
     flipFilter.Update()
-    acfImage = flipFilter.GetOutput()
+    return flipFilter.GetOutput()
+
+# -----------------------------------------------------------------------------
+def faf_ACF_image(image, ctCoeff, spectCoeff, weight=None, cacheFolder=None, cacheSize=1e9):
 
+    weight = check_parameters(image.GetImageDimension(), ctCoeff, spectCoeff, weight)
+    ctArray = itk.array_view_from_image(image)
+    if cacheFolder is not None:
+        key = acf_cache_key(voxel_hash(ctArray), ctArray, image.GetSpacing(), image.GetOrigin(), ctCoeff, spectCoeff, weight)
+        acfImage = read_acf_cache(cacheFolder, key)
+        if acfImage is not None:
+            return acfImage
+    projectedArray = projected_attenuation(ctArray, ctCoeff, spectCoeff, weight)
+    acfImage = acf_image_from_projection(projectedArray, image.GetSpacing(), image.GetOrigin())
+    if cacheFolder is not None:
+        write_acf_cache(cacheFolder, key, acfImage, cacheSize)
     return acfImage
 
+# -----------------------------------------------------------------------------
+def faf_ACF_image_file(filename, ctCoeff, spectCoeff, weight=None, cacheFolder=None, cacheSize=1e9):
+    #Same as faf_ACF_image, but an uncompressed .mhd/.raw (or .mha) CT is memory mapped and streamed by slabs of slices
+    #instead of being read in memory
+    mappedImage = image_projection.read_mhd_memmap(filename)
+    if mappedImage is None:
+        return faf_ACF_image(itk.imread(filename), ctCoeff, spectCoeff, weight, cacheFolder, cacheSize)
+    ctArray, spacing, origin = mappedImage
+    weight = check_parameters(ctArray.ndim, ctCoeff, spectCoeff, weight)
+    if cacheFolder is not None:
+        key = acf_cache_key(file_voxel_hash(cacheFolder, filename, ctArray), ctArray, spacing, origin, ctCoeff, spectCoeff, weight)
+        acfImage = read_acf_cache(cacheFolder, key)
+        if acfImage is not None:
+            return acfImage
+    projectedArray = projected_attenuation(ctArray, ctCoeff, spectCoeff, weight)
+    acfImage = acf_image_from_projection(projectedArray, spacing, origin)
+    if cacheFolder is not None:
+        write_acf_cache(cacheFolder, key, acfImage, cacheSize)
+    return acfImage
+
+# -----------------------------------------------------------------------------
+def voxel_hash(array):
+    #sha1 of the voxel bytes, read by chunks (array can be a memmap)
+    sha = hashlib.sha1()
+    voxels = np.ascontiguousarray(array).reshape(-1).view(np.uint8)
+    chunkSize = 64*1024*1024
+    for i in range(0, voxels.shape[0], chunkSize):
+        sha.update(voxels[i:i+chunkSize])
+    return sha.hexdigest()
+
+# -----------------------------------------------------------------------------
+def file_voxel_hash(cacheFolder, filename, array):
+    #The voxel hash of a CT file is kept in the cache folder with the size and the modification time of the file
+    #and of its data file (.raw of a .mhd, from the memory map), so an unchanged file is not hashed again
+    os.makedirs(cacheFolder, exist_ok=True)
+    hashFile = os.path.join(cacheFolder, "ctHashes.json")
+    hashes = {}
+    if os.path.isfile(hashFile):
+        with open(hashFile) as f:
+            hashes = json.load(f)
+    filename = os.path.abspath(filename)
+    stats = []
+    for f in sorted(set([filename, os.path.abspath(getattr(array, "filename", None) or filename)])):
+        stat = os.stat(f)
+        stats += [f, stat.st_size, stat.st_mtime_ns]
+    entry = hashes.get(filename)
+    if entry is not None and entry[:-1] == stats:
+        return entry[-1]
+    hashes[filename] = stats + [voxel_hash(array)]
+    fd, tmpFilename = tempfile.mkstemp(dir=cacheFolder, prefix="tmp", suffix=".json")
+    with os.fdopen(fd, "w") as f:
+        json.dump(hashes, f)
+    os.replace(tmpFilename, hashFile)
+    return hashes[filename][-1]
+
+# -----------------------------------------------------------------------------
+def acf_cache_key(ctHash, ctArray, spacing, origin, ctCoeff, spectCoeff, weight):
+    parameters = {"ct": ctHash, "dtype": ctArray.dtype.str, "shape": list(ctArray.shape),
+                  "spacing": [float(x) for x in spacing], "origin": [float(x) for x in origin],
+                  "ctCoeff": [float(x) for x in ctCoeff], "spectCoeff": [float(x) for x in spectCoeff], "weight": [float(x) for x in weight]}
+    return hashlib.sha1(json.dumps(parameters, sort_keys=True).encode()).hexdigest()
+
+# -----------------------------------------------------------------------------
+def read_acf_cache(cacheFolder, key):
+    filename = os.path.join(cacheFolder, key + ".mha")
+    if not os.path.isfile(filename):
+        return None
+    os.utime(filename)  # Most recently used
+    return itk.imread(filename)
+
+# -----------------------------------------------------------------------------
+def write_acf_cache(cacheFolder, key, acfImage, cacheSize=1e9):
+    #Store the ACF image, then remove the least recently used images until the cache is smaller than cacheSize (in bytes)
+    os.makedirs(cacheFolder, exist_ok=True)
+    filename = os.path.join(cacheFolder, key + ".mha")
+    #Temporary file unique to the writer, so concurrent writers of the same key do not collide
+    fd, tmpFilename = tempfile.mkstemp(dir=cacheFolder, prefix="tmp", suffix=".mha")
+    os.close(fd)
+    try:
+        itk.imwrite(acfImage, tmpFilename)
+        os.replace(tmpFilename, filename)
+    finally:
+        if os.path.exists(tmpFilename):
+            os.remove(tmpFilename)
+    entries = []
+    for f in glob.glob(os.path.join(cacheFolder, "*.mha")):
+        if os.path.basename(f).startswith("tmp"):
+            continue
+        try:
+            entries += [(os.path.getmtime(f), os.path.getsize(f), f)]
+        except FileNotFoundError:  # Removed by another writer
+            pass
+    entries.sort()
+    cacheTotalSize = sum([size for mtime, size, f in entries])
+    if os.path.isfile(os.path.join(cacheFolder, "ctHashes.json")):
+        cacheTotalSize += os.path.getsize(os.path.join(cacheFolder, "ctHashes.json"))
+    for mtime, size, f in entries:
+        if cacheTotalSize <= cacheSize or f == filename:
+            break
+        try:
+            os.remove(f)
+        except FileNotFoundError:
+            pass
+        cacheTotalSize -= size
+
 # -----------------------------------------------------------------------------
 if __name__ == '__main__':
     faf_ACF_image_click()
@@ -142,6 +306,7 @@ if __name__ == '__main__':
 import unittest
 import tempfile
 import hashlib
+import concurrent.futures
 import shutil
 import os
 import wget
@@ -157,3 +322,80 @@ class Test_Faf_ACF_Image_(unittest.TestCase):
         outputArray = itk.array_from_image(output)
         self.assertTrue(np.allclose(outputArray[208, 189], 6.02242))
         shutil.rmtree(tmpdirpath)
+
+    def test_faf_ACF_image_peaks(self):
+        ctArray = np.random.randint(-1000, 1500, size=(20, 30, 25)).astype(np.int16)
+        ctArray[0, :, 0] = 0
+        ct = itk.image_from_array(ctArray)
+        ct.SetSpacing([1.5, 2.0, 2.5])
+        ct.SetOrigin([-10, 5, 3])
+        ctCoeff = [0.2068007, 0.57384408]
+        spectCoeff = [0.00017856, 0.16529103, 0.31934538, 0.00014657, 0.13597229, 0.24070651]
+        weight = [0.062, 0.104]
+        output = faf_ACF_image(ct, ctCoeff, spectCoeff, weight)
+        attenuation = np.zeros(ctArray.shape)
+        for i in range(2):
+            attenuationTemp = np.zeros(ctArray.shape)
+            attenuationTemp[ctArray < 0] = spectCoeff[3*i+1] + (spectCoeff[3*i+1] - spectCoeff[3*i])/1000.0*ctArray[ctArray < 0]
+            attenuationTemp[ctArray > 0] = spectCoeff[3*i+1] + ctCoeff[0]/(ctCoeff[1]-ctCoeff[0])*(spectCoeff[3*i+2] - spectCoeff[3*i+1])/1000.0*ctArray[ctArray > 0]
+            attenuation += weight[i]*attenuationTemp
+        attenuation[attenuation < 0] = 0
+        expectedArray = np.flip(np.exp(2.0/(2.0*10.0)*np.sum(attenuation, axis=1)), 0)
+        self.assertTrue(np.allclose(itk.array_view_from_image(output), expectedArray))
+        self.assertTrue(output.GetLargestPossibleRegion().GetSize()[0] == 25)
+        self.assertTrue(output.GetLargestPossibleRegion().GetSize()[1] == 20)
+        self.assertTrue(np.allclose(output.GetSpacing(), [1.5, 2.5]))
+
+    def test_faf_ACF_image_file(self):
+        tmpdirpath = tempfile.mkdtemp()
+        ct = itk.image_from_array(np.random.randint(-1000, 1500, size=(37, 30, 25)).astype(np.int16))
+        ct.SetSpacing([1.5, 2.0, 2.5])
+        ct.SetOrigin([-10, 5, 3])
+        output = faf_ACF_image(ct, [0.2068007, 0.57384408], [0.00014657, 0.13597229, 0.24070651])
+        for filename, compression in [("CT.mhd", False), ("CT.mha", False), ("CTCompressed.mhd", True)]:
+            itk.imwrite(ct, os.path.join(tmpdirpath, filename), compression=compression)
+            self.assertTrue((image_projection.read_mhd_memmap(os.path.join(tmpdirpath, filename)) is None) == compression)
+            outputFile = faf_ACF_image_file(os.path.join(tmpdirpath, filename), [0.2068007, 0.57384408], [0.00014657, 0.13597229, 0.24070651])
+            self.assertTrue(np.allclose(itk.array_view_from_image(output), itk.array_view_from_image(outputFile)))
+            self.assertTrue(np.allclose(output.GetOrigin(), outputFile.GetOrigin()))
+            self.assertTrue(np.allclose(output.GetSpacing(), outputFile.GetSpacing()))
+        shutil.rmtree(tmpdirpath)
+
+    def test_faf_ACF_image_cache(self):
+        tmpdirpath = tempfile.mkdtemp()
+        cacheFolder = os.path.join(tmpdirpath, "cache")
+        ct = itk.image_from_array(np.random.randint(-1000, 1500, size=(37, 30, 25)).astype(np.int16))
+        itk.imwrite(ct, os.path.join(tmpdirpath, "CT.mhd"))
+        output = faf_ACF_image(ct, [0.2068007, 0.57384408], [0.00014657, 0.13597229, 0.24070651], cacheFolder=cacheFolder)
+        self.assertTrue(len(glob.glob(os.path.join(cacheFolder, "*.mha"))) == 1)
+        outputFile = faf_ACF_image_file(os.path.join(tmpdirpath, "CT.mhd"), [0.2068007, 0.57384408], [0.00014657, 0.13597229, 0.24070651], cacheFolder=cacheFolder)
+        self.assertTrue(len(glob.glob(os.path.join(cacheFolder, "*.mha"))) == 1)
+        self.assertTrue(np.array_equal(itk.array_view_from_image(output), itk.array_view_from_image(outputFile)))
+        output = faf_ACF_image(ct, [0.2068007, 0.57384408], [0.00015653, 0.14515948, 0.26067691], cacheFolder=cacheFolder, cacheSize=1)
+        self.assertTrue(len(glob.glob(os.path.join(cacheFolder, "*.mha"))) == 1)
+        shutil.rmtree(tmpdirpath)
+    def test_faf_ACF_image_cache_raw(self):
+        #A rewritten .raw with the same .mhd header is not taken from the cache
+        tmpdirpath = tempfile.mkdtemp()
+        cacheFolder = os.path.join(tmpdirpath, "cache")
+        ctArray = np.random.randint(-1000, 1500, size=(17, 20, 15)).astype(np.int16)
+        itk.imwrite(itk.image_from_array(ctArray), os.path.join(tmpdirpath, "CT.mhd"))
+        output = faf_ACF_image_file(os.path.join(tmpdirpath, "CT.mhd"), [0.2068007, 0.57384408], [0.00014657, 0.13597229, 0.24070651], cacheFolder=cacheFolder)
+        header = os.stat(os.path.join(tmpdirpath, "CT.mhd"))
+        np.flip(ctArray, axis=0).astype(np.int16).tofile(os.path.join(tmpdirpath, "CT.raw"))
+        os.utime(os.path.join(tmpdirpath, "CT.raw"), ns=(header.st_atime_ns, header.st_mtime_ns + 10**9))
+        os.utime(os.path.join(tmpdirpath, "CT.mhd"), ns=(header.st_atime_ns, header.st_mtime_ns))
+        outputRaw = faf_ACF_image_file(os.path.join(tmpdirpath, "CT.mhd"), [0.2068007, 0.57384408], [0.00014657, 0.13597229, 0.24070651], cacheFolder=cacheFolder)
+        expected = faf_ACF_image(itk.image_from_array(np.flip(ctArray, axis=0).copy()), [0.2068007, 0.57384408], [0.00014657, 0.13597229, 0.24070651])
+        self.assertTrue(np.allclose(itk.array_view_from_image(outputRaw), itk.array_view_from_image(expected)))
+        self.assertTrue(not np.allclose(itk.array_view_from_image(outputRaw), itk.array_view_from_image(output)))
+        shutil.rmtree(tmpdirpath)
+    def test_write_acf_cache_concurrent(self):
+        tmpdirpath = tempfile.mkdtemp()
+        images = [itk.image_from_array(np.full((20, 30), index, dtype=np.float32)) for index in range(8)]
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            list(executor.map(lambda image: write_acf_cache(tmpdirpath, "key", image), images*4))
+        self.assertTrue(os.listdir(tmpdirpath) == ["key.mha"])
+        array = itk.array_view_from_image(read_acf_cache(tmpdirpath, "key"))
+        self.assertTrue(np.all(array == array.flat[0]))
+        shutil.rmtree(tmpdirpath)
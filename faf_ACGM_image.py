@@ -10,6 +10,7 @@ import gatetools as gt
 import itk
 import click
 import numpy as np
+import faf_pipeline
 
 
 # -----------------------------------------------------------------------------
@@ -36,7 +37,8 @@ def faf_ACGM_image_click(gm, acf, factor, output):
 
     gmImage = itk.imread(gm)
     acfImage = itk.imread(acf)
-    outputImage = faf_ACGM_image(gmImage, acfImage, factor)
+    node = faf_pipeline.Node("acgm", lambda registeredGm, acf: faf_ACGM_image(registeredGm, acf, factor), ["registeredGm", "acf"], ["acgm"])
+    outputImage = faf_pipeline.run_step(node, {"registeredGm": gmImage, "acf": acfImage})
     itk.imwrite(outputImage, output)
 
 # -----------------------------------------------------------------------------
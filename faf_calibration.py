@@ -10,7 +10,9 @@ import gatetools as gt
 import itk
 import click
 import numpy as np
+import sys
 import image_projection
+import faf_pipeline
 
 
 # -----------------------------------------------------------------------------
@@ -23,7 +25,7 @@ CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 @click.option('--half_life', '-l', help='Half life for the injected radionuclide in the SPECT in h', required=True, default=6.0)
 @click.option('--delta_time', '-t', help='Time between injection and beginning of the SPECT acquisition in h', required=True, default=1.0)
 @click.option('--acquisition_duration', '-d', help='Total duration time of the SPECT acquisition in s', required=True, default=900.0)
-@click.option('--output', '-o', help='Output filename', required=True,
+@click.option('--output', '-o', help='Output filename. If not set, only the calibration factor is computed',
                 type=click.Path(dir_okay=False,
                               writable=True, readable=False,
                               resolve_path=True, allow_dash=False, path_type=None))
@@ -36,18 +38,49 @@ def faf_calibration_click(spect, acgm, injected_activity, half_life, delta_time,
     - <spect_image> is the input 3D attenuation corrected, scatter corrected, reconstruction recovery SPECT, in counts\n
     - <ACGM_image>  is the registered attenuation corrected geometrical mean Image (usually the output of sydFAF_ACGM_Image)\n
 
-    The output is a calibrated 3D SPECT in MBq. Calibration factor with FAF method is printed. For more value about FAF, use verbose flag.
+    The output is a calibrated 3D SPECT in MBq. Calibration factor with FAF method is printed. For more value about FAF, use verbose flag. Without output, only the calibration factor is computed.
     
     '''
 
     spectImage = itk.imread(spect)
     acgmImage = itk.imread(acgm)
-    outputImage, fafFactor = faf_calibration(spectImage, acgmImage, injected_activity, half_life, delta_time, acquisition_duration)
+    if output is None:
+        node = faf_pipeline.Node("calibrationFactor", lambda spect, acgm: faf_calibration_factor(spect, acgm, injected_activity, half_life, delta_time, acquisition_duration, verbose), ["spect", "acgm"], ["fafFactor"])
+        fafFactor = faf_pipeline.run_step(node, {"spect": spectImage, "acgm": acgmImage})
+        print("Calibration factor with FAF (Bq/count): " + str(fafFactor))
+        return
+    node = faf_pipeline.Node("calibration", lambda spect, acgm: faf_calibration(spect, acgm, injected_activity, half_life, delta_time, acquisition_duration, verbose, inplace=True), ["spect", "acgm"], ["calibratedSpect", "fafFactor"])
+    outputImage, fafFactor = faf_pipeline.run_step(node, {"spect": spectImage, "acgm": acgmImage})
     print("Calibration factor with FAF (Bq/count): " + str(fafFactor))
     itk.imwrite(outputImage, output)
 
 # -----------------------------------------------------------------------------
-def faf_calibration(spect, acgm, injected_activity=1.0, half_life=6.0067, delta_time=1.0, acquisition_duration=900, verbose=False):
+def faf_calibration(spect, acgm, injected_activity=1.0, half_life=6.0067, delta_time=1.0, acquisition_duration=900, verbose=False, inplace=False):
+    #Return the calibrated SPECT image and the calibration factor (Bq/count).
+    #With inplace, the voxels of a float SPECT image are multiplied in place instead of creating a new image
+
+    spect = check_images(spect, acgm)
+    calibrationFactor = calibration_factor(spect, acgm, injected_activity, half_life, delta_time, acquisition_duration, verbose)
+
+    spectArray = itk.array_view_from_image(spect)
+    if inplace and np.issubdtype(spectArray.dtype, np.floating):
+        spectArray *= calibrationFactor
+        return (spect, calibrationFactor*1000000)
+    calibratedSpectArray = spectArray*calibrationFactor
+    calibratedSpectImage = itk.image_from_array(calibratedSpectArray)
+    calibratedSpectImage.CopyInformation(spect)
+
+    return (calibratedSpectImage, calibrationFactor*1000000)
+
+# -----------------------------------------------------------------------------
+def faf_calibration_factor(spect, acgm, injected_activity=1.0, half_life=6.0067, delta_time=1.0, acquisition_duration=900, verbose=False):
+    #Return only the calibration factor (Bq/count), without creating a calibrated SPECT image
+
+    spect = check_images(spect, acgm)
+    return calibration_factor(spect, acgm, injected_activity, half_life, delta_time, acquisition_duration, verbose)*1000000
+
+# -----------------------------------------------------------------------------
+def check_images(spect, acgm):
 
     if spect.GetImageDimension() != 3:
         print("spect image dimension (" + str(spect.GetImageDimension()) + ") is not 3")
@@ -59,16 +92,22 @@ def faf_calibration(spect, acgm, injected_activity=1.0, half_life=6.0067, delta_
 
     if not (itk.array_from_matrix(spect.GetDirection()) == np.eye(spect.GetImageDimension())).all():
         spect = gt.applyTransformation(input=spect, force_resample=True, pad=0)
+    return spect
+
+# -----------------------------------------------------------------------------
+def calibration_factor(spect, acgm, injected_activity=1.0, half_life=6.0067, delta_time=1.0, acquisition_duration=900, verbose=False):
+    #Calibration factor in MBq/count. The SPECT voxels are only read once, by the projection along y (without
+    #copy), and the sum of the SPECT is the sum of its projection
 
     projectedSPECT = image_projection.image_projection(spect, 1)
+    sumSPECT = np.sum(itk.array_view_from_image(projectedSPECT))
     flipFilter = itk.FlipImageFilter.New(Input=projectedSPECT)
     flipFilter.SetFlipAxes((False, True))
     flipFilter.Update()
     projectedSPECT = flipFilter.GetOutput()
     projectedSPECT = gt.applyTransformation(input=projectedSPECT, like=acgm, force_resample=True)
-    projectedSPECTArray = itk.array_from_image(projectedSPECT)
-    acgmArray = itk.array_from_image(acgm)
-    spectArray = itk.array_from_image(spect)
+    projectedSPECTArray = itk.array_view_from_image(projectedSPECT)
+    acgmArray = itk.array_view_from_image(acgm)
 
     lambdaDecay = np.log(2.0)/(half_life*3600)
     A0 = injected_activity*np.exp(-lambdaDecay*delta_time*3600)
@@ -76,7 +115,6 @@ def faf_calibration(spect, acgm, injected_activity=1.0, half_life=6.0067, delta_
     #integralActivity = A0*integral
     #volume = np.prod(np.array(spect.GetSpacing()))
 
-    sumSPECT = np.sum(spectArray)
     sumACGM = np.sum(acgmArray)
     partialSumACGM = np.sum(acgmArray[projectedSPECTArray > 1])
 
@@ -93,12 +131,7 @@ def faf_calibration(spect, acgm, injected_activity=1.0, half_life=6.0067, delta_
         #print("volume of SPECT (mm3): " + str(volume))
         #print("integral Activity (MBq.s): " + str(integralActivity))
 
-    calibrationFactor = 1.0/sensitivityFAF
-    calibratedSpectArray = spectArray*calibrationFactor
-    calibratedSpectImage = itk.image_from_array(calibratedSpectArray)
-    calibratedSpectImage.CopyInformation(spect)
-
-    return (calibratedSpectImage, calibrationFactor*1000000)
+    return 1.0/sensitivityFAF
 
 # -----------------------------------------------------------------------------
 if __name__ == '__main__':
@@ -124,3 +157,19 @@ class Test_Faf_Calibration_(unittest.TestCase):
         theoreticalcalibrationFactor = 1/(6*16*16*0.33/(0.5*0.25))*1000000
         self.assertTrue(np.allclose(calibrationFactor, theoreticalcalibrationFactor))
         self.assertTrue(np.allclose(calibratedSpectArray[4,12], 0.33*theoreticalcalibrationFactor/1000000))
+
+    def test_faf_calibration_inplace(self):
+        gm = np.ones((32,12))*11.2
+        spect = np.ones((16,16,6), dtype=np.float32)*0.33
+        gmImage = itk.image_from_array(gm)
+        gmImage.SetOrigin(np.array([-6.0, -16.0]))
+        spectImage = itk.image_from_array(spect)
+        spectImage.SetOrigin(np.array([-3.0, -8.0, -8.0]))
+        theoreticalcalibrationFactor = 1/(6*16*16*0.33/(0.5*0.25))*1000000
+        calibrationFactor = faf_calibration_factor(spectImage, gmImage, 1.0, half_life=4, delta_time=4)
+        self.assertTrue(np.allclose(calibrationFactor, theoreticalcalibrationFactor))
+        self.assertTrue(np.allclose(itk.array_view_from_image(spectImage), 0.33))
+        calibratedSpectImage, calibrationFactor = faf_calibration(spectImage, gmImage, 1.0, half_life=4, delta_time=4, inplace=True)
+        self.assertTrue(np.allclose(calibrationFactor, theoreticalcalibrationFactor))
+        self.assertTrue(calibratedSpectImage is spectImage)
+        self.assertTrue(np.allclose(itk.array_view_from_image(spectImage), 0.33*theoreticalcalibrationFactor/1000000))
@@ -11,6 +11,7 @@ import itk
 import click
 import numpy as np
 import sys
+import faf_pipeline
 
 
 # -----------------------------------------------------------------------------
@@ -35,7 +36,8 @@ def faf_create_planar_geometrical_mean_click(input, output):
     '''
 
     inputImage = itk.imread(input)
-    outputImage = faf_create_planar_geometrical_mean(inputImage)
+    node = faf_pipeline.Node("gm", faf_create_planar_geometrical_mean, ["planar"], ["gm"])
+    outputImage = faf_pipeline.run_step(node, {"planar": inputImage})
     itk.imwrite(outputImage, output)
 
 # -----------------------------------------------------------------------------
@@ -10,11 +10,8 @@ import gatetools as gt
 import itk
 import click
 import numpy as np
-import faf_create_planar_geometrical_mean
-import faf_register_planar_image
-import faf_ACF_image
-import faf_ACGM_image
-import faf_calibration
+import sys
+import faf_pipeline
 
 # -----------------------------------------------------------------------------
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
@@ -25,12 +22,15 @@ CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 @click.option('--planar', '-p', help='Input planar WB image filename', required=True, type=click.Path(dir_okay=False))
 @click.option('--injected_activity', '-a', help='Injected activity for the SPECT in MBq', required=True, default=1.0)
 @click.option('--delta_time', '-t', help='Time between injection and beginning of the SPECT acquisition in h', required=True, default=1.0)
+@click.option('--jobs', '-j', help='Number of steps run at the same time', default=2)
+@click.option('--cache', help='Cache folder of the intermediate images (gm, registeredGm, acf, acgm)', type=click.Path(file_okay=False))
+@click.option('--verbose', '-v', help='Print the wall time and the peak memory of each step', is_flag=True)
 @click.option('--output', '-o', help='Output filename', required=True,
                 type=click.Path(dir_okay=False,
                               writable=True, readable=False,
                               resolve_path=True, allow_dash=False, path_type=None))
 
-def faf_lutetium_calibration_click(spect, ct, planar, injected_activity, delta_time, output):
+def faf_lutetium_calibration_click(spect, ct, planar, injected_activity, delta_time, jobs, cache, verbose, output):
     '''
     Full FAF calibration for Lutetium images \n
 
@@ -39,17 +39,29 @@ def faf_lutetium_calibration_click(spect, ct, planar, injected_activity, delta_t
     - <planar_image>  is the Whole Body Planar Image. For Lutetium, there is 8 slices for 113keV and 208keV windows in that order: 113_ANT_primary, 113_POST_primary, 208_ANT_primary, 208_POST_primary, 113_ANT_scatter, 113_POST_scatter, 208_ANT_scatter, 208_POST_scatter\n
 
     The output is a calibrated 3D SPECT in MBq. Calibration factor with FAF method is printed.
+
+    The steps are run with faf_pipeline: the ACF image is computed at the same time as the registration of the GM. With --cache, the intermediate images are kept in the cache folder, so a new run with another injected activity or delta time only computes the calibration step.
     
     '''
 
     spectImage = itk.imread(spect)
     ctImage = itk.imread(ct)
     planarImage = itk.imread(planar)
-    outputImage = faf_lutetium_calibration(spectImage, ctImage, planarImage, injected_activity, delta_time)
+    outputImage = faf_lutetium_calibration(spectImage, ctImage, planarImage, injected_activity, delta_time, jobs, verbose, cache)
     itk.imwrite(outputImage, output)
 
 # -----------------------------------------------------------------------------
-def faf_lutetium_calibration(spect, ct, planar, injected_activity, delta_time):
+def faf_lutetium_calibration(spect, ct, planar, injected_activity, delta_time, jobs=2, verbose=False, cacheFolder=None):
+
+    calibratedSpectImage, fafFactor, report = lutetium_calibration(spect, ct, planar, injected_activity, delta_time, jobs, cacheFolder, True)
+    print("Calibration factor with FAF (Bq/count): " + str(fafFactor))
+    if verbose:
+        faf_pipeline.print_report(report)
+    return calibratedSpectImage
+
+# -----------------------------------------------------------------------------
+def lutetium_calibration(spect, ct, planar, injected_activity, delta_time, jobs=2, cacheFolder=None, verbose=False):
+    #Return the calibrated SPECT image, the FAF calibration factor and the report of the pipeline
 
     if spect.GetImageDimension() != 3:
         print("spect image dimension (" + str(spect.GetImageDimension()) + ") is not 3")
@@ -66,21 +78,10 @@ def faf_lutetium_calibration(spect, ct, planar, injected_activity, delta_time):
         print("planar image dimension (" + str(planar.GetLargestPossibleRegion().GetSize()[2]) + ") is not 8")
         sys.exit(1)
 
-    planarArray = itk.array_from_image(planar)
-    tempArray1 = planarArray[2:4,:,:]
-    tempArray2 = planarArray[6:8,:,:]
-    planar208Array = np.concatenate([tempArray1, tempArray2], axis=0)
-    planar208Image = itk.image_from_array(planar208Array)
-    planar208Image.SetSpacing(planar.GetSpacing())
-    planar208Image.SetOrigin(planar.GetOrigin())
-    
-    gmImage = faf_create_planar_geometrical_mean.faf_create_planar_geometrical_mean(planar208Image)
-    registeredGmImage = faf_register_planar_image.faf_register_planar_image(gmImage, spect)
-    acfImage = faf_ACF_image.faf_ACF_image(ct, [0.2068007, 0.57384408],  [0.00014657, 0.13597229, 0.24070651])
-    acgmImage = faf_ACGM_image.faf_ACGM_image(registeredGmImage, acfImage)
-    calibratedSpectImage, fafFactor = faf_calibration.faf_calibration(spect, acgmImage, injected_activity, 6.647*24,delta_time, 900, True)
-    print("Calibration factor with FAF (Bq/count): " + str(fafFactor))
-    return calibratedSpectImage
+    #Keep the 208keV windows: 208_ANT_primary, 208_POST_primary, 208_ANT_scatter, 208_POST_scatter
+    nodes = faf_pipeline.faf_nodes([0.2068007, 0.57384408], [0.00014657, 0.13597229, 0.24070651], injected_activity, 6.647*24, delta_time, 900, [2, 3, 6, 7], verbose)
+    values, report = faf_pipeline.run_pipeline(nodes, {"planar": planar, "spect": spect, "ct": ct}, ["calibratedSpect", "fafFactor"], jobs, cacheFolder)
+    return values["calibratedSpect"], values["fafFactor"], report
 
 # -----------------------------------------------------------------------------
 if __name__ == '__main__':
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+#   Copyright (C): OpenGATE Collaboration
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE.md for further details
+# -----------------------------------------------------------------------------
+
+import itk
+import click
+import numpy as np
+import sys
+import os
+import csv
+import json
+import time
+import traceback
+import concurrent.futures
+import faf_lutetium_calibration
+
+# -----------------------------------------------------------------------------
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+@click.command(context_settings=CONTEXT_SETTINGS)
+
+@click.option('--manifest', '-m', help='Manifest of the cases (.csv or .json)', required=True, type=click.Path(dir_okay=False, exists=True))
+@click.option('--output', '-o', help='Output folder of the calibrated SPECT images', required=True, type=click.Path(file_okay=False))
+@click.option('--summary', '-s', help='Summary table filename (.csv), default: summary.csv in the output folder', default=None, type=click.Path(dir_okay=False))
+@click.option('--jobs', '-j', help='Number of cases calibrated at the same time', default=1)
+@click.option('--cache', help='Cache folder of the intermediate images, shared by the cases', type=click.Path(file_okay=False))
+
+def faf_lutetium_calibration_batch_click(manifest, output, summary, jobs, cache):
+    '''
+    FAF calibration for Lutetium of all the cases of a manifest, in a single process.
+
+    The manifest is a csv file with a header, or a json list of objects, with the keys: spect, ct, planar, injected_activity (MBq), delta_time (h) and optionally id and output. The filenames are relative to the folder of the manifest. See faf_lutetium_calibration.py for the description of the images.
+
+    The calibrated SPECT of each case is written in the output folder (<id>.mha by default). A failing case does not stop the others; it is reported in the summary table with the FAF factor and the time of each case.
+    '''
+
+    cases = read_manifest(manifest)
+    if summary is None:
+        summary = os.path.join(output, "summary.csv")
+    results = faf_lutetium_calibration_batch(cases, output, jobs, cache)
+    write_summary(results, summary)
+    failed = [result for result in results if result["status"] != "ok"]
+    print(str(len(results) - len(failed)) + " case(s) calibrated, " + str(len(failed)) + " failed, summary in " + summary)
+
+# -----------------------------------------------------------------------------
+def read_manifest(filename):
+    #List of the cases (dict) of a csv or json manifest, with the filenames relative to the manifest folder
+    if filename.endswith(".json"):
+        with open(filename) as f:
+            cases = json.load(f)
+    else:
+        with open(filename, newline='') as f:
+            cases = [dict(row) for row in csv.DictReader(f)]
+    folder = os.path.dirname(os.path.abspath(filename))
+    for index, case in enumerate(cases):
+        for key in ["spect", "ct", "planar", "injected_activity", "delta_time"]:
+            if not key in case or case[key] in [None, ""]:
+                print("The case " + str(index) + " of the manifest has no " + key)
+                sys.exit(1)
+        for key in ["spect", "ct", "planar", "output"]:
+            if key in case and case[key] not in [None, ""]:
+                case[key] = os.path.join(folder, case[key])
+        if not "id" in case or case["id"] in [None, ""]:
+            case["id"] = str(index)
+    return cases
+
+# -----------------------------------------------------------------------------
+def faf_lutetium_calibration_batch(cases, outputFolder, jobs=1, cacheFolder=None):
+    #Calibrate the cases with jobs threads and return the results (dict) in the order of the cases
+    os.makedirs(outputFolder, exist_ok=True)
+    with concurrent.futures.ThreadPoolExecutor(max(1, jobs)) as executor:
+        results = list(executor.map(lambda case: calibrate_case(case, outputFolder, cacheFolder), cases))
+    return results
+
+# -----------------------------------------------------------------------------
+def calibrate_case(case, outputFolder, cacheFolder=None):
+    #Errors (exceptions and exits) are caught and kept in the result of the case
+    output = case.get("output")
+    if output in [None, ""]:
+        output = os.path.join(outputFolder, str(case["id"]) + ".mha")
+    result = {"id": case["id"], "spect": case["spect"], "output": output, "status": "ok", "fafFactor": "", "time": 0.0, "error": ""}
+    start = time.time()
+    try:
+        spect = itk.imread(case["spect"])
+        ct = itk.imread(case["ct"])
+        planar = itk.imread(case["planar"])
+        calibratedSpectImage, fafFactor, report = faf_lutetium_calibration.lutetium_calibration(spect, ct, planar, float(case["injected_activity"]), float(case["delta_time"]), 1, cacheFolder)
+        itk.imwrite(calibratedSpectImage, output)
+        result["fafFactor"] = fafFactor
+    except (Exception, SystemExit) as e:
+        result["status"] = "failed"
+        result["error"] = traceback.format_exception_only(type(e), e)[-1].strip()
+    result["time"] = time.time() - start
+    return result
+
+# -----------------------------------------------------------------------------
+def write_summary(results, filename):
+    if os.path.dirname(filename) != "":
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, "w", newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=["id", "spect", "output", "status", "fafFactor", "time", "error"])
+        writer.writeheader()
+        for result in results:
+            writer.writerow(result)
+
+# -----------------------------------------------------------------------------
+if __name__ == '__main__':
+    faf_lutetium_calibration_batch_click()
+
+# -----------------------------------------------------------------------------
+import unittest
+import tempfile
+import shutil
+
+class Test_Faf_Lutetium_Calibration_Batch(unittest.TestCase):
+    def test_faf_lutetium_calibration_batch(self):
+        tmpdirpath = tempfile.mkdtemp()
+        np.random.seed(0)
+        z, y, x = np.mgrid[0:40, 0:20, 0:25]
+        spectArray = (100*np.exp(-((z - 20)**2 + (x - 12)**2 + (y - 10)**2)/30.) + 1).astype(np.float32)
+        spect = itk.image_from_array(spectArray)
+        spect.SetSpacing([4, 4, 4])
+        ct = itk.image_from_array(np.random.randint(-1000, 500, size=(40, 20, 25)).astype(np.float32))
+        ct.SetSpacing([4, 4, 4])
+        planarArray = np.random.poisson(np.tile(np.flip(spectArray.sum(axis=1), axis=0), (8, 2, 1))).astype(np.float32)
+        planar = itk.image_from_array(planarArray)
+        planar.SetSpacing([4, 4, 1])
+        itk.imwrite(spect, os.path.join(tmpdirpath, "spect.mha"))
+        itk.imwrite(ct, os.path.join(tmpdirpath, "ct.mha"))
+        itk.imwrite(planar, os.path.join(tmpdirpath, "planar.mha"))
+        with open(os.path.join(tmpdirpath, "manifest.csv"), "w") as f:
+            f.write("id,spect,ct,planar,injected_activity,delta_time\n")
+            f.write("p1_t1,spect.mha,ct.mha,planar.mha,100,2\n")
+            f.write("p1_t2,spect.mha,ct.mha,missing.mha,100,24\n")
+            f.write("p2_t1,spect.mha,ct.mha,planar.mha,50,2\n")
+        cases = read_manifest(os.path.join(tmpdirpath, "manifest.csv"))
+        results = faf_lutetium_calibration_batch(cases, os.path.join(tmpdirpath, "output"), 2)
+        self.assertTrue([result["status"] for result in results] == ["ok", "failed", "ok"])
+        calibratedSpectImage, fafFactor, report = faf_lutetium_calibration.lutetium_calibration(spect, ct, planar, 100, 2)
+        self.assertTrue(np.isclose(results[0]["fafFactor"], fafFactor))
+        self.assertTrue(np.isclose(results[2]["fafFactor"], fafFactor/2))
+        output = itk.imread(os.path.join(tmpdirpath, "output", "p1_t1.mha"))
+        self.assertTrue(np.allclose(itk.array_view_from_image(output), itk.array_view_from_image(calibratedSpectImage)))
+        write_summary(results, os.path.join(tmpdirpath, "summary.csv"))
+        with open(os.path.join(tmpdirpath, "summary.csv")) as f:
+            self.assertTrue(len(list(csv.DictReader(f))) == 3)
+        shutil.rmtree(tmpdirpath)
@@ -0,0 +1,442 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+#   Copyright (C): OpenGATE Collaboration
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE.md for further details
+# -----------------------------------------------------------------------------
+
+import gatetools as gt
+import itk
+import click
+import numpy as np
+import sys
+import os
+import time
+import json
+import hashlib
+import threading
+import tempfile
+import concurrent.futures
+import faf_create_planar_geometrical_mean
+import faf_register_planar_image
+import faf_ACF_image
+import faf_ACGM_image
+import faf_calibration
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# -----------------------------------------------------------------------------
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+@click.command(context_settings=CONTEXT_SETTINGS)
+
+@click.option('--input', '-i', 'inputs', help='Input of the pipeline: name=filename (planar, spect, ct or any intermediate gm, registeredGm, acf, acgm)', multiple=True, required=True)
+@click.option('--output', '-o', 'outputs', help='Output of the pipeline: name=filename (gm, registeredGm, acf, acgm, calibratedSpect)', multiple=True, required=True)
+@click.option('--planar_slices', help='Slices of the planar image used for the geometrical mean, separated by comma (eg: 2,3,6,7 for 208keV of Lutetium)', default=None)
+@click.option('--c', '-c', help='Attenuation Coefficient for Water and Bone for CT energy', default='0.2068007,0.57384408')
+@click.option('--s', '-s', help='Attenuation Coefficient for Air, Water and Bone for SPECT energies', default='0.00014657,0.13597229,0.24070651')
+@click.option('--injected_activity', '-a', help='Injected activity for the SPECT in MBq', default=1.0)
+@click.option('--half_life', '-l', help='Half life for the injected radionuclide in the SPECT in h', default=6.647*24)
+@click.option('--delta_time', '-t', help='Time between injection and beginning of the SPECT acquisition in h', default=1.0)
+@click.option('--acquisition_duration', '-d', help='Total duration time of the SPECT acquisition in s', default=900.0)
+@click.option('--jobs', '-j', help='Number of steps run at the same time', default=2)
+@click.option('--cache', help='Cache folder of the intermediate images (gm, registeredGm, acf, acgm)', type=click.Path(file_okay=False))
+@click.option('--verbose', '-v', help='Verbose', is_flag=True)
+
+def faf_pipeline_click(inputs, outputs, planar_slices, c, s, injected_activity, half_life, delta_time, acquisition_duration, jobs, cache, verbose):
+    '''
+    Run the FAF steps as a pipeline. The images are passed in memory between the steps and the independent steps (eg: the ACF computed from the CT, and the GM registered on the SPECT) are run at the same time.
+
+    Only the steps needed to compute the outputs from the inputs are run, so a single step can be run, eg: -i ct=ct.mha -o acf=acf.mha is the same as faf_ACF_image.py. The steps are:\n
+    - gm: geometrical mean of the planar image (faf_create_planar_geometrical_mean.py)\n
+    - registration: registeredGm, the gm registered on the spect (faf_register_planar_image.py)\n
+    - acf: ACF image of the ct (faf_ACF_image.py)\n
+    - acgm: ACGM image of registeredGm and acf (faf_ACGM_image.py)\n
+    - calibration: calibratedSpect of the spect and acgm (faf_calibration.py)\n
+
+    With --cache, the intermediate images are stored in the cache folder, named by a hash of the inputs and parameters they depend on. A next run only computes the steps depending on a changed input or parameter (eg: only the calibration when the injected activity changes).
+
+    With --verbose, the wall time and the peak memory of each step are printed.
+    '''
+
+    values = {}
+    for input in inputs:
+        name, filename = split_name(input)
+        values[name] = itk.imread(filename)
+    filenames = dict([split_name(output) for output in outputs])
+    planarSlices = None
+    if planar_slices is not None:
+        planarSlices = [int(i) for i in planar_slices.split(',')]
+    ctCoeff = [float(x) for x in c.split(',')]
+    spectCoeff = [float(x) for x in s.split(',')]
+    nodes = faf_nodes(ctCoeff, spectCoeff, injected_activity, half_life, delta_time, acquisition_duration, planarSlices)
+    values, report = run_pipeline(nodes, values, list(filenames.keys()), jobs, cache)
+    for name in filenames:
+        itk.imwrite(values[name], filenames[name])
+    if "fafFactor" in values:
+        print("Calibration factor with FAF (Bq/count): " + str(values["fafFactor"]))
+    if verbose:
+        print_report(report)
+
+# -----------------------------------------------------------------------------
+def split_name(option):
+    if not "=" in option:
+        print("Option " + option + " is not name=filename")
+        sys.exit(1)
+    return tuple(option.split("=", 1))
+
+# -----------------------------------------------------------------------------
+class Node:
+    #A step of the pipeline: function is called with the values of inputs and returns the values of outputs
+    #(a tuple if there are several outputs).
+    #parameters (json serializable) are the other parameters of function, used in the keys of the cached outputs.
+    #With cache, the outputs (images) are stored in the cache folder of run_pipeline
+    def __init__(self, name, function, inputs, outputs, parameters=None, cache=False):
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.parameters = parameters
+        self.cache = cache
+
+# -----------------------------------------------------------------------------
+def faf_nodes(ctCoeff=[0.2068007, 0.57384408], spectCoeff=[0.00014657, 0.13597229, 0.24070651], injected_activity=1.0, half_life=6.647*24, delta_time=1.0, acquisition_duration=900, planarSlices=None, verbose=False):
+    #Nodes of the FAF calibration. With planarSlices, the geometrical mean is computed with these slices of the planar image only
+    planarName = "planar"
+    nodes = []
+    if planarSlices is not None:
+        nodes += [Node("planarSlices", lambda planar: select_planar_slices(planar, planarSlices), ["planar"], ["planarSlices"], {"slices": planarSlices})]
+        planarName = "planarSlices"
+    nodes += [Node("gm", faf_create_planar_geometrical_mean.faf_create_planar_geometrical_mean, [planarName], ["gm"], cache=True),
+              Node("registration", faf_register_planar_image.faf_register_planar_image, ["gm", "spect"], ["registeredGm"], cache=True),
+              Node("acf", lambda ct: faf_ACF_image.faf_ACF_image(ct, ctCoeff, spectCoeff), ["ct"], ["acf"], {"ctCoeff": list(ctCoeff), "spectCoeff": list(spectCoeff)}, cache=True),
+              Node("acgm", faf_ACGM_image.faf_ACGM_image, ["registeredGm", "acf"], ["acgm"], cache=True),
+              Node("calibration", lambda spect, acgm: faf_calibration.faf_calibration(spect, acgm, injected_activity, half_life, delta_time, acquisition_duration, verbose), ["spect", "acgm"], ["calibratedSpect", "fafFactor"],
+                   {"injected_activity": injected_activity, "half_life": half_life, "delta_time": delta_time, "acquisition_duration": acquisition_duration})]
+    return nodes
+
+# -----------------------------------------------------------------------------
+def select_planar_slices(planar, slices):
+    planarArray = itk.array_view_from_image(planar)
+    slicesImage = itk.image_from_array(np.ascontiguousarray(planarArray[slices, :, :]))
+    slicesImage.SetSpacing(planar.GetSpacing())
+    slicesImage.SetOrigin(planar.GetOrigin())
+    return slicesImage
+
+# -----------------------------------------------------------------------------
+def required_nodes(nodes, values, targets):
+    #Nodes needed to compute the targets from the values, in the declaration order
+    producers = {}
+    for node in nodes:
+        for output in node.outputs:
+            producers[output] = node
+    needed = set()
+    missing = []
+    names = list(targets)
+    while len(names) > 0:
+        name = names.pop()
+        if name in values:
+            continue
+        if not name in producers:
+            missing += [name]
+            continue
+        if producers[name].name in needed:
+            continue
+        needed.add(producers[name].name)
+        names += producers[name].inputs
+    if len(missing) > 0:
+        print("Missing input(s) of the pipeline: " + ", ".join(sorted(set(missing))))
+        sys.exit(1)
+    return [node for node in nodes if node.name in needed]
+
+# -----------------------------------------------------------------------------
+def run_pipeline(nodes, values, targets=None, jobs=1, cacheFolder=None):
+    #Run the nodes needed to compute the targets (all the outputs by default) from the values (dict name: value).
+    #A node is started as soon as its inputs are available, with at most jobs nodes running at the same time.
+    #With cacheFolder, the outputs of the nodes with cache are stored in the folder, named by a hash of the values
+    #and parameters they depend on. A node with all its outputs in the cache is replaced by their reading, so only
+    #the nodes depending on a changed value or parameter are run again.
+    #Return the dict of all the values and the report of the nodes (name, start and wall time in s, peak memory in bytes)
+    values = dict(values)
+    if targets is None:
+        targets = [output for node in nodes for output in node.outputs]
+    if cacheFolder is not None:
+        nodes = cached_nodes(nodes, values, cacheFolder)
+    remaining = required_nodes(nodes, values, targets)
+    report = []
+    monitor = MemoryMonitor()
+    monitor.start()
+    startTime = time.time()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max(1, jobs)) as executor:
+            running = {}
+            while len(remaining) > 0 or len(running) > 0:
+                for node in [node for node in remaining if all([input in values for input in node.inputs])]:
+                    remaining.remove(node)
+                    running[executor.submit(run_node, node, [values[input] for input in node.inputs], monitor)] = node
+                if len(running) == 0:
+                    print("Cannot run the node(s): " + ", ".join([node.name for node in remaining]))
+                    sys.exit(1)
+                done, notDone = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    node = running.pop(future)
+                    outputs, start, wallTime, peakMemory = future.result()
+                    if len(node.outputs) == 1:
+                        outputs = (outputs,)
+                    for name, value in zip(node.outputs, outputs):
+                        values[name] = value
+                    report += [{"node": node.name, "start": start - startTime, "time": wallTime, "peakMemory": peakMemory, "cached": getattr(node, "cached", False)}]
+    finally:
+        monitor.stop()
+    report.sort(key=lambda entry: entry["start"])
+    return values, report
+
+# -----------------------------------------------------------------------------
+def run_step(node, values, verbose=False):
+    #Run a single node with run_pipeline (used by the scripts of the FAF steps) and return its outputs
+    #(a tuple if there are several outputs). With verbose, the report of the node is printed
+    values, report = run_pipeline([node], values, node.outputs)
+    if verbose:
+        print_report(report)
+    outputs = tuple([values[output] for output in node.outputs])
+    if len(outputs) == 1:
+        return outputs[0]
+    return outputs
+
+# -----------------------------------------------------------------------------
+def cached_nodes(nodes, values, cacheFolder):
+    #Replace the nodes with all their outputs in the cache folder by the reading of the outputs, and the other nodes
+    #with cache by the node followed by the writing of its outputs
+    os.makedirs(cacheFolder, exist_ok=True)
+    keys = value_keys(nodes, values)
+    newNodes = []
+    for node in nodes:
+        if not node.cache or not all([output in keys for output in node.outputs]):
+            newNodes += [node]
+            continue
+        filenames = [os.path.join(cacheFolder, keys[output] + ".mha") for output in node.outputs]
+        if all([os.path.isfile(filename) for filename in filenames]):
+            newNode = Node(node.name, lambda filenames=filenames: read_cached_outputs(filenames), [], node.outputs)
+            newNode.cached = True
+        else:
+            newNode = Node(node.name, lambda *inputs, node=node, filenames=filenames: write_cached_outputs(node.function(*inputs), filenames), node.inputs, node.outputs)
+        newNodes += [newNode]
+    return newNodes
+
+# -----------------------------------------------------------------------------
+def value_keys(nodes, values):
+    #Hash of each value: the hash of the content for the values of the pipeline inputs, and the hash of the node
+    #name, parameters and input hashes for the node outputs
+    keys = {}
+    for name in values:
+        keys[name] = value_hash(values[name])
+    added = True
+    while added:
+        added = False
+        for node in nodes:
+            if node.outputs[0] in keys or not all([input in keys for input in node.inputs]):
+                continue
+            for index, output in enumerate(node.outputs):
+                description = {"version": cacheVersion, "node": node.name, "parameters": node.parameters, "inputs": [keys[input] for input in node.inputs], "output": index}
+                keys[output] = hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+            added = True
+    return keys
+
+#Change it when the computation of a step changes, to not reuse the previous cached values
+cacheVersion = 1
+
+# -----------------------------------------------------------------------------
+def value_hash(value):
+    if isinstance(value, itk.ImageBase):
+        array = itk.array_view_from_image(value)
+        description = {"voxels": faf_ACF_image.voxel_hash(array), "dtype": array.dtype.str, "shape": list(array.shape),
+                       "spacing": list(value.GetSpacing()), "origin": list(value.GetOrigin()),
+                       "direction": itk.array_from_matrix(value.GetDirection()).tolist()}
+    else:
+        description = {"value": repr(value)}
+    return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+# -----------------------------------------------------------------------------
+def read_cached_outputs(filenames):
+    outputs = tuple([itk.imread(filename) for filename in filenames])
+    for filename in filenames:
+        os.utime(filename)
+    if len(outputs) == 1:
+        return outputs[0]
+    return outputs
+
+# -----------------------------------------------------------------------------
+def write_cached_outputs(outputs, filenames):
+    images = outputs
+    if len(filenames) == 1:
+        images = (outputs,)
+    for image, filename in zip(images, filenames):
+        write_cached_image(image, filename)
+    return outputs
+
+# -----------------------------------------------------------------------------
+def write_cached_image(image, filename):
+    #Written in a temporary file unique to the writer then renamed, so the cases computing the same value at the
+    #same time never write in the same file, and a reader never gets a partially written file
+    fd, tmpFilename = tempfile.mkstemp(dir=os.path.dirname(filename), prefix="tmp", suffix=".mha")
+    os.close(fd)
+    try:
+        itk.imwrite(image, tmpFilename)
+        os.replace(tmpFilename, filename)
+    finally:
+        if os.path.exists(tmpFilename):
+            os.remove(tmpFilename)
+
+# -----------------------------------------------------------------------------
+def run_node(node, inputs, monitor):
+    monitor.begin(node.name)
+    start = time.time()
+    try:
+        outputs = node.function(*inputs)
+    finally:
+        peakMemory = monitor.end(node.name)
+    return outputs, start, time.time() - start, peakMemory
+
+# -----------------------------------------------------------------------------
+def print_report(report):
+    print("{:<16}{:>12}{:>12}{:>20}{:>8}".format("node", "start (s)", "time (s)", "peak memory (MB)", "cached"))
+    for entry in report:
+        print("{:<16}{:>12.3f}{:>12.3f}{:>20.1f}{:>8}".format(entry["node"], entry["start"], entry["time"], entry["peakMemory"]/1e6, "yes" if entry["cached"] else "no"))
+
+# -----------------------------------------------------------------------------
+def current_memory():
+    #Resident memory of the process in bytes
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1])*os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource is not None:
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == "darwin" else maxrss*1024
+    return 0
+
+# -----------------------------------------------------------------------------
+class MemoryMonitor:
+    #Sample the resident memory of the process and keep its peak while each node is running. When nodes run at the
+    #same time, the peak is the one of the whole process during the node
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peaks = {}
+        self.lock = threading.Lock()
+        self.stopEvent = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopEvent.set()
+        self.thread.join()
+
+    def sample(self):
+        while not self.stopEvent.wait(self.interval):
+            memory = current_memory()
+            with self.lock:
+                for name in self.peaks:
+                    self.peaks[name] = max(self.peaks[name], memory)
+
+    def begin(self, name):
+        with self.lock:
+            self.peaks[name] = current_memory()
+
+    def end(self, name):
+        memory = current_memory()
+        with self.lock:
+            return max(self.peaks.pop(name), memory)
+
+# -----------------------------------------------------------------------------
+if __name__ == '__main__':
+    faf_pipeline_click()
+
+# -----------------------------------------------------------------------------
+import unittest
+import tempfile
+import shutil
+
+class Test_Faf_Pipeline(unittest.TestCase):
+    def test_run_pipeline(self):
+        order = []
+        def step(name, duration):
+            def function(*inputs):
+                time.sleep(duration)
+                order.append(name)
+                return sum(inputs) + 1
+            return function
+        nodes = [Node("a", step("a", 0.2), ["x"], ["a"]),
+                 Node("b", step("b", 0.05), ["a"], ["b"]),
+                 Node("c", step("c", 0.05), ["y"], ["c"]),
+                 Node("d", step("d", 0), ["b", "c"], ["d"]),
+                 Node("e", step("e", 0), ["z"], ["e"])]
+        values, report = run_pipeline(nodes, {"x": 1, "y": 10}, ["d"], jobs=2)
+        self.assertTrue(values["d"] == 15)
+        self.assertTrue(not "e" in values)
+        #c does not depend on a and b, it is run at the same time as a
+        self.assertTrue(order == ["c", "a", "b", "d"])
+        self.assertTrue([entry["node"] for entry in report][-1] == "d")
+        self.assertTrue(all([entry["peakMemory"] > 0 for entry in report]))
+        #Intermediate values as inputs
+        values, report = run_pipeline(nodes, {"b": 5, "y": 10}, ["d"])
+        self.assertTrue(values["d"] == 17)
+        self.assertTrue(len(report) == 2)
+    def test_run_step(self):
+        x = itk.image_from_array(np.ones((4, 5, 6), dtype=np.float32))
+        output = run_step(Node("double", lambda image: itk.multiply_image_filter(image, constant=2.0), ["x"], ["y"]), {"x": x})
+        self.assertTrue(np.allclose(itk.array_view_from_image(output), 2))
+        self.assertTrue(run_step(Node("split", lambda a: (a, a + 1), ["a"], ["b", "c"]), {"a": 1}) == (1, 2))
+    def test_run_pipeline_cache(self):
+        tmpdirpath = tempfile.mkdtemp()
+        calls = []
+        def nodes(offset1, offset2):
+            def add(name, offset):
+                def function(image):
+                    calls.append(name)
+                    output = itk.image_from_array(itk.array_from_image(image) + offset)
+                    output.CopyInformation(image)
+                    return output
+                return function
+            return [Node("a", add("a", offset1), ["x"], ["a"], {"offset": offset1}, cache=True),
+                    Node("b", add("b", 1.0), ["a"], ["b"], cache=True),
+                    Node("c", add("c", offset2), ["b"], ["c"], {"offset": offset2})]
+        x = itk.image_from_array(np.ones((4, 5, 6), dtype=np.float32))
+        values, report = run_pipeline(nodes(1.0, 2.0), {"x": x}, ["c"], cacheFolder=tmpdirpath)
+        self.assertTrue(calls == ["a", "b", "c"])
+        self.assertTrue(len(os.listdir(tmpdirpath)) == 2)
+        #Only the node after the changed parameter is run again
+        values, report = run_pipeline(nodes(1.0, 3.0), {"x": x}, ["c"], cacheFolder=tmpdirpath)
+        self.assertTrue(calls == ["a", "b", "c", "c"])
+        self.assertTrue(np.allclose(itk.array_view_from_image(values["c"]), 6))
+        self.assertTrue([entry["cached"] for entry in report] == [True, False])
+        values, report = run_pipeline(nodes(2.0, 3.0), {"x": x}, ["c"], cacheFolder=tmpdirpath)
+        self.assertTrue(calls == ["a", "b", "c", "c", "a", "b", "c"])
+        self.assertTrue(np.allclose(itk.array_view_from_image(values["c"]), 7))
+        #A changed input
+        x = itk.image_from_array(np.zeros((4, 5, 6), dtype=np.float32))
+        values, report = run_pipeline(nodes(2.0, 3.0), {"x": x}, ["c"], cacheFolder=tmpdirpath)
+        self.assertTrue(calls[-3:] == ["a", "b", "c"])
+        shutil.rmtree(tmpdirpath)
+    def test_write_cached_outputs_concurrent(self):
+        tmpdirpath = tempfile.mkdtemp()
+        images = [itk.image_from_array(np.full((20, 30, 40), index, dtype=np.float32)) for index in range(8)]
+        filename = os.path.join(tmpdirpath, "key.mha")
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            list(executor.map(lambda image: write_cached_outputs(image, [filename]), images*4))
+        self.assertTrue(os.listdir(tmpdirpath) == ["key.mha"])
+        array = itk.array_view_from_image(read_cached_outputs([filename]))
+        self.assertTrue(np.all(array == array.flat[0]))
+        shutil.rmtree(tmpdirpath)
+    def test_faf_nodes(self):
+        np.random.seed(0)
+        ct = itk.image_from_array(np.random.randint(-1000, 1500, size=(20, 15, 10)).astype(np.float32))
+        values, report = run_pipeline(faf_nodes(), {"ct": ct}, ["acf"])
+        self.assertTrue([entry["node"] for entry in report] == ["acf"])
+        acf = faf_ACF_image.faf_ACF_image(ct, [0.2068007, 0.57384408], [0.00014657, 0.13597229, 0.24070651])
+        self.assertTrue(np.allclose(itk.array_view_from_image(values["acf"]), itk.array_view_from_image(acf)))
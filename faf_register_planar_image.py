@@ -11,7 +11,9 @@ import itk
 import click
 import numpy as np
 import sys
+import concurrent.futures
 import image_projection
+import faf_pipeline
 
 
 # -----------------------------------------------------------------------------
@@ -22,23 +24,34 @@ CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
                 type=click.Path(dir_okay=False))
 @click.option('--spect', '-s', help='Input SPECT 3D image filename', required=True,
                 type=click.Path(dir_okay=False))
+@click.option('--metric', '-m', help='Similarity metric: mutual information (mi), normalized cross correlation (ncc) or Mattes mutual information of ITK (mattes)', default='mi',
+                type=click.Choice(['mi', 'ncc', 'mattes']))
+@click.option('--jobs', '-j', help='Number of threads evaluating the mattes metric', default=1)
+@click.option('--levels', '-l', help='Number of levels of the coarse to fine search (0: search all the shifts at full resolution)', default=0)
+@click.option('--x_range', '-x', help='Search the x misalignment in this range (in pixels) around the centered position', default=0)
+@click.option('--subpixel', help='Sub-pixel refinement of the x and y position', is_flag=True, default=False)
 @click.option('--output', '-o', help='Output filename for the geometrical mean registered 2D image', required=True,
                 type=click.Path(dir_okay=False,
                               writable=True, readable=False,
                               resolve_path=True, allow_dash=False, path_type=None))
 
-def faf_register_planar_image_click(planar, spect, output):
+def faf_register_planar_image_click(planar, spect, metric, jobs, levels, x_range, subpixel, output):
     '''
     Register the geometrical mean planar image (usually the output of faf_create_planar_geometrical_mean) on the projected SPECT 3D image along the y coordinate.
+
+    All the y shifts are scored at once: with the mutual information metric (mi), the joint histogram of each overlap is computed from the binned images; with the normalized cross correlation (ncc), the cross products of all the shifts are obtained with a FFT. The Mattes mutual information metric of ITK (mattes) is kept for validation; its evaluation is split over --jobs threads. With all the metrics, the first best shift is selected when several shifts have the same score.
+
+    With --levels, the shifts are searched on downsampled images first and then refined at each finer level. --x_range also searches the x misalignment, and --subpixel refines the position below the pixel size.
     '''
 
     inputPlanar = itk.imread(planar)
     inputSpect = itk.imread(spect)
-    outputImage = faf_register_planar_image(inputPlanar, inputSpect)
+    node = faf_pipeline.Node("registration", lambda gm, spect: faf_register_planar_image(gm, spect, metric, levels, x_range, subpixel, jobs), ["gm", "spect"], ["registeredGm"])
+    outputImage = faf_pipeline.run_step(node, {"gm": inputPlanar, "spect": inputSpect})
     itk.imwrite(outputImage, output)
 
 # -----------------------------------------------------------------------------
-def faf_register_planar_image(planar, spect):
+def faf_register_planar_image(planar, spect, metric="mi", levels=0, xRange=0, subpixel=False, jobs=1):
 
     if planar.GetImageDimension() != 2:
         print("Planar image dimension (" + str(planar.GetImageDimension()) + ") is not 2")
@@ -57,50 +70,256 @@ def faf_register_planar_image(planar, spect):
     projectedSpect = flipFilter.GetOutput()
     projectedSpect = gt.applyTransformation(input=projectedSpect, spacinglike=planar, force_resample=True, adaptive=True)
 
-    minCorrelation = 10
-    minCorrelationIndex = 0
+    #Score the y shifts of the centered planar image over the numpy arrays
+    xOffset = (projectedSpect.GetLargestPossibleRegion().GetSize()[0] -  planar.GetLargestPossibleRegion().GetSize()[0])/2.0
+    shift, xOffset = register_planar(itk.array_view_from_image(projectedSpect), itk.array_view_from_image(planar), xOffset, metric, levels=levels, xRange=xRange, subpixel=subpixel, jobs=jobs)
 
-    for i in range(projectedSpect.GetLargestPossibleRegion().GetSize()[1] + planar.GetLargestPossibleRegion().GetSize()[1] -1):
-        newOrigin = itk.Vector[itk.D, 2]()
-        newOrigin[0] = projectedSpect.GetOrigin()[0] + (projectedSpect.GetLargestPossibleRegion().GetSize()[0] -  planar.GetLargestPossibleRegion().GetSize()[0])*projectedSpect.GetSpacing()[0]/2.0
-        newOrigin[1] = projectedSpect.GetOrigin()[1] - (planar.GetLargestPossibleRegion().GetSize()[1] -1 -i)*projectedSpect.GetSpacing()[1]
-        centeredPlanar = gt.applyTransformation(input=planar, neworigin=newOrigin)
-        centredPlanarOriginInProjectedSpect = projectedSpect.TransformPhysicalPointToIndex(newOrigin)
+    newOrigin = itk.Vector[itk.D, 2]()
+    newOrigin[0] = projectedSpect.GetOrigin()[0] + xOffset*projectedSpect.GetSpacing()[0]
+    newOrigin[1] = projectedSpect.GetOrigin()[1] + shift*projectedSpect.GetSpacing()[1]
+    centeredPlanar = gt.applyTransformation(input=planar, neworigin=newOrigin)
 
-        identityTransform = itk.IdentityTransform[itk.D, 2].New()
-        identityTransform.SetIdentity()
-        interpolator = itk.LinearInterpolateImageFunction[type(planar), itk.D].New()
+    return centeredPlanar
+
+# -----------------------------------------------------------------------------
+def register_shift(fixedArray, movingArray, xOffset=0.0, metric="mi", bins=50):
+    #Return the y shift (in pixels) of the moving 2D array in the fixed 2D array maximizing the similarity metric.
+    #The moving row r is on the fixed row r + shift and the moving column c on the fixed column c + xOffset.
+    #All the shifts with an overlap are scored, from -(movingHeight-1) to fixedHeight-1
+    scores = shift_scores(fixedArray, movingArray, xOffset, metric, bins)
+    return int(np.argmax(scores)) - (movingArray.shape[0] - 1)
+
+# -----------------------------------------------------------------------------
+def shift_scores(fixedArray, movingArray, xOffset=0.0, metric="mi", bins=50, shifts=None, jobs=1):
+    #Similarity scores of the y shifts (all the shifts by default) for the x offset
+    if shifts is not None:
+        shifts = np.asarray(shifts)
+    if metric == "mattes":
+        return -mattes_values(fixedArray, movingArray, xOffset, bins, shifts, jobs)
+    fixedArray, movingArray = common_columns(fixedArray, movingArray, xOffset)
+    if metric == "ncc":
+        return ncc_scores(fixedArray, movingArray, shifts)
+    elif metric == "mi":
+        return mi_scores(fixedArray, movingArray, bins, shifts)
+    print("Unknown metric: " + str(metric))
+    sys.exit(1)
 
+# -----------------------------------------------------------------------------
+def mattes_values(fixedArray, movingArray, xOffset=0.0, bins=50, shifts=None, jobs=1):
+    #Mattes mutual information metric of ITK (lower is better) for the y shifts (all the shifts by default), with the
+    #same fixed regions as the former loop over the shifts. The shifts are split in jobs contiguous chunks evaluated
+    #in a thread pool, each with its own metric, and the values are returned in the order of the shifts
+    fixedImage = itk.image_from_array(np.ascontiguousarray(fixedArray, dtype=np.float64))
+    movingImage = itk.image_from_array(np.ascontiguousarray(movingArray, dtype=np.float64))
+    movingImage.SetOrigin([xOffset, 0])
+    if shifts is None:
+        shifts = np.arange(-(movingArray.shape[0] - 1), fixedArray.shape[0])
+    chunks = [chunk for chunk in np.array_split(shifts, max(1, min(jobs, len(shifts)))) if len(chunk) > 0]
+    if len(chunks) == 1:
+        return mattes_chunk_values(fixedImage, movingImage, chunks[0], bins, 0)
+    with concurrent.futures.ThreadPoolExecutor(len(chunks)) as executor:
+        values = list(executor.map(lambda chunk: mattes_chunk_values(fixedImage, movingImage, chunk, bins, 1), chunks))
+    return np.concatenate(values)
+
+# -----------------------------------------------------------------------------
+def mattes_chunk_values(fixedImage, movingImage, shifts, bins=50, workUnits=0):
+    #The metric, transform and interpolator are created once for the chunk. The moving row r is on the fixed row
+    #r + shift with the translation (0, -shift)
+    fixedSize = fixedImage.GetLargestPossibleRegion().GetSize()
+    movingSize = movingImage.GetLargestPossibleRegion().GetSize()
+    translation = itk.TranslationTransform[itk.D, 2].New()
+    interpolator = itk.LinearInterpolateImageFunction[type(movingImage), itk.D].New()
+    miCoeffFilter = itk.MattesMutualInformationImageToImageMetric[type(fixedImage), type(movingImage)].New()
+    miCoeffFilter.SetMovingImage(movingImage)
+    miCoeffFilter.SetFixedImage(fixedImage)
+    miCoeffFilter.SetTransform(translation)
+    miCoeffFilter.SetInterpolator(interpolator)
+    miCoeffFilter.UseAllPixelsOn()
+    miCoeffFilter.SetNumberOfHistogramBins(bins)
+    if workUnits > 0:
+        miCoeffFilter.SetNumberOfWorkUnits(workUnits)
+    parameters = translation.GetParameters()
+    xIndex = max(0, int(np.floor(movingImage.GetOrigin()[0] + 0.5)))
+    values = np.full(len(shifts), np.inf)
+    for i, shift in enumerate(shifts):
+        index = int(shift) + movingSize[1] - 1
         smallRegion = itk.ImageRegion[2]()
-        smallRegionSize = itk.Size[2]()
-        smallRegionSize[0] = min(centeredPlanar.GetLargestPossibleRegion().GetSize()[0], projectedSpect.GetLargestPossibleRegion().GetSize()[0])
-        smallRegionSize[1] = min(i + 1, projectedSpect.GetLargestPossibleRegion().GetSize()[1] + planar.GetLargestPossibleRegion().GetSize()[1] -1 -i, projectedSpect.GetLargestPossibleRegion().GetSize()[1])
-        smallRegion.SetSize(smallRegionSize)
-        smallRegionIndex = itk.Index[2]()
-        smallRegionIndex[0] = max(0, centredPlanarOriginInProjectedSpect[0])
-        smallRegionIndex[1] = max(0, centredPlanarOriginInProjectedSpect[1])
-        smallRegion.SetIndex(smallRegionIndex)
-
-        miCoeffFilter = itk.MattesMutualInformationImageToImageMetric[type(planar), type(planar)].New()
-        miCoeffFilter.SetMovingImage(centeredPlanar)
-        miCoeffFilter.SetFixedImage(projectedSpect)
-        miCoeffFilter.SetTransform(identityTransform)
-        miCoeffFilter.SetInterpolator(interpolator)
+        smallRegion.SetIndex([min(xIndex, fixedSize[0] - 1), max(0, int(shift))])
+        smallRegion.SetSize([min(movingSize[0], fixedSize[0] - smallRegion.GetIndex()[0]), min(index + 1, fixedSize[1] + movingSize[1] - 1 - index, fixedSize[1])])
         miCoeffFilter.SetFixedImageRegion(smallRegion)
-        miCoeffFilter.UseAllPixelsOn()
-        miCoeffFilter.SetNumberOfHistogramBins(50)
-        miCoeffFilter.ReinitializeSeed()
-        miCoeffFilter.Initialize()
-        if miCoeffFilter.GetValue(identityTransform.GetParameters()) < minCorrelation:
-            minCorrelation = miCoeffFilter.GetValue(identityTransform.GetParameters())
-            minCorrelationIndex = i
+        parameters[1] = -float(shift)
+        try:
+            miCoeffFilter.Initialize()
+            values[i] = miCoeffFilter.GetValue(parameters)
+        except RuntimeError:
+            #Not enough samples in the moving image, the shift is never selected
+            pass
+    return values
 
-    newOrigin = itk.Vector[itk.D, 2]()
-    newOrigin[0] = projectedSpect.GetOrigin()[0] + (projectedSpect.GetLargestPossibleRegion().GetSize()[0] -  planar.GetLargestPossibleRegion().GetSize()[0])*projectedSpect.GetSpacing()[0]/2.0
-    newOrigin[1] = projectedSpect.GetOrigin()[1] - (planar.GetLargestPossibleRegion().GetSize()[1] -1 -minCorrelationIndex)*projectedSpect.GetSpacing()[1]
-    centeredPlanar = gt.applyTransformation(input=planar, neworigin=newOrigin)
+# -----------------------------------------------------------------------------
+def register_planar(fixedArray, movingArray, xOffset=0.0, metric="mi", bins=50, levels=0, xRange=0, subpixel=False, jobs=1):
+    #Return the (y shift, x offset) of the moving 2D array in the fixed 2D array.
+    #The search starts on the arrays downsampled levels times by 2, over all the y shifts and the x offsets in
+    #[xOffset - xRange, xOffset + xRange]. The best position is then refined around it at each finer level, so the
+    #number of scored positions grows with the number of levels and not with the height.
+    #With subpixel, a parabola is fitted on the scores of the neighbour positions in y and x.
+    #Both pyramids have the same depth, limited by the smallest array
+    levels = pyramid_levels(levels, fixedArray.shape, movingArray.shape)
+    fixedPyramid = pyramid(fixedArray, levels)
+    movingPyramid = pyramid(movingArray, levels)
+    factor = 2**(len(fixedPyramid) - 1)
+    fixedCoarse = fixedPyramid[-1]
+    movingCoarse = movingPyramid[-1]
+    coarseRange = int(xRange//factor)
+    bestScore = -np.inf
+    for dx in range(-coarseRange, coarseRange + 1):
+        scores = shift_scores(fixedCoarse, movingCoarse, xOffset/factor + dx, metric, bins, jobs=jobs)
+        if scores.max() > bestScore:
+            bestScore = scores.max()
+            shift = int(np.argmax(scores)) - (movingCoarse.shape[0] - 1)
+            dxShift = dx
+    #Refine at each finer level around the best position of the coarser one
+    for level in range(len(fixedPyramid) - 2, -1, -1):
+        shift *= 2
+        dxShift *= 2
+        factor = 2**level
+        shifts = np.arange(shift - 1, shift + 2)
+        bestScore = -np.inf
+        levelRange = int(xRange//factor)
+        for dx in sorted(set(np.clip(range(dxShift - 1, dxShift + 2), -levelRange, levelRange))):
+            scores = shift_scores(fixedPyramid[level], movingPyramid[level], xOffset/factor + dx, metric, bins, shifts, jobs=jobs)
+            if scores.max() > bestScore:
+                bestScore = scores.max()
+                bestShift = int(shifts[np.argmax(scores)])
+                bestDx = dx
+        shift = bestShift
+        dxShift = int(bestDx)
+    yShift = float(shift)
+    xShift = xOffset + dxShift
+    if subpixel:
+        scores = shift_scores(fixedArray, movingArray, xShift, metric, bins, [shift - 1, shift, shift + 1], jobs=jobs)
+        yShift += parabola_vertex(scores)
+        scores = [shift_scores(fixedArray, movingArray, xShift + dx, metric, bins, [shift], jobs=jobs)[0] for dx in [-1, 0, 1]]
+        xShift += parabola_vertex(scores)
+    return yShift, xShift
 
-    return centeredPlanar
+# -----------------------------------------------------------------------------
+def parabola_vertex(scores):
+    #Position, in [-0.5, 0.5], of the maximum of the parabola going through the 3 scores at -1, 0 and 1
+    if not np.all(np.isfinite(scores)):
+        return 0.0
+    curvature = scores[0] - 2*scores[1] + scores[2]
+    if curvature >= 0:
+        return 0.0
+    return float(np.clip(0.5*(scores[0] - scores[2])/curvature, -0.5, 0.5))
+
+# -----------------------------------------------------------------------------
+def pyramid(array, levels):
+    #List of the array downsampled by 2 (mean of 2x2 blocks) levels times, stopping before a dimension gets smaller than 4
+    arrays = [np.asarray(array, dtype=np.float64)]
+    for level in range(levels):
+        array = arrays[-1]
+        if min(array.shape) < 8:
+            break
+        height = array.shape[0]//2*2
+        width = array.shape[1]//2*2
+        arrays.append(array[:height, :width].reshape(height//2, 2, width//2, 2).mean(axis=(1, 3)))
+    return arrays
+
+# -----------------------------------------------------------------------------
+def pyramid_levels(levels, *shapes):
+    #Number of downsamplings (not more than levels) done by pyramid on all the arrays of these shapes
+    smallest = min([min(shape) for shape in shapes])
+    level = 0
+    while level < levels and smallest >= 8:
+        smallest //= 2
+        level += 1
+    return level
+
+# -----------------------------------------------------------------------------
+def common_columns(fixedArray, movingArray, xOffset):
+    #Linear interpolation of the moving array on the fixed columns, keep only the columns inside both arrays
+    fixedColumns = np.arange(fixedArray.shape[1])
+    movingColumns = fixedColumns - xOffset
+    inside = (movingColumns >= -1e-6) & (movingColumns <= movingArray.shape[1] - 1 + 1e-6)
+    movingColumns = np.clip(movingColumns[inside], 0, movingArray.shape[1] - 1)
+    lowColumns = np.minimum(np.floor(movingColumns).astype(int), movingArray.shape[1] - 2) if movingArray.shape[1] > 1 else np.zeros(len(movingColumns), dtype=int)
+    highColumns = np.minimum(lowColumns + 1, movingArray.shape[1] - 1)
+    weights = movingColumns - lowColumns
+    movingArray = np.asarray(movingArray, dtype=np.float64)
+    interpolatedArray = movingArray[:, lowColumns]*(1 - weights) + movingArray[:, highColumns]*weights
+    return np.asarray(fixedArray, dtype=np.float64)[:, inside], interpolatedArray
+
+# -----------------------------------------------------------------------------
+def overlap_rows(fixedHeight, movingHeight, shifts=None):
+    #First and last (excluded) rows of the overlap in the fixed and moving arrays for the shifts (all the shifts by default)
+    if shifts is None:
+        shifts = np.arange(-(movingHeight - 1), fixedHeight)
+    fixedStart = np.maximum(0, shifts)
+    fixedStop = np.minimum(fixedHeight, movingHeight + shifts)
+    return fixedStart, fixedStop, fixedStart - shifts, fixedStop - shifts
+
+# -----------------------------------------------------------------------------
+def ncc_scores(fixedArray, movingArray, shifts=None):
+    fixedStart, fixedStop, movingStart, movingStop = overlap_rows(fixedArray.shape[0], movingArray.shape[0], shifts)
+    #Sums over the overlaps with the cumulative sums of the rows
+    cumulativeFixed = np.concatenate(([0], np.cumsum(fixedArray.sum(axis=1))))
+    cumulativeFixed2 = np.concatenate(([0], np.cumsum((fixedArray**2).sum(axis=1))))
+    cumulativeMoving = np.concatenate(([0], np.cumsum(movingArray.sum(axis=1))))
+    cumulativeMoving2 = np.concatenate(([0], np.cumsum((movingArray**2).sum(axis=1))))
+    sumFixed = cumulativeFixed[fixedStop] - cumulativeFixed[fixedStart]
+    sumFixed2 = cumulativeFixed2[fixedStop] - cumulativeFixed2[fixedStart]
+    sumMoving = cumulativeMoving[movingStop] - cumulativeMoving[movingStart]
+    sumMoving2 = cumulativeMoving2[movingStop] - cumulativeMoving2[movingStart]
+    if shifts is None:
+        #Cross products of all the shifts with a FFT correlation along y, summed over the columns
+        size = fixedArray.shape[0] + movingArray.shape[0] - 1
+        fftProduct = np.fft.rfft(fixedArray, size, axis=0)*np.fft.rfft(movingArray[::-1], size, axis=0)
+        sumCross = np.fft.irfft(fftProduct.sum(axis=1), size)
+    else:
+        sumCross = np.array([np.sum(fixedArray[fixedStart[i]:fixedStop[i]]*movingArray[movingStart[i]:movingStop[i]]) for i in range(len(fixedStart))])
+    nbPixels = (fixedStop - fixedStart)*fixedArray.shape[1]
+    covariance = sumCross - sumFixed*sumMoving/nbPixels
+    variance = (sumFixed2 - sumFixed**2/nbPixels)*(sumMoving2 - sumMoving**2/nbPixels)
+    scores = np.full(len(fixedStart), -np.inf)
+    valid = (nbPixels > 0) & (variance > 1e-12*max(1.0, variance.max()))
+    scores[valid] = covariance[valid]/np.sqrt(variance[valid])
+    return scores
+
+# -----------------------------------------------------------------------------
+def binned_array(array, bins):
+    minimum = array.min()
+    maximum = array.max()
+    if maximum <= minimum:
+        return np.zeros(array.shape, dtype=np.intp)
+    return np.minimum(((array - minimum)*(bins/(maximum - minimum))).astype(np.intp), bins - 1)
+
+# -----------------------------------------------------------------------------
+def mi_scores(fixedArray, movingArray, bins=50, shifts=None):
+    fixedStart, fixedStop, movingStart, movingStop = overlap_rows(fixedArray.shape[0], movingArray.shape[0], shifts)
+    fixedBins = binned_array(fixedArray, bins)
+    movingBins = binned_array(movingArray, bins)
+    jointBins = fixedBins*bins
+    #Marginal histograms of the overlaps with the cumulative histograms of the rows
+    cumulativeFixed = np.zeros((fixedArray.shape[0] + 1, bins))
+    np.cumsum(np.apply_along_axis(np.bincount, 1, fixedBins, minlength=bins), axis=0, out=cumulativeFixed[1:])
+    cumulativeMoving = np.zeros((movingArray.shape[0] + 1, bins))
+    np.cumsum(np.apply_along_axis(np.bincount, 1, movingBins, minlength=bins), axis=0, out=cumulativeMoving[1:])
+    scores = np.full(len(fixedStart), -np.inf)
+    for i in range(len(fixedStart)):
+        if fixedStop[i] <= fixedStart[i]:
+            continue
+        #The joint histogram is a full re-bin of the overlap: a shift changes every (fixed, moving) row pair
+        joint = np.bincount((jointBins[fixedStart[i]:fixedStop[i]] + movingBins[movingStart[i]:movingStop[i]]).ravel(), minlength=bins*bins)
+        nbPixels = joint.sum()
+        joint = joint[joint > 0]
+        fixedHistogram = cumulativeFixed[fixedStop[i]] - cumulativeFixed[fixedStart[i]]
+        fixedHistogram = fixedHistogram[fixedHistogram > 0]
+        movingHistogram = cumulativeMoving[movingStop[i]] - cumulativeMoving[movingStart[i]]
+        movingHistogram = movingHistogram[movingHistogram > 0]
+        #MI = H(fixed) + H(moving) - H(fixed, moving)
+        scores[i] = (np.sum(joint*np.log(joint)) - np.sum(fixedHistogram*np.log(fixedHistogram)) - np.sum(movingHistogram*np.log(movingHistogram)))/nbPixels + np.log(nbPixels)
+    return scores
 
 # -----------------------------------------------------------------------------
 if __name__ == '__main__':
@@ -113,15 +332,50 @@ import hashlib
 import shutil
 import os
 
-#class Test_Faf_Register_Planar_Image(unittest.TestCase):
-#    def test_faf_register_planar_image(self):
-#        x1 = np.arange(0, 23, 1)
-#        y1 = np.arange(0, 71, 1)
-#        xx1, yy1 = np.meshgrid(x1, y1)
-#        xx1 = np.int16(xx1)
-#        image1 = itk.image_from_array(array)
-
-#        output=faf_register_planar_image(image1, )
-#        outputArray = itk.array_view_from_image(output)
-#        self.assertTrue(outputArray[13, 5] == np.sqrt((5-1.1*0.5*5)**2))
-
+class Test_Faf_Register_Planar_Image(unittest.TestCase):
+    def test_register_shift(self):
+        np.random.seed(0)
+        fixedArray = np.random.rand(60, 20)
+        for metric in ["mi", "ncc", "mattes"]:
+            self.assertTrue(register_shift(fixedArray, fixedArray[15:45], 0, metric) == 15)
+            self.assertTrue(register_shift(fixedArray, fixedArray[5:50, 2:18], 2, metric) == 5)
+            self.assertTrue(register_shift(fixedArray[20:], fixedArray[:50], 0, metric) == -20)
+    def test_mattes_jobs(self):
+        np.random.seed(0)
+        fixedArray = np.random.rand(50, 30)
+        movingArray = np.round(fixedArray[10:30, 3:27], 1)
+        values = mattes_values(fixedArray, movingArray, 3)
+        self.assertTrue(np.array_equal(values, mattes_values(fixedArray, movingArray, 3, jobs=4)))
+        self.assertTrue(register_planar(fixedArray, movingArray, 3, "mattes", jobs=4) == (10, 3))
+    def test_faf_register_planar_image(self):
+        np.random.seed(0)
+        spectArray = np.random.rand(30, 12, 25).astype(np.float32)
+        spect = itk.image_from_array(spectArray)
+        spect.SetSpacing([2, 2, 2])
+        planarArray = np.flip(spectArray.sum(axis=1), axis=0)[8:20, 2:23]
+        planar = itk.image_from_array(np.ascontiguousarray(planarArray))
+        planar.SetSpacing([2, 2])
+        planar.SetOrigin([-50, 100])
+        output = faf_register_planar_image(planar, spect)
+        self.assertTrue(np.allclose(output.GetOrigin(), [4, -42]))
+        self.assertTrue(np.allclose(itk.array_view_from_image(output), planarArray))
+    def test_register_planar(self):
+        y, x = np.mgrid[0:200, 0:60]
+        fixedArray = 100*np.exp(-((y - 60)**2 + (x - 25)**2)/40.) + 60*np.exp(-((y - 140)**2 + (x - 35)**2)/90.) + 20*np.exp(-((y - 100)**2)/400.)
+        movingArray = np.zeros((120, 50))
+        movingArray[:] = fixedArray[40:160, 7:57]
+        for metric in ["mi", "ncc"]:
+            self.assertTrue(register_planar(fixedArray, movingArray, 5, metric, levels=3, xRange=4) == (40, 7))
+        #Sub-pixel position
+        movingArray = 0.5*(fixedArray[40:160, 7:57] + fixedArray[41:161, 7:57])
+        yShift, xShift = register_planar(fixedArray, movingArray, 5, "ncc", levels=3, xRange=4, subpixel=True)
+        self.assertTrue(abs(yShift - 40.5) < 0.2)
+        self.assertTrue(abs(xShift - 7) < 0.2)
+    def test_register_planar_sizes(self):
+        #The moving pyramid stops before the fixed one: both use the depth of the smallest array
+        y, x = np.mgrid[0:200, 0:60]
+        fixedArray = 100*np.exp(-((y - 110)**2 + (x - 25)**2)/20.) + 60*np.exp(-((y - 125)**2 + (x - 22)**2)/10.)
+        movingArray = fixedArray[100:130, 20:30]
+        self.assertTrue(pyramid_levels(3, fixedArray.shape, movingArray.shape) == 1)
+        for metric in ["mi", "ncc"]:
+            self.assertTrue(register_planar(fixedArray, movingArray, 20, metric, levels=3, xRange=2) == (100, 20))
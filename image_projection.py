@@ -11,6 +11,7 @@ import itk
 import click
 import numpy as np
 import sys
+import os
 
 
 # -----------------------------------------------------------------------------
@@ -19,48 +20,178 @@ CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 
 @click.option('--input', '-i', help='Input image filename', required=True,
                 type=click.Path(dir_okay=False))
-@click.option('--axis', '-p', help='Axis of the projection', default=0)
+@click.option('--axis', '-p', help='Axis of the projection (can be repeated to project along several axes)', default=[0], multiple=True)
 @click.option('--mean', '-m', help='Compute the mean of the projected image', is_flag=True)
+@click.option('--operation', help='Operation of the projection', default='sum',
+                type=click.Choice(['sum', 'mean', 'max', 'mip', 'min', 'percentile']))
+@click.option('--percentile', '-q', help='Percentile (between 0 and 100) for the percentile operation', default=50.0)
+@click.option('--dtype', help='Type used to accumulate the voxels', default='float64',
+                type=click.Choice(['float32', 'float64', 'int64']))
+@click.option('--chunk_size', help='Size (MB) of the chunks of an uncompressed .mhd/.mha image read at once', default=64.0)
 @click.option('--output', '-o', help='Output filename', required=True,
                 type=click.Path(dir_okay=False,
                               writable=True, readable=False,
                               resolve_path=True, allow_dash=False, path_type=None))
 
-def image_projection_click(input, axis, mean, output):
+def image_projection_click(input, axis, mean, operation, percentile, dtype, chunk_size, output):
     '''
     Project the input along the axis. Compute the mean of the projection along this axis if the flag is set
+
+    The operation of the projection can also be the maximum (max or mip for the maximum intensity projection), the minimum or a percentile of the voxels along the axis. The voxels are accumulated in dtype (int64 for exact sums of integer images).
+
+    An uncompressed .mhd/.raw (or .mha) input is memory mapped and projected by chunks of --chunk_size MB, so images larger than the memory can be projected.
     '''
 
-    inputImage = itk.imread(input)
-    outputImage = image_projection(inputImage, axis, mean)
+    if mean:
+        operation = 'mean'
+    outputImage = image_projection_file(input, list(axis), operation=operation, dtype=np.dtype(dtype), percentile=percentile, chunkSize=chunk_size*1024*1024)
     itk.imwrite(outputImage, output)
 
 # -----------------------------------------------------------------------------
-def image_projection(image, axis=0, mean=False):
-    
-    array = (itk.array_from_image(image)).astype(float)
-    if image.GetImageDimension() == 3:
-        array = np.swapaxes(array, 0, 2)
-    projectedArray = np.sum(array, axis)
-    
+def image_projection(image, axis=0, mean=False, operation="sum", dtype=np.float64, percentile=50.0):
+    #Project the image along the ITK axis (or the list of ITK axes). The remaining axes keep their order.
+    #The voxels are read from a view of the image, without copy
     if mean:
-        projectedArray = projectedArray / image.GetLargestPossibleRegion().GetSize()[axis]
+        operation = "mean"
+    axes = np.atleast_1d(axis).tolist()
+    projectedArray = projection_array(itk.array_view_from_image(image), axes, operation, dtype, percentile)
+    return projection_image(projectedArray, image.GetSpacing(), image.GetOrigin(), axes)
+
+# -----------------------------------------------------------------------------
+def projection_image(projectedArray, spacing, origin, axes):
+    if projectedArray.dtype == np.int64:
+        #64 bits integer images are not wrapped in ITK
+        projectedArray = projectedArray.astype(np.float64)
 
-    outputImage = itk.image_from_array(projectedArray)
-    spacing =  np.array(image.GetSpacing())
-    spacing = np.delete(spacing, axis)
+    outputImage = itk.image_from_array(np.ascontiguousarray(projectedArray))
+    spacing =  np.array(spacing)
+    spacing = np.delete(spacing, axes)
     outputImage.SetSpacing(spacing)
-    origin =  np.array(image.GetOrigin())
-    origin = np.delete(origin, axis)
+    origin =  np.array(origin)
+    origin = np.delete(origin, axes)
     outputImage.SetOrigin(origin)
     return outputImage
 
+# -----------------------------------------------------------------------------
+def projection_array(array, axes, operation="sum", dtype=np.float64, percentile=50.0):
+    #Projection of the numpy array (..., y, x) of an image along the ITK axes, the result has the type dtype
+    numpyAxes = tuple([array.ndim - 1 - axis for axis in axes])
+    if len(set(numpyAxes)) != len(numpyAxes) or min(numpyAxes) < 0 or max(numpyAxes) >= array.ndim or len(numpyAxes) >= array.ndim:
+        print("Axes of the projection (" + str(axes) + ") are not valid for an image of dimension " + str(array.ndim))
+        sys.exit(1)
+    if operation == "sum":
+        return np.sum(array, axis=numpyAxes, dtype=dtype)
+    elif operation == "mean":
+        return np.sum(array, axis=numpyAxes, dtype=dtype) / np.prod([array.shape[axis] for axis in numpyAxes])
+    elif operation in ["max", "mip"]:
+        return np.max(array, axis=numpyAxes).astype(dtype, copy=False)
+    elif operation == "min":
+        return np.min(array, axis=numpyAxes).astype(dtype, copy=False)
+    elif operation == "percentile":
+        return np.percentile(array, percentile, axis=numpyAxes).astype(dtype, copy=False)
+    print("Unknown operation of the projection: " + str(operation))
+    sys.exit(1)
+
+# -----------------------------------------------------------------------------
+metaElementTypes = {"MET_CHAR": np.int8, "MET_UCHAR": np.uint8, "MET_SHORT": np.int16, "MET_USHORT": np.uint16,
+                    "MET_INT": np.int32, "MET_UINT": np.uint32, "MET_LONG_LONG": np.int64, "MET_ULONG_LONG": np.uint64,
+                    "MET_FLOAT": np.float32, "MET_DOUBLE": np.float64}
+
+def read_mhd_memmap(filename):
+    #Memory map the voxels of an uncompressed .mhd/.raw (or .mha) image without reading them
+    #Return (array, spacing, origin) with the numpy order of the axes (..., y, x), or None if the image cannot be mapped
+    if not (filename.endswith(".mhd") or filename.endswith(".mha")):
+        return None
+    header = {}
+    with open(filename, "rb") as f:
+        for line in f:
+            if b"=" not in line:
+                return None
+            key, value = line.decode("latin-1").split("=", 1)
+            header[key.strip()] = value.strip()
+            if key.strip() == "ElementDataFile":
+                break
+        headerEnd = f.tell() if header.get("ElementDataFile") == "LOCAL" else 0
+    if header.get("CompressedData", "False") == "True" or header.get("ElementType") not in metaElementTypes \
+       or int(header.get("ElementNumberOfChannels", 1)) != 1 or "ElementDataFile" not in header:
+        return None
+    dimSize = [int(s) for s in header["DimSize"].split()]
+    nbDimension = len(dimSize)
+    direction = header.get("TransformMatrix", header.get("Orientation", header.get("Rotation")))
+    if direction is not None and not np.allclose(np.array(direction.split(), dtype=float), np.eye(nbDimension).flatten()):
+        return None
+    spacing = [float(s) for s in header.get("ElementSpacing", header.get("ElementSize", " ".join(["1"]*nbDimension))).split()]
+    origin = [float(s) for s in header.get("Offset", header.get("Origin", header.get("Position", " ".join(["0"]*nbDimension)))).split()]
+
+    dataFile = header["ElementDataFile"]
+    if dataFile == "LOCAL":
+        dataFile = filename
+        offset = headerEnd
+    elif dataFile == "LIST" or "%" in dataFile:
+        return None
+    else:
+        dataFile = os.path.join(os.path.dirname(filename), dataFile)
+        offset = int(header.get("HeaderSize", 0))
+    dtype = np.dtype(metaElementTypes[header["ElementType"]])
+    if header.get("BinaryDataByteOrderMSB", header.get("ElementByteOrderMSB", "False")) == "True":
+        dtype = dtype.newbyteorder(">")
+    else:
+        dtype = dtype.newbyteorder("<")
+    shape = tuple(reversed(dimSize))
+    if offset == -1:  # Data at the end of the file
+        offset = os.path.getsize(dataFile) - int(np.prod(shape))*dtype.itemsize
+    array = np.memmap(dataFile, dtype=dtype, mode="r", offset=offset, shape=shape)
+    return (array, spacing, origin)
+
+# -----------------------------------------------------------------------------
+def image_projection_file(filename, axis=0, mean=False, operation="sum", dtype=np.float64, percentile=50.0, chunkSize=64*1024*1024):
+    #Same as image_projection for an image file. An uncompressed .mhd/.raw (or .mha) image is memory mapped and
+    #projected by chunks of about chunkSize bytes along the slowest axis, so the image is never fully in memory
+    if mean:
+        operation = "mean"
+    axes = np.atleast_1d(axis).tolist()
+    mappedImage = read_mhd_memmap(filename)
+    if mappedImage is None:
+        return image_projection(itk.imread(filename), axes, operation=operation, dtype=dtype, percentile=percentile)
+    array, spacing, origin = mappedImage
+    numpyAxes = [array.ndim - 1 - axis for axis in axes]
+    #Chunks along the slowest axis. The percentile cannot be computed by chunks along a projected axis, so the
+    #chunks are along the slowest kept axis instead
+    chunkAxis = 0
+    if operation == "percentile" and 0 in numpyAxes:
+        chunkAxis = min([axis for axis in range(array.ndim) if not axis in numpyAxes])
+    nbSlices = max(1, int(chunkSize // max(1, array.nbytes // array.shape[chunkAxis])))
+    if not chunkAxis in numpyAxes:
+        #The chunks give slabs of the projection
+        slabs = []
+        for start in range(0, array.shape[chunkAxis], nbSlices):
+            chunk = array[(slice(None),)*chunkAxis + (slice(start, start + nbSlices),)]
+            slabs += [projection_array(chunk, axes, operation, dtype, percentile)]
+        outputAxis = chunkAxis - len([axis for axis in numpyAxes if axis < chunkAxis])
+        projectedArray = np.concatenate(slabs, axis=outputAxis)
+    else:
+        #The projections of the chunks are combined
+        chunkOperation = "sum" if operation == "mean" else operation
+        combine = {"sum": np.add, "max": np.maximum, "mip": np.maximum, "min": np.minimum}[chunkOperation]
+        projectedArray = None
+        for start in range(0, array.shape[0], nbSlices):
+            chunkProjection = projection_array(array[start:start + nbSlices], axes, chunkOperation, dtype, percentile)
+            if projectedArray is None:
+                projectedArray = chunkProjection
+            else:
+                combine(projectedArray, chunkProjection, out=projectedArray)
+        if operation == "mean":
+            projectedArray = projectedArray / np.prod([array.shape[axis] for axis in numpyAxes])
+    return projection_image(projectedArray, spacing, origin, axes)
+
 # -----------------------------------------------------------------------------
 if __name__ == '__main__':
     image_projection_click()
 
 # -----------------------------------------------------------------------------
 import unittest
+import tempfile
+import shutil
 import os
 
 def createImageExample():
@@ -107,3 +238,38 @@ class Test_Image_Projection(unittest.TestCase):
         outputArray = itk.array_view_from_image(output)
         self.assertTrue(outputArray[6, 10] == 6)
 
+    def test_image_projection_operations(self):
+        image = createImageExample()
+        array = itk.array_view_from_image(image)
+        output = image_projection(image, 1, operation="max", dtype=np.float32)
+        self.assertTrue(itk.array_view_from_image(output).dtype == np.float32)
+        self.assertTrue(np.array_equal(itk.array_view_from_image(output), array.max(axis=1)))
+        output = image_projection(image, 1, operation="percentile", percentile=30)
+        self.assertTrue(np.allclose(itk.array_view_from_image(output), np.percentile(array, 30, axis=1)))
+        output = image_projection(image, 2, operation="sum", dtype=np.int64)
+        self.assertTrue(np.array_equal(itk.array_view_from_image(output), array.sum(axis=0)))
+        output = image_projection(image, [0, 2], operation="mean")
+        self.assertTrue(np.allclose(itk.array_view_from_image(output), array.mean(axis=(0, 2))))
+        self.assertTrue(output.GetSpacing()[0] == 2)
+        self.assertTrue(output.GetOrigin()[0] == 12.4)
+        self.assertTrue(output.GetLargestPossibleRegion().GetSize()[0] == 23)
+        image2D = itk.image_from_array(np.float32(array[:, :, 3]))
+        image2D.SetSpacing([1.1, 2])
+        output = image_projection(image2D, 0)
+        self.assertTrue(np.allclose(itk.array_view_from_image(output), array[:, :, 3].sum(axis=1)))
+        self.assertTrue(output.GetSpacing()[0] == 2)
+
+    def test_image_projection_file(self):
+        tmpdirpath = tempfile.mkdtemp()
+        image = createImageExample()
+        itk.imwrite(image, os.path.join(tmpdirpath, "image.mhd"))
+        for axis in [0, 1, 2, [0, 2], [1, 2]]:
+            for operation in ["sum", "mean", "max", "percentile"]:
+                output = image_projection(image, axis, operation=operation)
+                #Chunks of 2 slices
+                outputFile = image_projection_file(os.path.join(tmpdirpath, "image.mhd"), axis, operation=operation, chunkSize=2*23*15*2)
+                self.assertTrue(np.allclose(itk.array_view_from_image(output), itk.array_view_from_image(outputFile)))
+                for i in range(output.GetImageDimension()):
+                    self.assertTrue(output.GetSpacing()[i] == outputFile.GetSpacing()[i])
+                    self.assertTrue(output.GetOrigin()[i] == outputFile.GetOrigin()[i])
+        shutil.rmtree(tmpdirpath)
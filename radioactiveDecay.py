@@ -3,12 +3,35 @@
 import click
 import math
 import datetime
+import functools
+import csv
+import sys
+import numpy as np
+try:
+  import pandas
+except ImportError:
+  pandas = None
 
+#Radionuclide data: half life in sec and branching ratios of the main emissions (gamma energy in keV, or beta)
+nuclideTable = {
+    "Tc99m": {"halfLife": 21624.12, "branchingRatios": {"gamma140.5": 0.885}},
+    "Y90": {"halfLife": 230549.76, "branchingRatios": {"beta-": 1.0}},
+    "Lu177": {"halfLife": 574300.8, "branchingRatios": {"beta-": 1.0, "gamma112.9": 0.0620, "gamma208.4": 0.1036}},
+    "Ga68": {"halfLife": 4069.8, "branchingRatios": {"beta+": 0.889}},
+    "In111": {"halfLife": 242343.36, "branchingRatios": {"gamma171.3": 0.9066, "gamma245.4": 0.9409}},
+}
+nuclideNames = sorted(nuclideTable.keys())
+nuclideHalfLives = np.array([nuclideTable[name]["halfLife"] for name in nuclideNames])
+
+@functools.lru_cache(maxsize=4096)
 def date2datetime(text):
     #available date format:
-    #"dd/mm/yyyy hh:mm" or "hh:mm"
+    #"dd/mm/yyyy hh:mm", "dd/mm/yy hh:mm" or "hh:mm"
     if '/' in text:
-        date_object = datetime.datetime.strptime(text, '%d/%m/%y %H:%M')
+        if len(text.split()[0].split('/')[-1]) == 4:
+            date_object = datetime.datetime.strptime(text, '%d/%m/%Y %H:%M')
+        else:
+            date_object = datetime.datetime.strptime(text, '%d/%m/%y %H:%M')
     else:
         date_object = datetime.datetime.strptime(text, '%H:%M')
     return date_object
@@ -22,8 +45,10 @@ CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 @click.option('-i', '--injection', type=str, help='Injection date, format: "dd/mm/yyyy hh:mm" or "hh:mm"')
 @click.option('-j', '--acquisition', type=str, help='Acquisition date, format: "dd/mm/yyyy hh:mm" or "hh:mm"')
 @click.option('-t', '--timegap', type=str, help='Time gap betwee injection and acquisition dates, format: "dd/mm/yyyy hh:mm", "hh:mm" or "ssssssss"')
+@click.option('-b', '--batch', type=click.Path(dir_okay=False, exists=True), help='Table (.csv or .parquet) of records with the columns radionuclide, activity and injection/acquisition or timegap')
+@click.option('-o', '--output', type=click.Path(dir_okay=False), help='Output table of the batch, with the new column decayedActivity')
 
-def radioactiveDecay_click(radionuclide, activity, injection, acquisition, timegap):
+def radioactiveDecay_click(radionuclide, activity, injection, acquisition, timegap, batch, output):
     """
     \b
     Compute the activity of the radionuclide at the acquisition date (or if not set, considering the gap time in day or second format)
@@ -33,24 +58,28 @@ def radioactiveDecay_click(radionuclide, activity, injection, acquisition, timeg
      - Lu177
      - Ga68
      - In111
+    \b
+    With --batch, the activities of all the records of the table are computed at once and written in the output table
     """
-    
+
+    if batch is not None:
+        if output is None:
+            print("The output table of the batch is not set")
+            sys.exit(1)
+        radioactiveDecay_table(batch, output)
+        return
     output = radioactiveDecay(radionuclide, activity, injection, acquisition, timegap)
     print("New activity: ")
     print(output)
 
+def halfLife(radionuclide):
+    if not radionuclide in nuclideTable:
+        print("Unknown radionuclide: " + str(radionuclide) + " (available: " + ", ".join(nuclideNames) + ")")
+        sys.exit(1)
+    return nuclideTable[radionuclide]["halfLife"]
+
 def radioactiveDecay(radionuclide, activity, injection, acquisition, timegap):
-    halftime = 1.0 #in sec
-    if radionuclide == "Tc99m":
-        halftime = 21624.12
-    elif radionuclide == "Y90":
-        halftime = 230549.76
-    elif radionuclide == "Lu177":
-        halftime = 574300.8
-    elif radionuclide == "Ga68":
-        halftime = 4069.8
-    elif radionuclide == "In111":
-        halftime = 242343.36
+    halftime = halfLife(radionuclide) #in sec
 
     deltaTime = 0 #in sec
     if acquisition != None and injection != None:
@@ -64,14 +93,196 @@ def radioactiveDecay(radionuclide, activity, injection, acquisition, timegap):
     output = activity*math.exp(-deltaTime*math.log(2)/halftime)
     return output
 
+def halfLives(radionuclides):
+    #Half lives (sec) of an array of radionuclide names
+    radionuclides = np.asarray(radionuclides, dtype=str)
+    indices = np.searchsorted(nuclideNames, radionuclides)
+    indices = np.minimum(indices, len(nuclideNames) - 1)
+    unknown = np.asarray(nuclideNames)[indices] != radionuclides
+    if np.any(unknown):
+        halfLife(radionuclides[unknown].flat[0])
+    return nuclideHalfLives[indices]
+
+def isoDate(text):
+    #ISO format of a date (see date2datetime, or already ISO: "yyyy-mm-dd hh:mm[:ss]"), without strptime
+    if '-' in text:
+        return text.replace(' ', 'T')
+    if '/' in text:
+        date, time = text.split()
+        day, month, year = date.split('/')
+        if len(year) == 2:
+            #Same century as strptime %y
+            year = ("20" if int(year) < 69 else "19") + year
+    else:
+        time = text
+        day, month, year = "1", "1", "1900"
+    hour, minute = time.split(':')
+    return year + "-" + month.zfill(2) + "-" + day.zfill(2) + "T" + hour.zfill(2) + ":" + minute.zfill(2)
+
+def isNumber(text):
+    try:
+        float(text)
+        return True
+    except ValueError:
+        return False
+
+epoch = np.datetime64("1970-01-01T00:00:00", "s")
+
+def datetimes2seconds(dates):
+    #Seconds of a datetime64 array from 01/01/1970 0:00, nan for NaT
+    seconds = (dates.astype("datetime64[s]") - epoch).astype(float)
+    seconds[np.isnat(dates)] = np.nan
+    return seconds
+
+def dates2seconds(dates):
+    #Seconds of an array of dates from 01/01/1970 0:00, nan for the empty dates. The dates are datetime64, numbers
+    #(seconds from 01/01/1970, eg: Unix timestamps) or strings (see date2datetime, ISO format or numbers).
+    #Each different date string is converted once
+    dates = np.asarray(dates)
+    if dates.dtype.kind == "M":
+        return datetimes2seconds(dates)
+    if dates.dtype.kind in "iuf":
+        return dates.astype(float)
+    if dates.dtype.kind == "O":
+        #Python or pandas datetimes, numbers or strings
+        return np.array([np.nan if date is None or (isinstance(date, float) and np.isnan(date))
+                         else float(date) if isinstance(date, (int, float, np.number))
+                         else dates2seconds(np.array([str(date)])).item() if isinstance(date, str)
+                         else datetimes2seconds(np.array([np.datetime64(date, "s")])).item() for date in dates.ravel().tolist()], dtype=float).reshape(dates.shape)
+    texts = dates.astype(str)
+    uniqueTexts, inverse = np.unique(texts, return_inverse=True)
+    uniqueTexts = [text.strip() for text in uniqueTexts.tolist()]
+    empty = np.array([text == "" for text in uniqueTexts], dtype=bool)
+    number = np.array([text != "" and not ':' in text and isNumber(text) for text in uniqueTexts], dtype=bool)
+    isoDates = np.array([isoDate(text) if not (isEmpty or isNum) else "1970-01-01T00:00" for text, isEmpty, isNum in zip(uniqueTexts, empty, number)], dtype="datetime64[s]")
+    seconds = datetimes2seconds(isoDates)
+    seconds[number] = [float(text) for text, isNum in zip(uniqueTexts, number) if isNum]
+    seconds[empty] = np.nan
+    return seconds[inverse].reshape(texts.shape)
+
+def timegaps2seconds(timegaps):
+    #Seconds of an array of time gaps (timedelta64, numbers in second or strings "hh:mm" or "ssssssss"), nan for the
+    #empty time gaps
+    timegaps = np.asarray(timegaps)
+    if timegaps.dtype.kind == "m":
+        seconds = timegaps.astype("timedelta64[s]").astype(float)
+        seconds[np.isnat(timegaps)] = np.nan
+        return seconds
+    if timegaps.dtype.kind in "iuf":
+        return timegaps.astype(float)
+    texts = np.array(["" if text is None else str(text) for text in timegaps.ravel().tolist()], dtype=str).reshape(timegaps.shape)
+    uniqueTexts, inverse = np.unique(texts, return_inverse=True)
+    seconds = np.array([np.nan if text.strip() == "" or text.strip() == "nan" else (date2datetime(text) - date2datetime("0:0")).total_seconds() if ':' in text else float(text) for text in uniqueTexts.tolist()], dtype=float)
+    return seconds[inverse].reshape(texts.shape)
+
+def radioactiveDecay_array(radionuclide, activity, injection=None, acquisition=None, timegap=None):
+    #Vectorized radioactiveDecay: the parameters are arrays (or scalars) of the records. For each record, the time
+    #between the injection and the acquisition is used if both are set (not empty), else the time gap, else 0
+    activity = np.asarray(activity, dtype=float)
+    halftime = halfLives(radionuclide)
+    deltaTime = np.full(np.broadcast(activity, halftime).shape, np.nan)
+    if injection is not None and acquisition is not None:
+        deltaTime[...] = dates2seconds(acquisition) - dates2seconds(injection)
+    if timegap is not None:
+        deltaTime = np.where(np.isnan(deltaTime), timegaps2seconds(timegap), deltaTime)
+    deltaTime = np.where(np.isnan(deltaTime), 0.0, deltaTime)
+    return activity*np.exp(-deltaTime*np.log(2)/halftime)
+
+def readTable(filename):
+    #Dict of the columns (numpy arrays of str) of a .csv or .parquet table
+    if filename.endswith(".parquet"):
+        if pandas is None:
+            print("pandas is needed to read parquet files")
+            sys.exit(1)
+        table = pandas.read_parquet(filename)
+        columns = {}
+        for column in table.columns:
+            if isinstance(table[column].dtype, pandas.DatetimeTZDtype):
+                columns[column] = table[column].dt.tz_convert("UTC").dt.tz_localize(None).to_numpy()
+            elif table[column].dtype.kind in "mM":
+                #Dates and durations are kept as datetime64 and timedelta64, with NaT for the missing values
+                columns[column] = table[column].to_numpy()
+            else:
+                columns[column] = table[column].fillna("").astype(str).to_numpy()
+        return columns
+    with open(filename, newline='') as f:
+        rows = list(csv.reader(f))
+    columns = np.array(rows[1:], dtype=str).reshape(len(rows) - 1, len(rows[0]))
+    return dict([(column, columns[:, index]) for index, column in enumerate(rows[0])])
+
+def writeTable(table, filename):
+    if filename.endswith(".parquet"):
+        if pandas is None:
+            print("pandas is needed to write parquet files")
+            sys.exit(1)
+        pandas.DataFrame(table).to_parquet(filename)
+        return
+    with open(filename, "w", newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(list(table.keys()))
+        writer.writerows(zip(*[np.asarray(column).tolist() for column in table.values()]))
+
+def radioactiveDecay_table(filename, output):
+    table = readTable(filename)
+    for column in ["radionuclide", "activity"]:
+        if not column in table:
+            print("No column " + column + " in " + filename)
+            sys.exit(1)
+    table["decayedActivity"] = radioactiveDecay_array(table["radionuclide"], table["activity"].astype(float), table.get("injection"), table.get("acquisition"), table.get("timegap"))
+    writeTable(table, output)
+    return table
+
 
 if __name__ == '__main__':
     radioactiveDecay_click()
 
 # -----------------------------------------------------------------------------
 import unittest
+import tempfile
+import shutil
+import os
 
 class Test_RadioactiveDecay(unittest.TestCase):
     def test_adioactivedecay(self):
         output = radioactiveDecay("Tc99m", 1, "10:00", "11:00", None)
         self.assertTrue(output == 0.89101352540955)
+    def test_radioactivedecay_array(self):
+        output = radioactiveDecay_array(["Tc99m", "Lu177", "Tc99m", "Ga68"], [1, 2, 3, 4], ["10:00", "01/02/21 10:00", "", ""], ["11:00", "03/02/2021 10:00", "", ""], ["", "", "1:00", "3600"])
+        expected = [radioactiveDecay("Tc99m", 1, "10:00", "11:00", None), radioactiveDecay("Lu177", 2, "01/02/21 10:00", "03/02/21 10:00", None),
+                    radioactiveDecay("Tc99m", 3, None, None, "1:00"), radioactiveDecay("Ga68", 4, None, None, "3600")]
+        self.assertTrue(np.allclose(output, expected, rtol=1e-12))
+    def test_radioactivedecay_array_dates(self):
+        expected = radioactiveDecay_array(["Lu177", "Lu177", "Lu177"], [1, 2, 3], ["01/02/21 10:00", "2021-02-01 10:00:00", ""], ["03/02/2021 10:00", "2021-02-04 10:30:00", ""], ["", "", "3600"])
+        injection = np.array(["2021-02-01T10:00", "2021-02-01T10:00", "NaT"], dtype="datetime64[ns]")
+        acquisition = np.array(["2021-02-03T10:00", "2021-02-04T10:30", "NaT"], dtype="datetime64[ns]")
+        output = radioactiveDecay_array(["Lu177", "Lu177", "Lu177"], [1, 2, 3], injection, acquisition, np.array([np.nan, np.nan, 3600]))
+        self.assertTrue(np.allclose(output, expected, rtol=1e-12))
+        #Unix timestamps
+        timestamps = lambda dates: np.where(np.isnat(dates), np.nan, (dates.astype("datetime64[s]") - np.datetime64("1970-01-01T00:00:00", "s")).astype(float))
+        output = radioactiveDecay_array(["Lu177", "Lu177", "Lu177"], [1, 2, 3], timestamps(injection), timestamps(acquisition).astype(str), [0, 0, 3600])
+        self.assertTrue(np.allclose(output, expected, rtol=1e-12))
+    @unittest.skipIf(pandas is None, "pandas is needed for parquet tables")
+    def test_radioactivedecay_table_parquet(self):
+        tmpdirpath = tempfile.mkdtemp()
+        table = pandas.DataFrame({"patient": ["p1", "p2"], "radionuclide": ["Lu177", "Tc99m"], "activity": [7400.0, 1.0],
+                                  "injection": pandas.to_datetime(["2021-02-01 10:00", "2021-02-01 10:00"]),
+                                  "acquisition": pandas.to_datetime(["2021-02-02 10:00", "2021-02-01 11:00"])})
+        table.to_parquet(os.path.join(tmpdirpath, "records.parquet"))
+        radioactiveDecay_table(os.path.join(tmpdirpath, "records.parquet"), os.path.join(tmpdirpath, "output.parquet"))
+        output = pandas.read_parquet(os.path.join(tmpdirpath, "output.parquet"))
+        self.assertTrue(np.isclose(output["decayedActivity"][0], 7400*np.exp(-np.log(2)/6.647)))
+        self.assertTrue(np.isclose(output["decayedActivity"][1], 0.89101352540955))
+        self.assertTrue(output["injection"].dtype.kind == "M")
+        shutil.rmtree(tmpdirpath)
+    def test_radioactivedecay_table(self):
+        tmpdirpath = tempfile.mkdtemp()
+        with open(os.path.join(tmpdirpath, "records.csv"), "w") as f:
+            f.write("patient,radionuclide,activity,injection,acquisition\n")
+            f.write("p1,Lu177,7400,01/02/21 10:00,02/02/21 10:00\n")
+            f.write("p2,Tc99m,1,10:00,11:00\n")
+        radioactiveDecay_table(os.path.join(tmpdirpath, "records.csv"), os.path.join(tmpdirpath, "output.csv"))
+        table = readTable(os.path.join(tmpdirpath, "output.csv"))
+        self.assertTrue(table["patient"].tolist() == ["p1", "p2"])
+        self.assertTrue(np.isclose(float(table["decayedActivity"][0]), 7400*np.exp(-np.log(2)/6.647)))
+        self.assertTrue(np.isclose(float(table["decayedActivity"][1]), 0.89101352540955))
+        shutil.rmtree(tmpdirpath)
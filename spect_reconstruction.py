@@ -5,78 +5,302 @@ import itk
 from itk import RTK as rtk
 import gatetools as gt
 import numpy as np
+import hashlib
+import os
+import sys
+import tempfile
+import time
+import csv
 
 # ------------------------------------------------------------------------------
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 
 
 @click.command(context_settings=CONTEXT_SETTINGS)
-@click.option('--input', '-i', 'input_image', help='Input mhd projection file')
-@click.option('--output', '-o', 'output_image', help='Output mhd of the reconstructed image')
+@click.option('--input', '-i', 'input_image', help='Input mhd projection file (repeat the option to reconstruct several projection sets with the same geometry and attenuation map)', multiple=True)
+@click.option('--output', '-o', 'output_image', help='Output mhd of the reconstructed image (one for each input, in the same order)', multiple=True)
 @click.option('--geom', 'geometry_file', help='Geometry file')
 @click.option('--map', 'attenuation_map', help='Attenuation map file')
 @click.option('--it', 'nb_iteration', help='Number of iterations for the OSEM algorithm')
 @click.option('--sub', 'nb_subset', help='Number of dimensions for the OSEM algorithm')
 @click.option('--rotation', type=click.Choice(['GE', 'Gate', 'None']), default='None')
 @click.option('--scaling_factor', 'scaling_factor', default=10000, help='Scaling factor for the GE attenuation map')
+@click.option('--initial', 'initial_image', help='Previous reconstruction used as initial volume (default: constant 1)')
+@click.option('--checkpoint', 'checkpoint_folder', help='Checkpoint folder: the volume is written every checkpoint_step iterations and the reconstruction resumes from the last checkpoint')
+@click.option('--checkpoint_step', 'checkpoint_step', default=0, help='Number of iterations between 2 checkpoints (default: only the last iteration)')
+@click.option('--criterion', type=click.Choice(['change', 'likelihood', 'roi', 'None']), default='None',
+              help='Stop before --it iterations when the relative change of the volume, of the log-likelihood or of the mean in the ROI is below the tolerance')
+@click.option('--tolerance', 'tolerance', default=0.001, help='Tolerance of the stopping criterion')
+@click.option('--roi', 'roi_image', help='ROI mask (in the frame of the output) for the roi criterion and metrics')
+@click.option('--report', 'report_file', help='Output csv file with the time and the metrics of each iteration')
 def spect_reconstruction_click(input_image, output_image, geometry_file, attenuation_map, nb_iteration,
-                               nb_subset, rotation, scaling_factor):
+                               nb_subset, rotation, scaling_factor, initial_image, checkpoint_folder, checkpoint_step,
+                               criterion, tolerance, roi_image, report_file):
     '''
     Compute a reconstruction using rtk OSEM algorithm
+
+    With --checkpoint, a reconstruction with the same projections, geometry, attenuation map, subsets and initial volume
+    resumes from the checkpoint with the most iterations (not more than --it), so increasing --it only computes the
+    extra iterations and an interrupted reconstruction restarts from its last checkpoint.
+
+    With --criterion, the metrics are computed after each iteration and the reconstruction stops as soon as the
+    criterion is below the tolerance. The likelihood criterion needs a forward projection by iteration.
+
+    The geometry and the attenuation map are read once for all the inputs.
     '''
-    image = itk.imread(input_image, itk.F)
-    res = spect_reconstruction(image, geometry_file, attenuation_map, int(nb_iteration), int(nb_subset),
-                               rotation, float(scaling_factor))
-    itk.imwrite(res, output_image)
+    if len(input_image) != len(output_image):
+        print('The number of inputs (' + str(len(input_image)) + ') is not the number of outputs (' + str(len(output_image)) + ')')
+        sys.exit(1)
+    if initial_image is not None:
+        initial_image = itk.imread(initial_image, itk.F)
+    if roi_image is not None:
+        roi_image = itk.imread(roi_image, itk.F)
+    report = None
+    if report_file is not None:
+        report = []
+    session = SpectReconstructionSession(geometry_file, attenuation_map, rotation, float(scaling_factor))
+    for input_filename, output_filename in zip(input_image, output_image):
+        image = itk.imread(input_filename, itk.F)
+        image_report = None if report is None else []
+        res = session.reconstruct(image, int(nb_iteration), int(nb_subset), initial_image, checkpoint_folder,
+                                  int(checkpoint_step), None if criterion == 'None' else criterion, float(tolerance),
+                                  roi_image, image_report)
+        itk.imwrite(res, output_filename)
+        if report is not None:
+            report += [dict(record, input=input_filename) for record in image_report]
+    if report_file is not None:
+        write_report(report, report_file)
 
 
 def spect_reconstruction(image, geometry_file, attenuation_map, nb_iteration, nb_subset,
-                         rotation, scaling_factor):
-    att_map = itk.imread(attenuation_map, itk.F)
-    if rotation == 'GE':
-        matrix = np.array([[1.0, 0, 0, 0], [0, 0, 1.0, 0], [0, -1.0, 0, 0], [0, 0, 0, 1.0]], dtype=float)
-        matrix = itk.matrix_from_array(matrix)
-        att_map = gt.applyTransformation(input=att_map, matrix=matrix, force_resample=False)
-        att_map = gt.image_divide([att_map, scaling_factor])
-    elif rotation == 'Gate':
-        matrix = np.array([[1.0, 0, 0, 0], [0, 0, -1.0, 0], [0, -1.0, 0, 0], [0, 0, 0, 1.0]])
-        matrix = itk.matrix_from_array(matrix)
-        att_map = gt.applyTransformation(input=att_map, matrix=matrix, force_resample=True)
-
-    nb_projection = itk.array_from_image(image).shape[0]
-    geometryReader = rtk.ThreeDCircularProjectionGeometryXMLFileReader.New()
-    geometryReader.SetFilename(geometry_file)
-    geometryReader.GenerateOutputInformation()
-    geometry = geometryReader.GetOutputObject()
-    Dimension = 3
-    pixelType = itk.F
-    CPUImageType = itk.Image[pixelType, Dimension]
-    OSEMType = rtk.OSEMConeBeamReconstructionFilter[CPUImageType, CPUImageType]
-    imageReference = itk.imread(attenuation_map)
-    volume_source = rtk.ConstantImageSource[CPUImageType].New()
-    volume_source.SetInformationFromImage(imageReference)
-    volume_source.SetConstant(1.)
-    volume_source.Update()
-
-    osem = OSEMType.New()
-    osem.SetInput(0, volume_source)
-    osem.SetInput(1, image)
-    osem.SetInput(2, att_map)
-    osem.SetNumberOfIterations(nb_iteration)
-    osem.SetNumberOfProjectionsPerSubset(int(nb_projection / nb_subset))
-    osem.SetBackProjectionFilter(6)
-    osem.SetForwardProjectionFilter(4)
-    osem.SetGeometry(geometry)
-    osem.Update()
-    reconstruction = osem.GetOutput()
-
-    if rotation == 'GE':
-        matrix_inv = np.array([[1, 0, 0, 0], [0, 0, -1, 0], [0, 1, 0, 0], [0, 0, 0, 1]], dtype=float)
-        matrix_inv = itk.matrix_from_array(matrix_inv)
-        reconstruction = gt.applyTransformation(
-            input=reconstruction, matrix=matrix_inv, force_resample=True)
-
-    return reconstruction
+                         rotation, scaling_factor, initial_image=None, checkpoint_folder=None, checkpoint_step=0,
+                         criterion=None, tolerance=0.001, roi=None, report=None):
+    # criterion: None, 'change', 'likelihood' or 'roi' to stop when its relative change is below the tolerance
+    # report: list where the record (dict) of the time and metrics of each iteration is appended
+    session = SpectReconstructionSession(geometry_file, attenuation_map, rotation, scaling_factor)
+    return session.reconstruct(image, nb_iteration, nb_subset, initial_image, checkpoint_folder, checkpoint_step,
+                               criterion, tolerance, roi, report)
+
+
+class SpectReconstructionSession:
+    '''
+    Geometry and attenuation map read, oriented and scaled once, to reconstruct several projection sets (energy
+    windows, bed positions, time points) with the same geometry and attenuation map
+    '''
+
+    def __init__(self, geometry_file, attenuation_map, rotation=None, scaling_factor=10000):
+        self.rotation = rotation
+        self.image_type = itk.Image[itk.F, 3]
+        self.image_reference = itk.imread(attenuation_map, itk.F)
+        att_map = self.image_reference
+        if rotation == 'GE':
+            matrix = np.array([[1.0, 0, 0, 0], [0, 0, 1.0, 0], [0, -1.0, 0, 0], [0, 0, 0, 1.0]], dtype=float)
+            matrix = itk.matrix_from_array(matrix)
+            att_map = gt.applyTransformation(input=att_map, matrix=matrix, force_resample=False)
+            att_map = gt.image_divide([att_map, scaling_factor])
+        elif rotation == 'Gate':
+            matrix = np.array([[1.0, 0, 0, 0], [0, 0, -1.0, 0], [0, -1.0, 0, 0], [0, 0, 0, 1.0]])
+            matrix = itk.matrix_from_array(matrix)
+            att_map = gt.applyTransformation(input=att_map, matrix=matrix, force_resample=True)
+        self.att_map = att_map
+
+        geometryReader = rtk.ThreeDCircularProjectionGeometryXMLFileReader.New()
+        geometryReader.SetFilename(geometry_file)
+        geometryReader.GenerateOutputInformation()
+        self.geometry = geometryReader.GetOutputObject()
+
+        volume_source = rtk.ConstantImageSource[self.image_type].New()
+        volume_source.SetInformationFromImage(self.image_reference)
+        volume_source.SetConstant(1.)
+        volume_source.Update()
+        self.constant_volume = volume_source.GetOutput()
+
+        # Forward projector of the log-likelihood, kept between the iterations and the reconstructions
+        self.projection_source = rtk.ConstantImageSource[self.image_type].New()
+        self.projection_source.SetConstant(0.)
+        self.forward = rtk.ZengForwardProjectionImageFilter[self.image_type, self.image_type].New()
+        self.forward.SetInput(0, self.projection_source.GetOutput())
+        self.forward.SetInput(2, self.att_map)
+        self.forward.SetGeometry(self.geometry)
+
+        # Checkpoints are only shared by the reconstructions of the same inputs
+        self.key = hashlib.sha1()
+        self.key.update(str((rotation, scaling_factor)).encode())
+        for filename in [geometry_file, attenuation_map]:
+            with open(filename, 'rb') as f:
+                self.key.update(f.read())
+
+    def reconstruct(self, image, nb_iteration, nb_subset, initial_image=None, checkpoint_folder=None,
+                    checkpoint_step=0, criterion=None, tolerance=0.001, roi=None, report=None):
+        # See spect_reconstruction
+        nb_projection = itk.array_view_from_image(image).shape[0]
+        OSEMType = rtk.OSEMConeBeamReconstructionFilter[self.image_type, self.image_type]
+        if initial_image is None:
+            volume = self.constant_volume
+        else:
+            volume = self.osem_frame(initial_image)
+        roi_mask = None
+        if roi is not None:
+            roi_mask = itk.array_from_image(self.osem_frame(roi)) > 0.5
+            if not roi_mask.any():
+                print('The ROI mask is empty in the reconstructed volume')
+                sys.exit(1)
+        elif criterion == 'roi':
+            print('The roi criterion needs a ROI mask')
+            sys.exit(1)
+        metric_name = {None: None, 'change': 'change', 'likelihood': 'likelihood_change', 'roi': 'roi_change'}[criterion]
+        with_metrics = criterion is not None or report is not None
+        likelihood = None
+        if criterion == 'likelihood':
+            likelihood = lambda volume: self.log_likelihood(volume, image)
+        previous_record = None
+
+        # Resume from the last checkpoint
+        done_iteration = 0
+        if checkpoint_folder is not None:
+            checkpoint_folder = os.path.join(checkpoint_folder, checkpoint_key(image, self.key, nb_subset, initial_image))
+            done_iteration, checkpoint = last_checkpoint(checkpoint_folder, nb_iteration)
+            if checkpoint is not None:
+                volume = itk.imread(checkpoint, itk.F)
+
+        # The OSEM iterations only depend on the current volume, so they are run by blocks up to each checkpoint, or
+        # one by one with the metrics (with a new filter for each block: an updated OSEM filter does not restart from
+        # new input images)
+        while done_iteration < nb_iteration:
+            step = nb_iteration - done_iteration
+            if with_metrics:
+                step = 1
+            elif checkpoint_folder is not None and checkpoint_step > 0:
+                step = min(step, checkpoint_step - done_iteration % checkpoint_step)
+            start = time.time()
+            osem = OSEMType.New()
+            osem.SetInput(0, volume)
+            osem.SetInput(1, image)
+            osem.SetInput(2, self.att_map)
+            osem.SetNumberOfIterations(step)
+            osem.SetNumberOfProjectionsPerSubset(int(nb_projection / nb_subset))
+            osem.SetBackProjectionFilter(6)
+            osem.SetForwardProjectionFilter(4)
+            osem.SetGeometry(self.geometry)
+            osem.Update()
+            previous_volume = volume
+            volume = osem.GetOutput()
+            volume.DisconnectPipeline()
+            done_iteration += step
+            converged = False
+            if with_metrics:
+                record = iteration_record(done_iteration, time.time() - start, previous_volume, volume, roi_mask,
+                                          likelihood, previous_record)
+                previous_record = record
+                if report is not None:
+                    report += [record]
+                converged = criterion is not None and record[metric_name] < tolerance
+            if checkpoint_folder is not None and (converged or done_iteration == nb_iteration or
+                                                  (checkpoint_step > 0 and done_iteration % checkpoint_step == 0)):
+                write_checkpoint(volume, checkpoint_folder, done_iteration)
+            if converged:
+                break
+        reconstruction = volume
+
+        if self.rotation == 'GE':
+            matrix_inv = np.array([[1, 0, 0, 0], [0, 0, -1, 0], [0, 1, 0, 0], [0, 0, 0, 1]], dtype=float)
+            matrix_inv = itk.matrix_from_array(matrix_inv)
+            reconstruction = gt.applyTransformation(
+                input=reconstruction, matrix=matrix_inv, force_resample=True)
+
+        return reconstruction
+
+    def osem_frame(self, initial_image):
+        # Image in the frame of the output of the reconstruction (eg: previous reconstruction) in the frame of the OSEM volume
+        initial_image = itk.cast_image_filter(initial_image, ttype=(type(initial_image), self.image_type))
+        if self.rotation == 'GE':
+            matrix = np.array([[1.0, 0, 0, 0], [0, 0, 1.0, 0], [0, -1.0, 0, 0], [0, 0, 0, 1.0]], dtype=float)
+            matrix = itk.matrix_from_array(matrix)
+            return gt.applyTransformation(input=initial_image, like=self.image_reference, matrix=matrix, force_resample=True)
+        if list(initial_image.GetLargestPossibleRegion().GetSize()) != list(self.image_reference.GetLargestPossibleRegion().GetSize()) or \
+                not np.allclose(initial_image.GetSpacing(), self.image_reference.GetSpacing()) or \
+                not np.allclose(initial_image.GetOrigin(), self.image_reference.GetOrigin()):
+            return gt.applyTransformation(input=initial_image, like=self.image_reference, force_resample=True)
+        return initial_image
+
+    def log_likelihood(self, volume, image):
+        # Poisson log-likelihood (without the constant term) of the projections, with the forward projector of the OSEM
+        self.projection_source.SetInformationFromImage(image)
+        self.forward.SetInput(1, volume)
+        self.forward.Update()
+        expected = itk.array_view_from_image(self.forward.GetOutput()).astype(np.float64)
+        measured = itk.array_view_from_image(image).astype(np.float64)
+        positive = expected > 0
+        return float(np.sum(measured[positive] * np.log(expected[positive])) - np.sum(expected))
+
+
+def iteration_record(iteration, osem_time, previous_volume, volume, roi_mask=None, likelihood=None, previous_record=None):
+    # Time and convergence metrics of an iteration, relative to the volume of the previous iteration:
+    # change of the volume (L2 norm), of the mean in the ROI and of the log-likelihood (likelihood function of a volume)
+    start = time.time()
+    previous_array = itk.array_view_from_image(previous_volume)
+    array = itk.array_view_from_image(volume)
+    record = {'iteration': iteration, 'time': osem_time}
+    record['change'] = float(np.linalg.norm(array - previous_array) / max(np.linalg.norm(previous_array), 1e-30))
+    if roi_mask is not None:
+        previous_mean = float(previous_array[roi_mask].mean())
+        record['roi_mean'] = float(array[roi_mask].mean())
+        record['roi_change'] = abs(record['roi_mean'] - previous_mean) / max(abs(previous_mean), 1e-30)
+    if likelihood is not None:
+        if previous_record is not None and 'log_likelihood' in previous_record:
+            previous_likelihood = previous_record['log_likelihood']
+        else:
+            previous_likelihood = likelihood(previous_volume)
+        record['log_likelihood'] = likelihood(volume)
+        record['likelihood_change'] = abs(record['log_likelihood'] - previous_likelihood) / max(abs(previous_likelihood), 1e-30)
+    record['metric_time'] = time.time() - start
+    return record
+
+
+def write_report(report, report_file):
+    with open(report_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['input', 'iteration', 'time', 'metric_time', 'change', 'roi_mean', 'roi_change',
+                                               'log_likelihood', 'likelihood_change'], restval='')
+        writer.writeheader()
+        writer.writerows(report)
+
+
+def checkpoint_key(image, session_key, nb_subset, initial_image=None):
+    # Key of the projections, subsets and initial volume, added to the key of the geometry and attenuation map
+    key = session_key.copy()
+    key.update(np.ascontiguousarray(itk.array_view_from_image(image)).tobytes())
+    key.update(str((list(image.GetSpacing()), list(image.GetOrigin()), nb_subset)).encode())
+    if initial_image is not None:
+        key.update(np.ascontiguousarray(itk.array_view_from_image(initial_image)).tobytes())
+    return key.hexdigest()
+
+
+def last_checkpoint(checkpoint_folder, nb_iteration):
+    # (iteration, filename) of the checkpoint with the most iterations, not more than nb_iteration
+    iterations = []
+    if os.path.isdir(checkpoint_folder):
+        for filename in os.listdir(checkpoint_folder):
+            if filename.startswith('iteration_') and filename.endswith('.mha') and filename[10:-4].isdigit():
+                iterations += [int(filename[10:-4])]
+    iterations = [iteration for iteration in iterations if iteration <= nb_iteration]
+    if len(iterations) == 0:
+        return 0, None
+    return max(iterations), os.path.join(checkpoint_folder, 'iteration_' + str(max(iterations)).zfill(4) + '.mha')
+
+
+def write_checkpoint(volume, checkpoint_folder, iteration):
+    # Written in a temporary file unique to the writer first, so an interrupted job never leaves a truncated checkpoint
+    # and two sessions writing the same iteration never swap their files
+    os.makedirs(checkpoint_folder, exist_ok=True)
+    filename = os.path.join(checkpoint_folder, 'iteration_' + str(iteration).zfill(4) + '.mha')
+    fd, tmp_filename = tempfile.mkstemp(dir=checkpoint_folder, prefix='tmp_', suffix='.mha')
+    os.close(fd)
+    try:
+        itk.imwrite(volume, tmp_filename)
+        os.replace(tmp_filename, filename)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
 
 
 # -----------------------------------------------------------------------------
@@ -89,6 +313,7 @@ import tempfile
 import shutil
 import os
 import wget
+import concurrent.futures
 
 
 class Test_spect_reconstruction_(unittest.TestCase):
@@ -127,3 +352,119 @@ class Test_spect_reconstruction_(unittest.TestCase):
 
 
         shutil.rmtree(tmpdirpath)
+    def test_spect_reconstruction_checkpoint(self):
+        tmpdirpath = tempfile.mkdtemp()
+        image, filenameGeom, filenameMap = synthetic_spect(tmpdirpath)
+        res = spect_reconstruction(image, filenameGeom, filenameMap, 4, 4, None, 10000)
+        res_array = itk.array_from_image(res)
+        # Warm start from 2 iterations
+        res2 = spect_reconstruction(image, filenameGeom, filenameMap, 2, 4, None, 10000)
+        res_warm = spect_reconstruction(image, filenameGeom, filenameMap, 2, 4, None, 10000, initial_image=res2)
+        self.assertTrue(np.allclose(itk.array_from_image(res_warm), res_array))
+        # Checkpoints every iteration, then resume from the 3rd iteration
+        checkpoint_folder = os.path.join(tmpdirpath, 'checkpoint')
+        res3 = spect_reconstruction(image, filenameGeom, filenameMap, 3, 4, None, 10000, checkpoint_folder=checkpoint_folder,
+                                    checkpoint_step=1)
+        key = os.listdir(checkpoint_folder)[0]
+        self.assertTrue(sorted(os.listdir(os.path.join(checkpoint_folder, key))) ==
+                        ['iteration_0001.mha', 'iteration_0002.mha', 'iteration_0003.mha'])
+        self.assertTrue(last_checkpoint(os.path.join(checkpoint_folder, key), 4)[0] == 3)
+        res_resumed = spect_reconstruction(image, filenameGeom, filenameMap, 4, 4, None, 10000,
+                                           checkpoint_folder=checkpoint_folder)
+        self.assertTrue(np.allclose(itk.array_from_image(res_resumed), res_array))
+        self.assertTrue(os.path.exists(os.path.join(checkpoint_folder, key, 'iteration_0004.mha')))
+        # Another number of subsets does not use the checkpoints
+        spect_reconstruction(image, filenameGeom, filenameMap, 1, 2, None, 10000, checkpoint_folder=checkpoint_folder)
+        self.assertTrue(len(os.listdir(checkpoint_folder)) == 2)
+        shutil.rmtree(tmpdirpath)
+
+    def test_spect_reconstruction_criterion(self):
+        tmpdirpath = tempfile.mkdtemp()
+        image, filenameGeom, filenameMap = synthetic_spect(tmpdirpath)
+        # Metrics of each iteration without stopping criterion
+        report = []
+        roi = itk.image_from_array((np.mgrid[0:24, 0:24, 0:24][0] > 12).astype(np.float32))
+        roi.CopyInformation(itk.imread(filenameMap, itk.F))
+        res = spect_reconstruction(image, filenameGeom, filenameMap, 3, 4, None, 10000, roi=roi, report=report)
+        self.assertTrue([record['iteration'] for record in report] == [1, 2, 3])
+        self.assertTrue(all(record['change'] > 0 and record['roi_mean'] > 0 for record in report))
+        self.assertTrue(np.allclose(itk.array_from_image(res),
+                                    itk.array_from_image(spect_reconstruction(image, filenameGeom, filenameMap, 3, 4, None, 10000))))
+        # Stop when the volume changes by less than the change of the 3rd iteration
+        report_change = []
+        res_change = spect_reconstruction(image, filenameGeom, filenameMap, 20, 4, None, 10000, criterion='change',
+                                          tolerance=report[2]['change']*1.0001, report=report_change)
+        self.assertTrue(len(report_change) == 3)
+        self.assertTrue(np.allclose(itk.array_from_image(res_change), itk.array_from_image(res)))
+        # Log-likelihood
+        report_likelihood = []
+        spect_reconstruction(image, filenameGeom, filenameMap, 20, 4, None, 10000, criterion='likelihood', tolerance=1e-3,
+                             report=report_likelihood)
+        self.assertTrue(len(report_likelihood) < 20)
+        self.assertTrue(report_likelihood[-1]['log_likelihood'] > report_likelihood[0]['log_likelihood'])
+        self.assertTrue(report_likelihood[-1]['likelihood_change'] < 1e-3)
+        write_report(report_likelihood, os.path.join(tmpdirpath, 'report.csv'))
+        with open(os.path.join(tmpdirpath, 'report.csv')) as f:
+            self.assertTrue(len(list(csv.DictReader(f))) == len(report_likelihood))
+        shutil.rmtree(tmpdirpath)
+
+    def test_write_checkpoint_concurrent(self):
+        tmpdirpath = tempfile.mkdtemp()
+        volumes = [itk.image_from_array(np.full((20, 30, 40), index, dtype=np.float32)) for index in range(8)]
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            list(executor.map(lambda volume: write_checkpoint(volume, tmpdirpath, 3), volumes*4))
+        self.assertTrue(os.listdir(tmpdirpath) == ['iteration_0003.mha'])
+        self.assertTrue(last_checkpoint(tmpdirpath, 5) == (3, os.path.join(tmpdirpath, 'iteration_0003.mha')))
+        array = itk.array_view_from_image(itk.imread(os.path.join(tmpdirpath, 'iteration_0003.mha')))
+        self.assertTrue(np.all(array == array.flat[0]))
+        shutil.rmtree(tmpdirpath)
+
+    def test_spect_reconstruction_session(self):
+        tmpdirpath = tempfile.mkdtemp()
+        image, filenameGeom, filenameMap = synthetic_spect(tmpdirpath)
+        image2 = itk.image_from_array(itk.array_from_image(image)*2 + 0.5)
+        image2.CopyInformation(image)
+        session = SpectReconstructionSession(filenameGeom, filenameMap, None, 10000)
+        for projections in [image, image2, image]:
+            res = session.reconstruct(projections, 2, 4)
+            expected = spect_reconstruction(projections, filenameGeom, filenameMap, 2, 4, None, 10000)
+            self.assertTrue(np.allclose(itk.array_from_image(res), itk.array_from_image(expected)))
+        # The forward projector is kept between the projection sets
+        volume = session.reconstruct(image, 1, 4)
+        likelihood = session.log_likelihood(volume, image)
+        session.log_likelihood(volume, image2)
+        self.assertTrue(session.log_likelihood(volume, image) == likelihood)
+        shutil.rmtree(tmpdirpath)
+
+
+def synthetic_spect(tmpdirpath):
+    # Projections of a sphere in a uniform attenuation map, with a parallel geometry of 32 projections
+    CPUImageType = itk.Image[itk.F, 3]
+    geometry = rtk.ThreeDCircularProjectionGeometry.New()
+    for index in range(32):
+        geometry.AddProjection(300., 0., index*360./32)
+    filenameGeom = os.path.join(tmpdirpath, 'geom.xml')
+    geometryWriter = rtk.ThreeDCircularProjectionGeometryXMLFileWriter.New()
+    geometryWriter.SetFilename(filenameGeom)
+    geometryWriter.SetObject(geometry)
+    geometryWriter.WriteFile()
+    z, y, x = np.mgrid[0:24, 0:24, 0:24]
+    phantom = itk.image_from_array((((x - 12)**2 + (y - 10)**2 + (z - 13)**2 < 30)*10 + 1).astype(np.float32))
+    phantom.SetSpacing([4, 4, 4])
+    phantom.SetOrigin([-46, -46, -46])
+    att_map = itk.image_from_array(np.full((24, 24, 24), 0.01, dtype=np.float32))
+    att_map.CopyInformation(phantom)
+    filenameMap = os.path.join(tmpdirpath, 'attenuation_map.mha')
+    itk.imwrite(att_map, filenameMap)
+    projection_source = rtk.ConstantImageSource[CPUImageType].New()
+    projection_source.SetOrigin([-46, -46, 0])
+    projection_source.SetSpacing([4, 4, 1])
+    projection_source.SetSize([24, 24, 32])
+    projection_source.SetConstant(0.)
+    forward = rtk.ZengForwardProjectionImageFilter[CPUImageType, CPUImageType].New()
+    forward.SetInput(0, projection_source.GetOutput())
+    forward.SetInput(1, phantom)
+    forward.SetInput(2, att_map)
+    forward.SetGeometry(geometry)
+    forward.Update()
+    return forward.GetOutput(), filenameGeom, filenameMap
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+#   Copyright (C): OpenGATE Collaboration
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE.md for further details
+# -----------------------------------------------------------------------------
+
+import gatetools as gt
+import itk
+import click
+import numpy as np
+import sys
+
+
+# -----------------------------------------------------------------------------
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+@click.command(context_settings=CONTEXT_SETTINGS)
+
+@click.option('--input', '-i', help='Input filename (one per bed position)', required=True, multiple=True,
+                type=click.Path(dir_okay=False))
+@click.option('--dimension', '-d', default=2, help='Dimension for stitching (default 2)')
+@click.option('--pad', '-p', default=0, help='Default value for padding (default 0)')
+@click.option('--blending', '-b', default='max', type=click.Choice(['max', 'linear', 'average']), help='Blending of the FOVs at the junctions (default max)')
+@click.option('--tolerance', '-t', default=1e-3, help='Tolerance (in voxel) to consider the FOVs on the same grid (default 1e-3)')
+@click.option('--output', '-o', help='Output filename', required=True,
+                type=click.Path(dir_okay=False,
+                              writable=True, readable=False,
+                              resolve_path=True, allow_dash=False, path_type=None))
+
+def stitch_images_click(input, dimension, pad, blending, tolerance, output):
+    '''
+    Stitch N FOV images (one -i option per bed position) according their origin and size along the dimension d.
+    The inputs are images readible by ITK (eg: .mhd), usually 3D images from nuclear medecine.
+    The output have the same spacing and origin than the FOV with the littlest origin. The other FOVs are resampled to be stitched along d.
+    The output is the copy of the FOV values, except at the junctions where the FOVs are blended (-b):\n
+     - max: take the maximum value (it avoid 0 values)\n
+     - linear: feathered junction, the weight of each FOV decreases linearly along the junction\n
+     - average: mean of the FOVs covering the slice\n
+    If a FOV is already on the grid of the output (same spacing, direction, size and origin except along d, where the origins differ by an integer number of slices, up to the tolerance -t in voxel), it is copied without resampling.
+
+    eg: stitch_images -i bed1.mhd -i bed2.mhd -i bed3.mhd -o wholeBody.mhd
+
+    unittest:
+       python -m unittest stitch_images
+    '''
+
+    inputImages = [itk.imread(filename) for filename in input]
+    outputImage = stitch_images(inputImages, dimension, pad, blending, tolerance)
+    itk.imwrite(outputImage, output)
+
+# -----------------------------------------------------------------------------
+def slab(ndim, axis, start, stop):
+    #Index of the slices [start, stop[ along the numpy axis
+    index = [slice(None)]*ndim
+    index[axis] = slice(start, stop)
+    return tuple(index)
+
+# -----------------------------------------------------------------------------
+def blend_overlap(outputOverlap, bedOverlap, axis, blending, count):
+    #Blend in place the bed in the output, on the overlap slices only
+    #count is the number of beds already put on each overlap slice
+    if blending == "max":
+        np.maximum(outputOverlap, bedOverlap, out=outputOverlap)
+        return
+    ndim = outputOverlap.ndim
+    nbSlices = outputOverlap.shape[axis]
+    isInteger = np.issubdtype(outputOverlap.dtype, np.integer)
+    #Slice by slice, so the temporaries are one slice large
+    for i in range(nbSlices):
+        outputSlice = outputOverlap[slab(ndim, axis, i, i+1)]
+        bedSlice = bedOverlap[slab(ndim, axis, i, i+1)]
+        if blending == "linear":
+            weight = (i + 0.5)/nbSlices
+            blendedSlice = (1.0 - weight)*outputSlice + weight*bedSlice
+        elif blending == "average":
+            blendedSlice = outputSlice + (bedSlice - outputSlice.astype(float))/(count[i] + 1)
+        else:
+            print("Unknown blending mode " + str(blending))
+            sys.exit(1)
+        if isInteger:
+            np.rint(blendedSlice, out=blendedSlice)
+        outputSlice[...] = blendedSlice
+
+# -----------------------------------------------------------------------------
+def bed_extent(bed, reference, dimension):
+    #Return the first and the last index along dimension of the bed in the reference grid
+    Dimension = reference.GetImageDimension()
+    lowIndex = itk.ContinuousIndex[itk.D, Dimension]()
+    highIndex = itk.ContinuousIndex[itk.D, Dimension]()
+    for i in range(Dimension):
+        lowIndex[i] = -0.5
+        highIndex[i] = bed.GetLargestPossibleRegion().GetSize()[i] -0.5
+    lowIndex = reference.TransformPhysicalPointToIndex(bed.TransformContinuousIndexToPhysicalPoint(lowIndex))
+    highIndex = reference.TransformPhysicalPointToIndex(bed.TransformContinuousIndexToPhysicalPoint(highIndex))
+    return (lowIndex[dimension], highIndex[dimension])
+
+# -----------------------------------------------------------------------------
+def bed_inside_extent(bed, reference, dimension, start, stop):
+    #Return the first and the last index along dimension of the slices [start, stop] of the reference grid with their
+    #centers inside the bed (continuous index in [-0.5, size -0.5[ like the resampling). The other slices of the
+    #resampled bed are only pad
+    Dimension = reference.GetImageDimension()
+    size = bed.GetLargestPossibleRegion().GetSize()[dimension]
+    def inside(slice):
+        index = itk.Index[Dimension]()
+        for i in range(Dimension):
+            index[i] = 0
+        index[dimension] = slice
+        continuousIndex = bed.TransformPhysicalPointToContinuousIndex(reference.TransformIndexToPhysicalPoint(index))
+        return -0.5 <= continuousIndex[dimension] < size -0.5
+    while start <= stop and not inside(start):
+        start += 1
+    while stop >= start and not inside(stop):
+        stop -= 1
+    return (start, stop)
+
+# -----------------------------------------------------------------------------
+def aligned_offset(bed, reference, dimension, tolerance=1e-3):
+    #Return the index along dimension of the first slice of the bed in the reference grid if the bed is on this grid
+    #(same spacing, direction, size and origin except along dimension), None otherwise. tolerance is in voxel
+    Dimension = reference.GetImageDimension()
+    if not (itk.array_from_matrix(bed.GetDirection()) == itk.array_from_matrix(reference.GetDirection())).all():
+        return None
+    for i in range(Dimension):
+        spacing = reference.GetSpacing()[i]
+        size = bed.GetLargestPossibleRegion().GetSize()[i]
+        #The spacing difference accumulated along the bed must stay below the tolerance
+        if abs(bed.GetSpacing()[i] - spacing)*size > tolerance*spacing:
+            return None
+        if i != dimension and (size != reference.GetLargestPossibleRegion().GetSize()[i] or abs(bed.GetOrigin()[i] - reference.GetOrigin()[i]) > tolerance*spacing):
+            return None
+    offset = (bed.GetOrigin()[dimension] - reference.GetOrigin()[dimension])/reference.GetSpacing()[dimension]
+    if abs(offset - round(offset)) > tolerance or round(offset) < 0:
+        return None
+    return int(round(offset))
+
+# -----------------------------------------------------------------------------
+def resample_bed(bed, reference, dimension, start, stop, pad):
+    #Resample the bed on the slices [start, stop] of the reference grid
+    Dimension = reference.GetImageDimension()
+    startIndex = itk.Index[Dimension]()
+    for i in range(Dimension):
+        startIndex[i] = 0
+    startIndex[dimension] = start
+    newOrigin = [0]*Dimension
+    for i in range(Dimension):
+        newOrigin[i] = reference.GetOrigin()[i]
+    newOrigin[dimension] = reference.TransformIndexToPhysicalPoint(startIndex)[dimension]
+    newSize = [0]*Dimension
+    for i in range(Dimension):
+        newSize[i] = reference.GetLargestPossibleRegion().GetSize()[i]
+    newSize[dimension] = stop - start +1
+    return gt.applyTransformation(input=bed, spacinglike=reference, newsize=newSize, neworigin=newOrigin, force_resample=True, pad=pad)
+
+# -----------------------------------------------------------------------------
+def stitch_images(images, dimension=2, pad=0, blending="max", tolerance=1e-3):
+
+    Dimension = images[0].GetImageDimension()
+    for image in images:
+        if image.GetImageDimension() != Dimension:
+            print("Image dimension (" + str(image.GetImageDimension()) + ") and first image dimension (" + str(Dimension) + ") are different")
+            sys.exit(1)
+    PixelType = itk.template(images[0])[1][0]
+
+    #Check negative spacing or non identity direction
+    images = [image if (itk.array_from_matrix(image.GetDirection()) == np.eye(Dimension)).all()
+              else gt.applyTransformation(input=image, force_resample=True, pad=pad) for image in images]
+
+    #Sort the beds along dimension. The first one (the littlest origin) gives the grid of the output
+    beds = sorted(images, key=lambda image: image.GetOrigin()[dimension])
+    reference = beds[0]
+
+    #Compute the slices of each bed in the output, and the size of the output, before any resampling
+    extents = [(0, reference.GetLargestPossibleRegion().GetSize()[dimension] -1)]
+    for bed in beds[1:]:
+        start, stop = bed_extent(bed, reference, dimension)
+        extents.append((max(start, 0), stop))
+    outputSize = itk.Size[Dimension]()
+    for i in range(Dimension):
+        outputSize[i] = reference.GetLargestPossibleRegion().GetSize()[i]
+    outputSize[dimension] = max([stop for start, stop in extents]) +1
+
+    #Create output
+    ImageType = itk.Image[PixelType, Dimension]
+    outputImage = ImageType.New()
+    outputStart = itk.Index[Dimension]()
+    for i in range(Dimension):
+        outputStart[i] = 0
+    outputRegion = itk.ImageRegion[Dimension]()
+    outputRegion.SetSize(outputSize)
+    outputRegion.SetIndex(outputStart)
+    outputImage.SetRegions(outputRegion)
+    outputImage.Allocate()
+    outputImage.FillBuffer(pad)
+    outputImage.SetSpacing(reference.GetSpacing())
+    outputImage.SetDirection(reference.GetDirection())
+    outputImage.SetOrigin(reference.GetOrigin())
+
+    #Resample each bed directly on its slices (or take it as it is if it is already on the output grid) and put it in the output.
+    #Slices not yet covered by a previous bed are copied, the overlap slices are blended
+    outputArrayView = itk.array_view_from_image(outputImage)
+    ndim = outputArrayView.ndim
+    axis = Dimension - 1 - dimension
+    count = np.zeros(outputSize[dimension], dtype=int)
+    coveredEnd = 0
+    for bed, (start, stop) in zip(beds, extents):
+        offset = aligned_offset(bed, reference, dimension, tolerance)
+        if offset is not None:
+            bedImage = bed
+            start = offset
+            stop = min(offset + bed.GetLargestPossibleRegion().GetSize()[dimension], outputSize[dimension]) -1
+        else:
+            bedImage = resample_bed(bed, reference, dimension, start, stop, pad)
+        bedArrayView = itk.array_view_from_image(bedImage)
+        bedStart = start
+        if offset is None:
+            #Only the slices of the resampled bed inside its real extent are blended and counted, not the padded ones
+            start, stop = bed_inside_extent(bed, reference, dimension, start, stop)
+        overlapEnd = min(max(coveredEnd, start), stop +1)
+        if overlapEnd > start:
+            blend_overlap(outputArrayView[slab(ndim, axis, start, overlapEnd)], bedArrayView[slab(ndim, axis, start - bedStart, overlapEnd - bedStart)],
+                          axis, blending, count[start:overlapEnd])
+        outputArrayView[slab(ndim, axis, overlapEnd, stop +1)] = bedArrayView[slab(ndim, axis, overlapEnd - bedStart, stop +1 - bedStart)]
+        count[start:stop +1] += 1
+        coveredEnd = max(coveredEnd, stop +1)
+        del bedArrayView, bedImage
+
+    return outputImage
+
+# -----------------------------------------------------------------------------
+if __name__ == '__main__':
+    stitch_images_click()
+
+
+
+# -----------------------------------------------------------------------------
+import unittest
+
+def createBedExample(origin, size):
+    x = np.arange(0, size[0], 1)
+    y = np.arange(0, size[1], 1)
+    z = np.arange(0, size[2], 1)
+    zz, yy, xx = np.meshgrid(z, y, x, indexing='ij')
+    image = itk.image_from_array(np.float32(xx + 100*yy + 1))
+    image.SetOrigin(origin)
+    image.SetSpacing([2, 2, 2])
+    return image
+
+class Test_Stitch_Images(unittest.TestCase):
+    def test_stitch_images(self):
+        bed1 = createBedExample([7, 3.4, -10], [23, 20, 30])
+        bed2 = createBedExample([7, 3.4, 40], [23, 20, 30])
+        bed3 = createBedExample([7, 3.4, 90], [23, 20, 30])
+        output = stitch_images([bed3, bed1, bed2], dimension=2, pad=0)
+        outputArray = itk.array_view_from_image(output)
+        self.assertTrue(output.GetLargestPossibleRegion().GetSize()[2] == 81)
+        self.assertTrue(output.GetOrigin()[2] == -10)
+        self.assertTrue(np.allclose(outputArray[:80, 4, 5], 406))
+        output = stitch_images([bed1, bed2, bed3], dimension=1, pad=0)
+        self.assertTrue(output.GetLargestPossibleRegion().GetSize()[1] == 21)
+
+    def test_stitch_images_blending(self):
+        bed1 = itk.image_from_array(np.ones((10, 10, 10), dtype=np.float32))
+        bed2 = itk.image_from_array(3*np.ones((10, 10, 10), dtype=np.float32))
+        for dimension in [0, 2]:
+            origin = [0, 0, 0]
+            origin[dimension] = 6
+            bed2.SetOrigin(origin)
+            axis = 2 - dimension
+            output = stitch_images([bed1, bed2], dimension=dimension, blending="max")
+            outputArray = np.moveaxis(itk.array_view_from_image(output), axis, 0)
+            self.assertTrue(np.allclose(outputArray[6:10], 3))
+            output = stitch_images([bed1, bed2], dimension=dimension, blending="average")
+            outputArray = np.moveaxis(itk.array_view_from_image(output), axis, 0)
+            self.assertTrue(np.allclose(outputArray[:6], 1))
+            self.assertTrue(np.allclose(outputArray[6:10], 2))
+            output = stitch_images([bed1, bed2], dimension=dimension, blending="linear")
+            outputArray = np.moveaxis(itk.array_view_from_image(output), axis, 0)
+            overlap = outputArray[6:bed1.GetLargestPossibleRegion().GetSize()[dimension], 0, 0]
+            self.assertTrue(np.all(np.diff(overlap) > 0) and overlap[0] > 1 and overlap[-1] < 3)
+
+    def test_stitch_images_resampled_ones(self):
+        #Beds of ones off the output grid: the padded slices of the resampled beds are never blended
+        beds = []
+        for origin in [0, 30.3, 70.9]:
+            bed = itk.image_from_array(np.ones((20, 6, 6), dtype=np.float32))
+            bed.SetSpacing([2, 2, 2 if origin == 0 else 2.5])
+            bed.SetOrigin([0, 0, origin])
+            beds.append(bed)
+        for blending in ["max", "average", "linear"]:
+            outputArray = itk.array_view_from_image(stitch_images(beds, dimension=2, blending=blending))
+            start, stop = bed_inside_extent(beds[2], beds[0], 2, *bed_extent(beds[2], beds[0], 2))
+            self.assertTrue(np.all(outputArray[:stop +1] == 1))
+            self.assertTrue(np.all(outputArray[stop +1:] == 0))
+
+    def test_stitch_images_resampled_edges(self):
+        #Bed off the output grid: every resampled slice with its center inside the bed is kept, like stitch_image did
+        bed1 = createBedExample([7, 3.4, -10], [23, 20, 30])
+        bed2 = itk.image_from_array(np.float32(np.arange(30)[:, None, None] + 10*np.ones((30, 20, 23))))
+        bed2.SetOrigin([7, 3.4, 41.3])
+        bed2.SetSpacing([2, 2, 2])
+        output = stitch_images([bed1, bed2], dimension=2, pad=0)
+        outputArray = itk.array_view_from_image(output)
+        #Previous two beds algorithm: resampled second bed over its whole extent, then the first bed where it is superior
+        start, stop = bed_extent(bed2, bed1, 2)
+        expectedArray = np.zeros(outputArray.shape, dtype=np.float32)
+        expectedArray[start:stop +1] = itk.array_view_from_image(resample_bed(bed2, bed1, 2, start, stop, 0))
+        expectedArray[:30] = np.maximum(expectedArray[:30], itk.array_view_from_image(bed1))
+        self.assertTrue(output.GetLargestPossibleRegion().GetSize()[2] == 56)
+        self.assertTrue(np.allclose(outputArray, expectedArray))
+        self.assertTrue(np.all(outputArray[55] > 0))
+        inside = bed_inside_extent(bed2, bed1, 2, start, stop)
+        self.assertTrue(inside == (26, 55))
+        for blending in ["average", "linear"]:
+            outputArray = itk.array_view_from_image(stitch_images([bed1, bed2], dimension=2, pad=0, blending=blending))
+            self.assertTrue(np.allclose(outputArray[30:], expectedArray[30:]))
+            self.assertTrue(np.all(outputArray[26:30] != itk.array_view_from_image(bed1)[26:30]))
+
+    def test_stitch_images_aligned(self):
+        bed1 = createBedExample([7, 3.4, -10], [23, 20, 30])
+        bed2 = createBedExample([7, 3.4, 40.0000001], [23, 20, 30])
+        self.assertTrue(aligned_offset(bed2, bed1, 2) == 25)
+        self.assertTrue(aligned_offset(bed2, bed1, 2, tolerance=1e-9) is None)
+        bed3 = createBedExample([7, 3.4, 41], [23, 20, 30])
+        self.assertTrue(aligned_offset(bed3, bed1, 2) is None)
+        output = stitch_images([bed1, bed2], dimension=2, pad=0)
+        resampledOutput = stitch_images([bed1, bed2], dimension=2, pad=0, tolerance=1e-9)
+        self.assertTrue(np.array_equal(itk.array_view_from_image(output), itk.array_view_from_image(resampledOutput)))
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+#   Copyright (C): OpenGATE Collaboration
+#   This software is distributed under the terms
+#   of the GNU Lesser General  Public Licence (LGPL)
+#   See LICENSE.md for further details
+# -----------------------------------------------------------------------------
+
+import itk
+import click
+import numpy as np
+import sys
+import concurrent.futures
+import image_projection
+import radioactiveDecay
+
+
+# -----------------------------------------------------------------------------
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+@click.command(context_settings=CONTEXT_SETTINGS)
+
+@click.option('--input', '-i', 'inputs', help='Input activity image filename of a time point (repeat the option for each time point)', required=True, multiple=True,
+                type=click.Path(dir_okay=False))
+@click.option('--time', '-t', 'times', help='Time between injection and the acquisition of the time point in h (one for each input, in the same order)', required=True, multiple=True, type=float)
+@click.option('--model', '-m', help='Model of the time activity curve of the voxels', default='trapezoid',
+                type=click.Choice(['trapezoid', 'mono', 'bi']))
+@click.option('--radionuclide', '-r', help='Radionuclide (see radioactiveDecay.py)', default='Lu177')
+@click.option('--decay_corrected', help='The input images are decay corrected to the injection time', is_flag=True, default=False)
+@click.option('--chunk_size', help='Size (MB) of the chunk of voxels processed at once', default=64.0)
+@click.option('--jobs', '-j', help='Number of chunks processed at the same time', default=1)
+@click.option('--output', '-o', help='Output filename of the time integrated activity image', required=True,
+                type=click.Path(dir_okay=False,
+                              writable=True, readable=False,
+                              resolve_path=True, allow_dash=False, path_type=None))
+
+def time_integrated_activity_click(inputs, times, model, radionuclide, decay_corrected, chunk_size, jobs, output):
+    '''
+    Compute the time integrated activity (TIA) image from co-registered activity images (eg: calibrated SPECT from faf_calibration) acquired at several time points.
+
+    The time activity curve of each voxel is integrated from the injection to infinity with the model:\n
+    - trapezoid: linear from 0 at the injection to the first time point, trapezoids between the time points and physical decay after the last time point\n
+    - mono: mono-exponential A0.exp(-k.t) fitted on the time points, with k not smaller than the physical decay constant\n
+    - bi: bi-exponential A0.(exp(-k1.t) - exp(-k2.t)) fitted on the time points (at least 3), the mono-exponential is kept for the voxels where it fits better\n
+
+    The output is in the unit of the input images times h. With --decay_corrected, the input images are first converted to the activity at the acquisition time. The voxels are processed by chunks, and uncompressed .mhd/.raw (or .mha) inputs are memory mapped, so the time points are never fully loaded in memory.
+    '''
+
+    outputImage = time_integrated_activity(list(inputs), list(times), model, radionuclide, decay_corrected, chunk_size*1024*1024, jobs)
+    itk.imwrite(outputImage, output)
+
+# -----------------------------------------------------------------------------
+def time_integrated_activity(images, times, model="trapezoid", radionuclide="Lu177", decayCorrected=False, chunkSize=64*1024*1024, jobs=1):
+    #images are ITK images or filenames of the time points, times in h
+    if len(images) != len(times):
+        print("The number of images (" + str(len(images)) + ") is not the number of times (" + str(len(times)) + ")")
+        sys.exit(1)
+    if len(images) < 2 or (model == "bi" and len(images) < 3):
+        print("Not enough time points (" + str(len(images)) + ") for the model " + model)
+        sys.exit(1)
+    order = np.argsort(times)
+    times = np.array(times, dtype=np.float64)[order]
+    arrays = []
+    for index in order:
+        arrays += [activity_array(images[index])]
+    array, spacing, origin = arrays[0]
+    for otherArray, otherSpacing, otherOrigin in arrays[1:]:
+        if otherArray.shape != array.shape or not np.allclose(otherSpacing, spacing) or not np.allclose(otherOrigin, origin):
+            print("The images of the time points are not in the same frame")
+            sys.exit(1)
+    arrays = [a[0] for a in arrays]
+    decayConstant = np.log(2.0)/(radioactiveDecay.halfLife(radionuclide)/3600.0)
+
+    output = np.zeros(array.shape, dtype=np.float32)
+    sliceSize = max(1, int(np.prod(array.shape[1:])))*len(arrays)*8
+    nbSlices = max(1, int(chunkSize // sliceSize))
+
+    def process(start):
+        stop = min(start + nbSlices, array.shape[0])
+        activities = np.stack([np.asarray(a[start:stop], dtype=np.float64).reshape(-1) for a in arrays])
+        if decayCorrected:
+            activities *= np.exp(-decayConstant*times)[:, None]
+        output[start:stop] = tia_voxels(activities, times, model, decayConstant).reshape(output[start:stop].shape)
+
+    with concurrent.futures.ThreadPoolExecutor(max(1, jobs)) as executor:
+        list(executor.map(process, range(0, array.shape[0], nbSlices)))
+
+    outputImage = itk.image_from_array(output)
+    outputImage.SetSpacing(spacing)
+    outputImage.SetOrigin(origin)
+    return outputImage
+
+# -----------------------------------------------------------------------------
+def activity_array(image):
+    #(array, spacing, origin) of an ITK image or of an image file (memory mapped if possible)
+    if isinstance(image, str):
+        mappedImage = image_projection.read_mhd_memmap(image)
+        if mappedImage is not None:
+            return mappedImage
+        image = itk.imread(image)
+    if not (itk.array_from_matrix(image.GetDirection()) == np.eye(image.GetImageDimension())).all():
+        print("Images with a direction are not supported")
+        sys.exit(1)
+    return (itk.array_view_from_image(image), list(image.GetSpacing()), list(image.GetOrigin()))
+
+# -----------------------------------------------------------------------------
+def tia_voxels(activities, times, model="trapezoid", decayConstant=0.0):
+    #Time integrated activity of the voxels: activities (nbTimes, nbVoxels), times (nbTimes) in increasing order
+    if model == "trapezoid":
+        return tia_trapezoid(activities, times, decayConstant)
+    elif model == "mono":
+        A0, k = fit_monoexponential(activities, times, decayConstant)
+        return np.where(k > 0, A0/np.where(k > 0, k, 1), tia_trapezoid(activities, times, decayConstant))
+    elif model == "bi":
+        return tia_biexponential(activities, times, decayConstant)
+    print("Unknown model: " + str(model))
+    sys.exit(1)
+
+# -----------------------------------------------------------------------------
+def tia_trapezoid(activities, times, decayConstant):
+    tia = 0.5*activities[0]*times[0]
+    tia = tia + np.sum(0.5*(activities[1:] + activities[:-1])*np.diff(times)[:, None], axis=0)
+    if decayConstant > 0:
+        tia = tia + activities[-1]/decayConstant
+    return tia
+
+# -----------------------------------------------------------------------------
+def fit_monoexponential(activities, times, decayConstant):
+    #Log-linear least squares fit of A0.exp(-k.t) on the positive activities of each voxel, with k >= decayConstant.
+    #k is 0 for the voxels with less than 2 positive activities
+    weights = (activities > 0).astype(np.float64)
+    logActivities = np.log(np.where(activities > 0, activities, 1))
+    t = times[:, None]
+    s0 = np.sum(weights, axis=0)
+    st = np.sum(weights*t, axis=0)
+    stt = np.sum(weights*t*t, axis=0)
+    sy = np.sum(weights*logActivities, axis=0)
+    sty = np.sum(weights*t*logActivities, axis=0)
+    determinant = s0*stt - st*st
+    valid = (s0 >= 2) & (determinant > 0)
+    safeDeterminant = np.where(valid, determinant, 1)
+    k = np.where(valid, -(s0*sty - st*sy)/safeDeterminant, 0)
+    k = np.where(valid, np.maximum(k, decayConstant), 0)
+    logA0 = (sy + k*st)/np.where(s0 > 0, s0, 1)
+    A0 = np.where(valid, np.exp(logA0), 0)
+    return A0, k
+
+# -----------------------------------------------------------------------------
+def biexponential(parameters, times, decayConstant):
+    #A0.(exp(-k1.t) - exp(-k2.t)) with A0 = exp(a), k1 = decayConstant + exp(b), k2 = k1 + exp(c)
+    A0 = np.exp(parameters[0])
+    k1 = decayConstant + np.exp(parameters[1])
+    k2 = k1 + np.exp(parameters[2])
+    t = times[:, None]
+    e1 = np.exp(-k1*t)
+    e2 = np.exp(-k2*t)
+    return A0, k1, k2, e1, e2, A0*(e1 - e2)
+
+# -----------------------------------------------------------------------------
+def tia_biexponential(activities, times, decayConstant, iterations=50):
+    #Vectorized Levenberg-Marquardt fit of the bi-exponential on all the voxels, starting from the mono-exponential
+    #fit. The mono-exponential is kept for the voxels where it fits better (or with less than 3 positive activities)
+    A0, k = fit_monoexponential(activities, times, decayConstant)
+    monoFit = A0*np.exp(-k*times[:, None])
+    monoError = np.sum((activities - monoFit)**2, axis=0)
+    monoTIA = np.where(k > 0, A0/np.where(k > 0, k, 1), tia_trapezoid(activities, times, decayConstant))
+
+    fitted = (np.sum(activities > 0, axis=0) >= 3) & (k > 0)
+    y = activities[:, fitted]
+    parameters = np.stack([np.log(A0[fitted]*2), np.log(np.maximum(k[fitted] - decayConstant, 1e-3*k[fitted] + 1e-12)), np.full(np.sum(fitted), np.log(3.0/times[0]))])
+    error = np.sum((y - biexponential(parameters, times, decayConstant)[5])**2, axis=0)
+    damping = np.full(y.shape[1], 1e-3)
+    with np.errstate(over='ignore', invalid='ignore'):
+        parameters, error = levenberg_marquardt(parameters, error, damping, y, times, decayConstant, iterations)
+        A0b, k1, k2 = biexponential(parameters, times, decayConstant)[:3]
+        biTIA = A0b*(1/k1 - 1/k2)
+    tia = monoTIA.copy()
+    useBi = np.isfinite(biTIA) & (error < monoError[fitted])
+    tia[np.flatnonzero(fitted)[useBi]] = biTIA[useBi]
+    return tia
+
+# -----------------------------------------------------------------------------
+def levenberg_marquardt(parameters, error, damping, y, times, decayConstant, iterations):
+    t = times[:, None]
+    for iteration in range(iterations):
+        A0b, k1, k2, e1, e2, f = biexponential(parameters, times, decayConstant)
+        jacobian = np.stack([f, A0b*(k1 - decayConstant)*t*(e2 - e1), A0b*(k2 - k1)*t*e2], axis=-1)
+        residual = y - f
+        jtj = np.einsum('nvi,nvj->vij', jacobian, jacobian)
+        jtr = np.einsum('nvi,nv->vi', jacobian, residual)
+        diagonal = np.einsum('vii->vi', jtj)
+        jtj[:, [0, 1, 2], [0, 1, 2]] += damping[:, None]*diagonal + 1e-12
+        step = np.linalg.solve(jtj, jtr[..., None])[..., 0].T
+        newParameters = parameters + step
+        newError = np.sum((y - biexponential(newParameters, times, decayConstant)[5])**2, axis=0)
+        better = np.isfinite(newError) & (newError < error)
+        parameters = np.where(better, newParameters, parameters)
+        error = np.where(better, newError, error)
+        damping = np.where(better, damping/3, np.minimum(damping*3, 1e12))
+    return parameters, error
+
+# -----------------------------------------------------------------------------
+if __name__ == '__main__':
+    time_integrated_activity_click()
+
+# -----------------------------------------------------------------------------
+import unittest
+import tempfile
+import shutil
+import os
+
+class Test_Time_Integrated_Activity(unittest.TestCase):
+    def test_tia_voxels(self):
+        decayConstant = np.log(2.0)/(6.647*24)
+        times = np.array([4.0, 24.0, 96.0, 168.0])
+        A0 = np.array([1.0, 5.0, 2.0])
+        k = np.array([0.01, 0.05, 0.2]) + decayConstant
+        activities = A0*np.exp(-k*times[:, None])
+        self.assertTrue(np.allclose(tia_voxels(activities, times, "mono", decayConstant), A0/k))
+        #Uptake and washout slow enough to be sampled by the time points
+        k = np.array([0.01, 0.05, 0.02]) + decayConstant
+        k2 = np.array([0.5, 1.0, 0.1]) + k
+        activities = A0*(np.exp(-k*times[:, None]) - np.exp(-k2*times[:, None]))
+        self.assertTrue(np.allclose(tia_voxels(activities, times, "bi", decayConstant), A0*(1/k - 1/k2), rtol=1e-3))
+        trapezoid = 0.5*activities[0]*4 + 0.5*(activities[0] + activities[1])*20 + 0.5*(activities[1] + activities[2])*72 + 0.5*(activities[2] + activities[3])*72 + activities[3]/decayConstant
+        self.assertTrue(np.allclose(tia_voxels(activities, times, "trapezoid", decayConstant), trapezoid))
+    def test_time_integrated_activity(self):
+        tmpdirpath = tempfile.mkdtemp()
+        np.random.seed(0)
+        decayConstant = np.log(2.0)/(6.647*24)
+        times = [24.0, 4.0, 96.0]
+        A0 = np.random.rand(10, 8, 6)*100
+        k = np.random.rand(10, 8, 6)*0.05 + decayConstant
+        images = []
+        for index, time in enumerate(times):
+            image = itk.image_from_array(np.float32(A0*np.exp(-k*time)))
+            image.SetSpacing([2, 3, 4])
+            itk.imwrite(image, os.path.join(tmpdirpath, "time" + str(index) + ".mhd"))
+            images += [image]
+        output = time_integrated_activity(images, times, "mono")
+        self.assertTrue(np.allclose(itk.array_view_from_image(output), A0/k, rtol=1e-4))
+        self.assertTrue(np.allclose(output.GetSpacing(), [2, 3, 4]))
+        #Memory mapped time points, by chunks of 1 slice
+        filenames = [os.path.join(tmpdirpath, "time" + str(index) + ".mhd") for index in range(len(times))]
+        outputFile = time_integrated_activity(filenames, times, "mono", chunkSize=1, jobs=3)
+        self.assertTrue(np.allclose(itk.array_view_from_image(outputFile), itk.array_view_from_image(output)))
+        #Decay corrected time points
+        images = [itk.image_from_array(np.float32(A0*np.exp(-(k - decayConstant)*time))) for time in times]
+        output = time_integrated_activity(images, times, "mono", decayCorrected=True)
+        self.assertTrue(np.allclose(itk.array_view_from_image(output), A0/k, rtol=1e-4))
+        shutil.rmtree(tmpdirpath)